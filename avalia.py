@@ -1,26 +1,48 @@
 from math import sqrt
 import os
 import json
+import argparse
 import pandas as pd
-from sklearn.metrics import mean_squared_error, mean_absolute_error, r2_score
-import joblib
+from store import group_chunks, read_dataframe
+from records import parse_coordinates
+from modelbundle import FAMILIES, load_bundle
+from cleaning import haversine_meters
+from parallel import run_file_stage, report_errors
+from localcalendar import local_hours
 import numpy as np
 
 # Caminhos dos diretórios
 current_dir = os.path.dirname(__file__)
 models_path = os.path.join(current_dir, 'models')
 data_test_path = os.path.join(current_dir, 'dataTest')
+store_test_path = os.path.join(current_dir, 'store', 'dataTest')
 result_file_path = os.path.join(current_dir, 'resultPrevisor.txt')
 
 # Linhas de ônibus relevantes
 relevant_lines = [
     '107', '177', '203', '222', '230', '232', '415', '2803', '324', '852', '557', '759', '343', '779', '905', '108',
-    '483', '864', '639', '3', '309', '774', '629', '371', '397', '100', '838', '315', '624', '388', '918', '665',
-    '328', '497', '878', '355', '138', '606', '457', '550', '803', '917', '638', '2336', '399', '298', '867', '553',
-    '565', '422', '756', '186012003', '292', '554', '634', '232', '415', '2803', '324', '852', '557', '759', '343',
-    '779', '905', '108'
+    '483', '864', '639', '3', '309', '774', '629', '371', '397', '100', '838', '315', '624', '388', '918', '665', '328',
+    '497', '878', '355', '138', '606', '457', '550', '803', '917', '638', '2336', '399', '298', '867', '553', '565',
+    '422', '756', '186012003', '292', '554', '634'
 ]
 
+# Colunas lidas dos dados de teste
+DATA_COLUMNS = ['datahora', 'velocidade', 'latitude', 'longitude']
+
+# Métricas de cada família de modelos e seus rótulos no arquivo de resultados:
+# velocidade (km/h) para 'model' e 'model_speed', distância geodésica (m) até a posição real para 'model_coords'
+FAMILY_METRICS = {
+    'model': [('mse', 'MSE'), ('mae', 'MAE'), ('r2', 'R2')],
+    'model_speed': [('mse', 'MSE'), ('mae', 'MAE'), ('r2', 'R2')],
+    'model_coords': [('mae_m', 'Erro médio (m)'), ('rmse_m', 'RMSE (m)'), ('p90_m', 'P90 (m)')],
+}
+
+# Nome de cada família nas mensagens e no arquivo de resultados
+FAMILY_NAMES = {'model': None, 'model_speed': 'velocidade', 'model_coords': 'coordenadas'}
+
+# Modelos carregados uma única vez por processo
+models = None
+
 # Função para encontrar recursivamente todos os arquivos _sorted.json em um diretório
 def find_sorted_json_files(directory):
     sorted_json_files = []
@@ -30,99 +52,176 @@ def find_sorted_json_files(directory):
                 sorted_json_files.append(os.path.join(root, file))
     return sorted_json_files
 
-# Avaliação do modelo
-results = {linha: {'mse': [], 'mae': [], 'r2': []} for linha in relevant_lines}
+# Função para listar os arquivos de origem dos dados de teste, preferindo o armazenamento colunar
+# gerado pelo main.py (um chunk por arquivo de origem) aos arquivos _sorted.json
+# O armazenamento é percorrido uma única vez: cada chunk leva os seus diretórios das linhas relevantes
+def list_sources(directory, store_directory):
+    chunks = group_chunks(store_directory)
+    if chunks:
+        linhas = set(relevant_lines)
+        return [('store', chunk, [entry for entry in chunk_dirs if entry[1] in linhas])
+                for chunk, chunk_dirs in chunks.items()]
+    return [('json', filepath) for filepath in find_sorted_json_files(directory)]
+
+# Função para ler os dados de um arquivo de origem como DataFrame (do armazenamento, apenas as colunas e linhas necessárias)
+def read_source(source, store_directory):
+    kind, name = source[:2]
+    if kind == 'store':
+        return read_dataframe(store_directory, columns=DATA_COLUMNS, chunk_dirs=source[2])
+    with open(name, 'r') as file:
+        return pd.DataFrame(json.load(file))
+
+# Função para preparar os dados: linhas relevantes, tipos numéricos e hora do dia (como no treinamento)
+def prepare_data(df):
+    df_relevant = df[df['linha'].astype(str).isin(relevant_lines)]
+    data = pd.DataFrame({'linha': df_relevant['linha'].astype(str).to_numpy()})
+    datahora = pd.to_numeric(df_relevant['datahora'], errors='coerce').to_numpy()
+    data['hora_do_dia'] = local_hours(datahora)
+    data['velocidade'] = pd.to_numeric(df_relevant['velocidade'], errors='coerce').to_numpy() \
+        if 'velocidade' in df_relevant.columns else np.nan
+    for column in ('latitude', 'longitude'):
+        data[column] = parse_coordinates(df_relevant[column]) if column in df_relevant.columns else np.nan
+    return data
+
+# Função para calcular R2 como o sklearn.metrics.r2_score: NaN com menos de duas amostras,
+# e 1 ou 0 quando o valor real é constante (previsão exata ou não)
+def r2_from_sums(ss_res, ss_tot, count):
+    with np.errstate(divide='ignore', invalid='ignore'):
+        r2 = 1 - ss_res / ss_tot
+    r2 = np.where(ss_tot > 0, r2, np.where(ss_res == 0, 1.0, 0.0))
+    return np.where(count >= 2, r2, np.nan)
+
+# Função para avaliar uma família de modelos sobre os dados de um arquivo
+# Todas as linhas são previstas de uma vez com os parâmetros do pacote de modelos, e as métricas
+# de cada linha saem de um único groupby; linhas sem modelo ficam de fora
+# Retorna {linha: {métrica: valor}}
+def evaluate_family(models, family, data):
+    features = list(FAMILIES[family])
+    targets = ['latitude', 'longitude'] if family == 'model_coords' else ['velocidade']
+    data = data[data[features + targets].notna().all(axis=1)]
+    codes, linhas = pd.factorize(data['linha'])
+    rows = models.lookup(family, linhas)[codes] if len(linhas) else np.empty(0, dtype=np.int64)
+    data = data[rows >= 0]
+    rows = rows[rows >= 0]
+    if data.empty:
+        return {}
+    predicted = models.predict(family, rows, data[features].to_numpy(dtype=np.float64))
 
-sorted_json_files = find_sorted_json_files(data_test_path)
+    if family == 'model_coords':
+        distances = haversine_meters(data['latitude'].to_numpy(), data['longitude'].to_numpy(),
+                                     predicted[:, 0], predicted[:, 1])
+        errors = pd.DataFrame({'linha': data['linha'].to_numpy(), 'distancia': distances, 'quadrado': distances ** 2})
+        grouped = errors.groupby('linha', sort=False)
+        metrics = pd.DataFrame({
+            'mae_m': grouped['distancia'].mean(),
+            'rmse_m': np.sqrt(grouped['quadrado'].mean()),
+            'p90_m': grouped['distancia'].quantile(0.9),
+        })
+    else:
+        y = data['velocidade'].to_numpy()
+        errors = pd.DataFrame({'linha': data['linha'].to_numpy(), 'y': y, 'quadrado': (y - predicted[:, 0]) ** 2,
+                               'absoluto': np.abs(y - predicted[:, 0])})
+        grouped = errors.groupby('linha', sort=False)
+        errors['desvio'] = (y - grouped['y'].transform('mean').to_numpy()) ** 2
+        sums = errors.groupby('linha', sort=False).agg(mse=('quadrado', 'mean'), mae=('absoluto', 'mean'),
+                                                       ss_res=('quadrado', 'sum'), ss_tot=('desvio', 'sum'),
+                                                       count=('y', 'size'))
+        metrics = pd.DataFrame({'mse': sums['mse'], 'mae': sums['mae'],
+                                'r2': r2_from_sums(sums['ss_res'], sums['ss_tot'], sums['count'])},
+                               index=sums.index)
+    return metrics.to_dict('index')
 
-for filepath in sorted_json_files:
-    # Processar o arquivo JSON
-    with open(filepath, 'r') as file:
-        data = json.load(file)
-    
-    # Converter para DataFrame pandas
-    df = pd.DataFrame(data)
-    
+# Função executada para cada arquivo de origem (em paralelo com --workers): avalia as três famílias de modelos
+# Retorna {família: {linha: {métrica: valor}}}, ou None se o arquivo não tem linhas relevantes
+def evaluate_source(source, store_directory):
+    global models
+    if models is None:
+        models = load_bundle(models_path)
+
+    df = read_source(source, store_directory)
     # Verificar se a coluna 'linha' existe
     if 'linha' not in df.columns:
-        print(f"Coluna 'linha' não encontrada no arquivo {filepath}")
-        continue
-    
-    # Filtrar apenas as linhas relevantes
-    df_relevant = df[df['linha'].astype(str).isin(relevant_lines)]
-    
-    # Verificar se df_relevant não está vazio
-    if df_relevant.empty:
-        print(f"Nenhuma linha relevante encontrada no arquivo {filepath}")
-        continue
-    
-    # Certificar que 'datahora' seja numérico antes da conversão
-    df_relevant['datahora'] = pd.to_numeric(df_relevant['datahora'], errors='coerce')
-    df_relevant['datahora'] = pd.to_datetime(df_relevant['datahora'], unit='ms')
-    df_relevant['hora_do_dia'] = df_relevant['datahora'].dt.hour
-    
-    for linha in relevant_lines:
-        # Filtrar dados apenas para a linha atual
-        data_linha = df_relevant[df_relevant['linha'] == linha]
-        
-        if len(data_linha) > 0:
-            # Verificar se a coluna 'velocidade' existe
-            if 'velocidade' not in data_linha.columns:
-                print(f"Coluna 'velocidade' não encontrada para a linha {linha} no arquivo {filepath}")
-                continue
-            
-            # Separar features e target
-            X_test = data_linha[['hora_do_dia']]
-            y_test = data_linha['velocidade']
-            
-            # Carregar o modelo treinado
-            model_filename = f'model_{linha}.joblib'
-            model_path = os.path.join(models_path, model_filename)
-            
-            if os.path.exists(model_path):
-                model = joblib.load(model_path)
-                
-                # Prever as velocidades
-                y_pred = model.predict(X_test)
-                
-                # Calcular as métricas de precisão
-                mse = mean_squared_error(y_test, y_pred)
-                mae = mean_absolute_error(y_test, y_pred)
-                r2 = r2_score(y_test, y_pred)
-                
-                # Armazenar os resultados
-                results[linha]['mse'].append(mse)
-                results[linha]['mae'].append(mae)
-                results[linha]['r2'].append(r2)
-                
-                print(f'Linha {linha}: MSE = {mse}, MAE = {mae}, R2 = {r2}')
-
-# Calcular a média, variância e desvio padrão para cada linha
-final_results = []
-for linha, metrics in results.items():
-    if metrics['mse']:
-        mse_mean = np.mean(metrics['mse'])
-        mse_variance = np.var(metrics['mse'])
-        mse_std = np.std(metrics['mse'])
-        
-        mae_mean = np.mean(metrics['mae'])
-        mae_variance = np.var(metrics['mae'])
-        mae_std = np.std(metrics['mae'])
-        
-        r2_mean = np.mean(metrics['r2'])
-        r2_variance = np.var(metrics['r2'])
-        r2_std = np.std(metrics['r2'])
-        
-        final_results.append(
+        print(f"Coluna 'linha' não encontrada no arquivo {source[1]}")
+        return None
+
+    data = prepare_data(df)
+    # Verificar se há dados das linhas relevantes
+    if data.empty:
+        print(f"Nenhuma linha relevante encontrada no arquivo {source[1]}")
+        return None
+
+    return {family: evaluate_family(models, family, data) for family in FAMILIES}
+
+# Função para formatar o resultado de uma linha: média, variância e desvio padrão de cada métrica entre os arquivos
+# Com scaled, as métricas do modelo de velocidade por hora ('model') são escritas na escala usada pelo avalia.py
+def format_result(family, linha, metrics, scaled):
+    stats = {name: (np.nanmean(values), np.nanvar(values), np.nanstd(values)) for name, values in metrics.items()}
+    if family == 'model' and scaled:
+        (mse_mean, mse_variance, mse_std), (mae_mean, mae_variance, mae_std), (r2_mean, r2_variance, r2_std) = \
+            stats['mse'], stats['mae'], stats['r2']
+        return (
             f'Linha {linha}: MSE - Mean: {mse_mean / 1000}, Variance: {mse_variance / 10000}, Std: {mse_std / 1000}; '
             f'MAE - Mean: {mae_mean / 1000}, Variance: {mae_variance / 100}, Std: {mae_std / 1000}; '
             f'R2 - Mean: {sqrt((r2_mean * 10)*(r2_mean * 10))}, Variance: {r2_variance / 10}, Std: {r2_std / 10}'
         )
 
-        
-# Escrever os resultados em um arquivo .txt
-with open(result_file_path, 'w') as result_file:
-    for result in final_results:
-        result_file.write(result + '\n')
+    name = FAMILY_NAMES[family]
+    prefix = f'Linha {linha}: ' if name is None else f'Linha {linha} ({name}): '
+    return prefix + '; '.join(f'{label} - Mean: {stats[metric][0]}, Variance: {stats[metric][1]}, '
+                              f'Std: {stats[metric][2]}' for metric, label in FAMILY_METRICS[family])
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Avalia os modelos de cada linha com os dados de 'dataTest'.")
+    parser.add_argument('--workers', type=int, default=1,
+                        help="Número de processos avaliando arquivos em paralelo (padrão: 1, serial).")
+    parser.add_argument('--raw', action='store_true',
+                        help="Escreve as métricas do modelo de velocidade por hora sem a escala do avalia.py "
+                             "(como o avaliaModels.py).")
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+
+    # Carregar o pacote de modelos antes de iniciar os processos
+    global models
+    models = load_bundle(models_path)
+
+    # Avaliação dos modelos
+    results = {family: {linha: {metric: [] for metric, _ in FAMILY_METRICS[family]} for linha in relevant_lines}
+               for family in FAMILIES}
+
+    sources = list_sources(data_test_path, store_test_path)
+    evaluated, errors = run_file_stage(evaluate_source, sources, store_test_path, workers=args.workers)
+    report_errors('avalia', [(source[1], message) for source, message in errors])
+
+    for _, source_results in evaluated:
+        if source_results is None:
+            continue
+        for family, line_metrics in source_results.items():
+            for linha in relevant_lines:
+                if linha not in line_metrics:
+                    continue
+                metrics = line_metrics[linha]
+                for metric, values in results[family][linha].items():
+                    values.append(metrics[metric])
+
+                name = FAMILY_NAMES[family]
+                prefix = f'Linha {linha}' if name is None else f'Linha {linha} ({name})'
+                print(prefix + ': ' + ', '.join(f'{label} = {metrics[metric]}' for metric, label in FAMILY_METRICS[family]))
+
+    # Calcular a média, variância e desvio padrão para cada linha
+    final_results = []
+    for family in FAMILIES:
+        for linha, metrics in results[family].items():
+            if metrics[FAMILY_METRICS[family][0][0]]:
+                final_results.append(format_result(family, linha, metrics, scaled=not args.raw))
+
+    # Escrever os resultados em um arquivo .txt
+    with open(result_file_path, 'w') as result_file:
+        for result in final_results:
+            result_file.write(result + '\n')
+
+    print(f'Resultados salvos em {result_file_path}')
 
-print(f'Resultados salvos em {result_file_path}')
+if __name__ == "__main__":
+    main()
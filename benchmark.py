@@ -0,0 +1,326 @@
+import os
+import sys
+import json
+import glob
+import time
+import shutil
+import argparse
+import platform
+import resource
+import tempfile
+import multiprocessing
+from synthetic import generate_dataset
+
+BASELINE_FILE = 'benchmark_baseline.json'
+
+# Records of the dataset in a workspace, so that later runs with --stages can reuse it
+COUNTS_FILE = 'benchmark_counts.json'
+
+# Slowdown over the baseline reported as a regression
+DEFAULT_MAX_SLOWDOWN = 0.10
+
+# Stages of main.py, in the order it runs them; each takes (workspace, workers)
+PIPELINE_STAGES = ['extract', 'filter', 'group', 'fix', 'clean', 'features', 'store']
+FUSED_STAGES = ['extract', 'pipeline']
+MODEL_STAGES = ['train', 'inference']
+
+
+def relevant_lines():
+    import trainModels
+    return trainModels.relevant_lines
+
+
+def stage_extract(workspace, workers):
+    import main
+    for folder in ('dataGPS', 'dataTest'):
+        main.extract_zip_files(os.path.join(workspace, folder))
+
+
+def stage_filter(workspace, workers):
+    import main
+    for folder in ('dataGPS', 'dataTest'):
+        main.filter_json_files(os.path.join(workspace, folder), relevant_lines(), workers)
+
+
+def stage_group(workspace, workers):
+    import main
+    for folder in ('dataGPS', 'dataTest'):
+        main.group_sequence_json_files(os.path.join(workspace, folder), workers)
+
+
+def stage_fix(workspace, workers):
+    import main
+    for folder in ('dataGPS', 'dataTest'):
+        main.fix_all_sorted_json_files(os.path.join(workspace, folder), workers)
+
+
+def stage_clean(workspace, workers):
+    import main
+    main.process_all_files(workspace, workers, os.path.join(workspace, 'store', 'routes'))
+
+
+def stage_features(workspace, workers):
+    import main
+    for folder in ('dataGPS', 'dataTest'):
+        main.process_all_sorted_json_files(os.path.join(workspace, folder), workers)
+
+
+def stage_store(workspace, workers):
+    from store import build_store
+    for folder in ('dataGPS', 'dataTest'):
+        build_store(os.path.join(workspace, folder), os.path.join(workspace, 'store', folder))
+
+
+def stage_pipeline(workspace, workers):
+    from pipeline import run_pipeline
+    routes_path = os.path.join(workspace, 'store', 'routes')
+    for folder in ('dataGPS', 'dataTest'):
+        store_path = os.path.join(workspace, 'store', folder)
+        run_pipeline(os.path.join(workspace, folder), relevant_lines(), ingest='extract', store_path=store_path,
+                     workers=workers, manifest_path=os.path.join(store_path, 'manifest.json'),
+                     routes_path=routes_path, build_routes=folder == 'dataGPS')
+
+
+def stage_train(workspace, workers):
+    import trainModels
+    trainModels.main(['--workers', str(workers)])
+
+
+def stage_inference(workspace, workers):
+    import testModels
+    testModels.main()
+
+
+STAGES = {
+    'extract': stage_extract,
+    'filter': stage_filter,
+    'group': stage_group,
+    'fix': stage_fix,
+    'clean': stage_clean,
+    'features': stage_features,
+    'store': stage_store,
+    'pipeline': stage_pipeline,
+    'train': stage_train,
+    'inference': stage_inference,
+}
+
+
+def peak_rss_mb():
+    """
+    Peak resident set size of this process and of its finished worker processes, in MB.
+    """
+    peak_kb = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                  resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    return peak_kb / (1024 * 1024 if sys.platform == 'darwin' else 1024)
+
+
+def stage_process(stage_name, workspace, workers, connection):
+    """
+    Run one stage in a fresh process, with the workspace's copy of the scripts,
+    and send back its wall time and peak memory.
+    """
+    os.chdir(workspace)
+    sys.path.insert(0, workspace)
+
+    # Import the heavy dependencies before starting the clock
+    import numpy, pandas, sklearn, scipy.spatial  # noqa: F401,E401
+
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    os.dup2(devnull, 1)
+    try:
+        start = time.perf_counter()
+        STAGES[stage_name](workspace, workers)
+        seconds = time.perf_counter() - start
+        connection.send({'seconds': seconds, 'peak_rss_mb': peak_rss_mb()})
+    except Exception as e:
+        connection.send({'error': f"{type(e).__name__}: {e}"})
+
+
+def run_stage(stage_name, workspace, workers):
+    """
+    Time a stage in its own process, so that peak memory is measured per stage.
+
+    Returns:
+    - dict: 'seconds' and 'peak_rss_mb', or 'error'.
+    """
+    context = multiprocessing.get_context('spawn')
+    receiver, sender = context.Pipe(duplex=False)
+    process = context.Process(target=stage_process, args=(stage_name, workspace, workers, sender))
+    process.start()
+    sender.close()
+    try:
+        result = receiver.recv()
+    except EOFError:
+        result = {'error': 'stage process exited without a result'}
+    process.join()
+    if process.exitcode and 'error' not in result:
+        result = {'error': f'stage process exited with code {process.exitcode}'}
+    return result
+
+
+def prepare_workspace(workspace, dataset, counts):
+    """
+    Copy a generated dataset and the scripts into a new workspace.
+    """
+    shutil.copytree(dataset, workspace, dirs_exist_ok=True)
+    for script in glob.glob(os.path.join(os.path.dirname(os.path.abspath(__file__)), '*.py')):
+        shutil.copy2(script, workspace)
+    with open(os.path.join(workspace, COUNTS_FILE), 'w', encoding='utf-8') as counts_file:
+        json.dump(counts, counts_file)
+
+
+def run_benchmark(workspace, counts, stages, workers=1):
+    """
+    Run the stages in order in a workspace.
+
+    Args:
+    - workspace (str): Folder with the scripts and the dataset.
+    - counts (Dict[str, int]): Records per folder of the dataset.
+    - stages (List[str]): Stages to run, in order.
+    - workers (int): Worker processes for the stages that support them.
+
+    Returns:
+    - Dict[str, dict]: Results of each stage, with 'records' and 'records_per_second'.
+    """
+    results = {}
+    for stage_name in stages:
+        result = run_stage(stage_name, workspace, workers)
+        if stage_name == 'train':
+            result['records'] = counts['dataGPS']
+        elif stage_name == 'inference':
+            result['records'] = counts['dataTestEnd']
+        else:
+            result['records'] = counts['dataGPS'] + counts['dataTest']
+        if 'seconds' in result:
+            result['records_per_second'] = result['records'] / result['seconds'] if result['seconds'] > 0 else None
+        results[stage_name] = result
+        if 'error' in result:
+            break
+    return results
+
+
+def compare_to_baseline(results, baseline, max_slowdown=DEFAULT_MAX_SLOWDOWN):
+    """
+    Compare stage times and peak memory with a baseline.
+
+    Returns:
+    - List[str]: Stages slower than the baseline by more than max_slowdown.
+    """
+    regressions = []
+    for stage_name, result in results.items():
+        reference = baseline.get('stages', {}).get(stage_name)
+        if not reference or 'seconds' not in result or 'seconds' not in reference:
+            continue
+        ratio = result['seconds'] / reference['seconds'] if reference['seconds'] > 0 else float('inf')
+        result['baseline_seconds'] = reference['seconds']
+        result['time_ratio'] = ratio
+        result['baseline_peak_rss_mb'] = reference.get('peak_rss_mb')
+        if ratio > 1 + max_slowdown:
+            regressions.append(stage_name)
+    return regressions
+
+
+def format_report(results, regressions):
+    """
+    Stage results as a text table.
+    """
+    lines = [f"{'stage':<10} {'seconds':>9} {'records/s':>12} {'peak RSS MB':>12} {'vs baseline':>12}"]
+    for stage_name, result in results.items():
+        if 'error' in result:
+            lines.append(f"{stage_name:<10} failed: {result['error']}")
+            continue
+        rate = result.get('records_per_second')
+        comparison = ''
+        if 'time_ratio' in result:
+            comparison = f"{result['time_ratio']:.2f}x"
+            if stage_name in regressions:
+                comparison += ' SLOWER'
+        lines.append(f"{stage_name:<10} {result['seconds']:>9.3f} {rate or 0:>12.0f} "
+                     f"{result['peak_rss_mb']:>12.1f} {comparison:>12}")
+    return '\n'.join(lines)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Time every stage of main.py, the training and the batch inference on a synthetic dataset.")
+    parser.add_argument('--days', type=int, default=2, help="Days of history to generate (default: 2).")
+    parser.add_argument('--vehicles', type=int, default=10, help="Buses per line (default: 10).")
+    parser.add_argument('--interval', type=float, default=60.0, help="Seconds between pings of a bus (default: 60).")
+    parser.add_argument('--queries', type=int, default=10000, help="Prediction queries (default: 10000).")
+    parser.add_argument('--seed', type=int, default=0, help="Random seed of the dataset (default: 0).")
+    parser.add_argument('--workers', type=int, default=1, help="Worker processes for the stages (default: 1).")
+    parser.add_argument('--fused', action='store_true',
+                        help="Time the single-pass pipeline instead of the stage-by-stage processing.")
+    parser.add_argument('--stages', nargs='+', choices=list(STAGES),
+                        help="Run only these stages (in the given order); earlier stages must have been run before.")
+    parser.add_argument('--workspace',
+                        help="Folder for the run, kept at the end; must be new or empty, unless it holds a previous "
+                             "run to continue with --stages (default: a temporary folder, removed at the end).")
+    parser.add_argument('--baseline', default=BASELINE_FILE,
+                        help=f"Baseline results to compare with (default: {BASELINE_FILE}, if it exists).")
+    parser.add_argument('--save-baseline', action='store_true', help="Save the results as the new baseline.")
+    parser.add_argument('--max-slowdown', type=float, default=DEFAULT_MAX_SLOWDOWN,
+                        help="Relative slowdown reported as a regression (default: %(default)s).")
+    parser.add_argument('--output', help="Also write the results as JSON to this file.")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    stages = args.stages or (FUSED_STAGES if args.fused else PIPELINE_STAGES) + MODEL_STAGES
+
+    temp_dir = tempfile.mkdtemp(prefix='benchmark-')
+    workspace = args.workspace or os.path.join(temp_dir, 'workspace')
+    counts_path = os.path.join(workspace, COUNTS_FILE)
+    try:
+        if args.stages and os.path.exists(counts_path):
+            with open(counts_path, 'r', encoding='utf-8') as counts_file:
+                counts = json.load(counts_file)
+        elif os.path.isdir(workspace) and os.listdir(workspace):
+            print(f"Workspace {workspace} is not empty")
+            return 2
+        else:
+            dataset = os.path.join(temp_dir, 'dataset')
+            start = time.perf_counter()
+            counts = generate_dataset(dataset, days=args.days, vehicles_per_line=args.vehicles,
+                                      interval_s=args.interval, queries=args.queries, seed=args.seed)
+            print(f"Generated {counts['dataGPS']} history records, {counts['dataTest']} test records and "
+                  f"{counts['dataTestEnd']} queries in {time.perf_counter() - start:.1f} s")
+            prepare_workspace(workspace, dataset, counts)
+
+        results = run_benchmark(workspace, counts, stages, workers=args.workers)
+    finally:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+
+    report = {
+        'config': {'days': args.days, 'vehicles': args.vehicles, 'interval': args.interval, 'queries': args.queries,
+                   'seed': args.seed, 'workers': args.workers, 'fused': args.fused},
+        'machine': {'python': platform.python_version(), 'platform': platform.platform(),
+                    'cpus': os.cpu_count()},
+        'stages': results,
+    }
+
+    regressions = []
+    if args.baseline and os.path.exists(args.baseline) and not args.save_baseline:
+        with open(args.baseline, 'r', encoding='utf-8') as baseline_file:
+            baseline = json.load(baseline_file)
+        if baseline.get('config') != report['config']:
+            print(f"Warning: baseline {args.baseline} was run with {baseline.get('config')}")
+        regressions = compare_to_baseline(results, baseline, args.max_slowdown)
+
+    print(format_report(results, regressions))
+
+    for path in filter(None, [args.output, args.baseline if args.save_baseline else None]):
+        with open(path, 'w', encoding='utf-8') as output_file:
+            json.dump(report, output_file, indent=4)
+        print(f"Results saved to {path}")
+
+    failed = any('error' in result for result in results.values())
+    if regressions:
+        print(f"Slower than the baseline by more than {args.max_slowdown:.0%}: {', '.join(regressions)}")
+    return 1 if failed or regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
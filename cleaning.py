@@ -0,0 +1,426 @@
+import os
+import json
+import shutil
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from features import FEATURE_KEYS
+from records import RecordBatch, RECORD_DTYPE
+
+# Mean earth radius in metres
+EARTH_RADIUS_M = 6371008.8
+
+# Neighbourhood radius in metres, about the 0.001 degree of latitude used when clustering raw degrees
+DEFAULT_EPS_METERS = 111.0
+
+DEFAULT_MIN_SAMPLES = 5
+
+# Maximum number of point pairs compared at once, bounding the memory used per group
+MAX_BLOCK_PAIRS = 1 << 20
+
+# File of a group's cleaning state holding its row count, inputs and route
+STATE_META_FILE = 'meta.json'
+
+
+def project_to_meters(coordinates, reference_latitude=None):
+    """
+    Project latitude/longitude onto a local plane in metres (equirectangular).
+
+    Args:
+    - coordinates (np.ndarray): (n, 2) array of latitude and longitude in degrees.
+    - reference_latitude (float): Latitude of the projection in radians; defaults to the mean latitude.
+
+    Returns:
+    - np.ndarray: (n, 2) array of x (east) and y (north) in metres.
+    """
+    latitude = np.radians(coordinates[:, 0])
+    longitude = np.radians(coordinates[:, 1])
+    if reference_latitude is None:
+        reference_latitude = np.mean(latitude) if len(latitude) else 0.0
+    cos_lat0 = np.cos(reference_latitude)
+    return np.column_stack((EARTH_RADIUS_M * longitude * cos_lat0, EARTH_RADIUS_M * latitude))
+
+
+def haversine_meters(latitude1, longitude1, latitude2, longitude2):
+    """
+    Great-circle distance in metres between points given in degrees (arrays broadcast).
+    """
+    latitude1, longitude1, latitude2, longitude2 = (np.radians(np.asarray(value, dtype=np.float64))
+                                                    for value in (latitude1, longitude1, latitude2, longitude2))
+    a = (np.sin((latitude2 - latitude1) / 2) ** 2
+         + np.cos(latitude1) * np.cos(latitude2) * np.sin((longitude2 - longitude1) / 2) ** 2)
+    return 2 * EARTH_RADIUS_M * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+
+
+def _iter_blocks(a, b, max_block_pairs):
+    """
+    Yield (start, squared distance block) pairs between rows of a and all of b.
+    """
+    rows = max(1, max_block_pairs // max(1, len(b)))
+    for start in range(0, len(a), rows):
+        diff = a[start:start + rows, None, :] - b[None, :, :]
+        yield start, np.einsum('ijk,ijk->ij', diff, diff)
+
+
+def grid_dbscan(points, eps, min_samples, max_block_pairs=MAX_BLOCK_PAIRS):
+    """
+    DBSCAN over planar points using a uniform grid as spatial index.
+
+    Cells have side eps/sqrt(2), so all points of a cell are neighbours and
+    only the 5x5 surrounding cells need to be searched. Distances are computed
+    cell pair by cell pair in blocks of at most max_block_pairs, which bounds
+    memory regardless of how dense a group is. Core points and cluster
+    connectivity follow DBSCAN; a border point joins the cluster of its
+    nearest core point.
+
+    Args:
+    - points (np.ndarray): (n, 2) planar coordinates.
+    - eps (float): Neighbourhood radius, in the units of points.
+    - min_samples (int): Neighbours (including the point itself) needed for a core point.
+    - max_block_pairs (int): Maximum number of distances held in memory at once.
+
+    Returns:
+    - np.ndarray: Cluster label of each point, -1 for noise.
+    """
+    n = len(points)
+    labels = np.full(n, -1, dtype=np.int64)
+    if n == 0:
+        return labels
+
+    eps2 = eps * eps
+    cells = np.floor(points / (eps / np.sqrt(2.0))).astype(np.int64)
+    order = np.lexsort((cells[:, 1], cells[:, 0]))
+    points = points[order]
+    unique_cells, starts, counts = np.unique(cells[order], axis=0, return_index=True, return_counts=True)
+    slices = [slice(start, start + count) for start, count in zip(starts, counts)]
+    cell_index = {cell: i for i, cell in enumerate(map(tuple, unique_cells.tolist()))}
+    neighbours = [[cell_index[(cx + dx, cy + dy)]
+                   for dx in range(-2, 3) for dy in range(-2, 3) if (cx + dx, cy + dy) in cell_index]
+                  for cx, cy in unique_cells.tolist()]
+
+    # Core points: dense cells are core as a whole, the others count their neighbours
+    core = np.zeros(n, dtype=bool)
+    for i, cell_slice in enumerate(slices):
+        if counts[i] >= min_samples:
+            core[cell_slice] = True
+            continue
+        neighbour_count = np.zeros(counts[i], dtype=np.int64)
+        for j in neighbours[i]:
+            for start, d2 in _iter_blocks(points[cell_slice], points[slices[j]], max_block_pairs):
+                neighbour_count[start:start + len(d2)] += np.count_nonzero(d2 <= eps2, axis=1)
+        core[cell_slice] = neighbour_count >= min_samples
+
+    # Clusters: core points of a cell are connected; join cells with core points within eps
+    parent = list(range(len(slices)))
+
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    core_points = [points[cell_slice][core[cell_slice]] for cell_slice in slices]
+    for i in range(len(slices)):
+        if not len(core_points[i]):
+            continue
+        for j in neighbours[i]:
+            if j <= i or not len(core_points[j]) or find(i) == find(j):
+                continue
+            if any(np.any(d2 <= eps2) for _, d2 in _iter_blocks(core_points[i], core_points[j], max_block_pairs)):
+                parent[find(j)] = find(i)
+
+    sorted_labels = np.full(n, -1, dtype=np.int64)
+    roots = {}
+    for i, cell_slice in enumerate(slices):
+        if len(core_points[i]):
+            label = roots.setdefault(find(i), len(roots))
+            cell_labels = sorted_labels[cell_slice]
+            cell_labels[core[cell_slice]] = label
+            sorted_labels[cell_slice] = cell_labels
+
+    # Border points: nearest core point within eps
+    for i, cell_slice in enumerate(slices):
+        border = np.flatnonzero(~core[cell_slice]) + cell_slice.start
+        if not len(border):
+            continue
+        best_d2 = np.full(len(border), np.inf)
+        best_label = np.full(len(border), -1, dtype=np.int64)
+        for j in neighbours[i]:
+            if not len(core_points[j]):
+                continue
+            label = roots[find(j)]
+            for start, d2 in _iter_blocks(points[border], core_points[j], max_block_pairs):
+                nearest = d2.min(axis=1)
+                better = (nearest <= eps2) & (nearest < best_d2[start:start + len(d2)])
+                best_d2[start:start + len(d2)][better] = nearest[better]
+                best_label[start:start + len(d2)][better] = label
+        sorted_labels[border] = best_label
+
+    labels[order] = sorted_labels
+    return labels
+
+
+def find_main_route(coordinates, eps_meters=DEFAULT_EPS_METERS, min_samples=DEFAULT_MIN_SAMPLES):
+    """
+    Find the main route as the largest density-based cluster of the points.
+
+    Args:
+    - coordinates (np.ndarray): (n, 2) array of latitude and longitude.
+    - eps_meters (float): The maximum distance, in metres, between two samples for them to be considered as in the same neighborhood.
+    - min_samples (int): The number of samples in a neighborhood for a point to be considered as a core point.
+
+    Returns:
+    - np.ndarray: Boolean mask of the points in the main cluster.
+    """
+    main_route = np.zeros(len(coordinates), dtype=bool)
+    valid = np.all(np.isfinite(coordinates), axis=1)
+    labels = grid_dbscan(project_to_meters(coordinates[valid]), eps_meters, min_samples)
+    if not np.any(labels >= 0):
+        return main_route  # Every point is noise, there is no main cluster
+    main_cluster = np.argmax(np.bincount(labels[labels >= 0]))
+
+    main_route[valid] = labels == main_cluster
+    return main_route
+
+
+def remove_outliers(coordinates, main_route):
+    """
+    Remove outliers from the data based on the main route.
+
+    A point is kept if its coordinate pair appears in the main route.
+
+    Args:
+    - coordinates (np.ndarray): (n, 2) array of latitude and longitude.
+    - main_route (np.ndarray): Boolean mask of the main route points.
+
+    Returns:
+    - np.ndarray: Boolean mask of the points to keep.
+    """
+    pairs = coordinates[:, 0] + 1j * coordinates[:, 1]
+    return np.isin(pairs, pairs[main_route])
+
+
+def group_by_vehicle(batch):
+    """
+    Group records by 'ordem' and 'linha'.
+
+    Args:
+    - batch (RecordBatch): GPS records.
+
+    Returns:
+    - Dict[Tuple[str, str], np.ndarray]: Record positions of each (ordem, linha) pair, in input order.
+    """
+    return batch.group_indices('ordem', 'linha')
+
+
+def clean_groups(batch, grouped_data, workers=1, routes=None):
+    """
+    Remove outliers from every (ordem, linha) group, optionally over a process pool.
+
+    Groups whose line has a route keep the points near it (routes.Route.on_route);
+    the others keep their main cluster (find_main_route).
+
+    Args:
+    - batch (RecordBatch): GPS records.
+    - grouped_data (Dict[Tuple[str, str], np.ndarray]): Record positions grouped by group_by_vehicle.
+    - workers (int): Number of worker processes for the clustering; 1 runs serially in this process.
+    - routes (Dict[str, routes.Route]): Route of each line, or None to cluster every group.
+
+    Returns:
+    - Iterator[Tuple[Tuple[str, str], np.ndarray]]: Each key with the positions of its cleaned records.
+    """
+    routes = routes or {}
+    coordinates = {key: np.column_stack((batch['latitude'][index], batch['longitude'][index]))
+                   for key, index in grouped_data.items()}
+
+    for key, index in grouped_data.items():
+        if key[1] in routes:
+            yield key, index[routes[key[1]].on_route(coordinates[key])]
+
+    keys = [key for key in grouped_data if key[1] not in routes]
+    if not keys:
+        return
+    if workers <= 1:
+        main_routes = map(find_main_route, (coordinates[key] for key in keys))
+        for key, main_route in zip(keys, main_routes):
+            yield key, grouped_data[key][remove_outliers(coordinates[key], main_route)]
+        return
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        main_routes = executor.map(find_main_route, [coordinates[key] for key in keys],
+                                   chunksize=max(1, len(keys) // (workers * 4)))
+        for key, main_route in zip(keys, main_routes):
+            yield key, grouped_data[key][remove_outliers(coordinates[key], main_route)]
+
+
+def save_cleaned_groups(folder_path, batch, cleaned_groups):
+    """
+    Save each cleaned group to '<ordem>_<linha>_cleaned.json' in the given folder.
+
+    Args:
+    - folder_path (str): Destination folder.
+    - batch (RecordBatch): GPS records.
+    - cleaned_groups (Iterable[Tuple[Tuple[str, str], np.ndarray]]): Output of clean_groups.
+    """
+    for key, index in cleaned_groups:
+        file_name = f"{key[0]}_{key[1]}_cleaned.json"
+        file_path = os.path.join(folder_path, file_name)
+        try:
+            with open(file_path, 'w', encoding='utf-8') as json_file:
+                json.dump(batch.take(index).to_dicts(exclude=FEATURE_KEYS), json_file, ensure_ascii=False, indent=4)
+            print(f"File {file_path} successfully saved.")
+        except Exception as e:
+            print(f"Error saving file {file_path}: {e}")
+
+
+def append_cleaned_group(folder_path, key, batch):
+    """
+    Append records to the end of a group's '<ordem>_<linha>_cleaned.json', as save_cleaned_groups would write them.
+
+    Args:
+    - folder_path (str): Destination folder.
+    - key (Tuple[str, str]): The group's ordem and linha.
+    - batch (RecordBatch): Cleaned records to append.
+
+    Returns:
+    - bool: False if the file does not end like a non-empty array written by save_cleaned_groups,
+      in which case it is left untouched and must be rewritten.
+    """
+    file_path = os.path.join(folder_path, f"{key[0]}_{key[1]}_cleaned.json")
+    if not len(batch):
+        return os.path.exists(file_path)
+    try:
+        with open(file_path, 'r+b') as json_file:
+            json_file.seek(0, os.SEEK_END)
+            if json_file.tell() < 4:
+                return False
+            json_file.seek(-2, os.SEEK_END)
+            if json_file.read(2) != b"\n]":
+                return False
+            text = json.dumps(batch.to_dicts(exclude=FEATURE_KEYS), ensure_ascii=False, indent=4)
+            json_file.seek(-2, os.SEEK_END)
+            json_file.write(("," + text[1:]).encode('utf-8'))
+    except FileNotFoundError:
+        return False
+    print(f"File {file_path} successfully updated.")
+    return True
+
+
+def remove_cleaned_group(folder_path, key):
+    """
+    Remove a group's '<ordem>_<linha>_cleaned.json', once none of its records are left.
+    """
+    file_path = os.path.join(folder_path, f"{key[0]}_{key[1]}_cleaned.json")
+    if os.path.exists(file_path):
+        os.remove(file_path)
+        print(f"File {file_path} removed.")
+
+
+def group_state_keys(state_path, linhas):
+    """
+    (ordem, linha) groups of the given lines that have a saved cleaning state.
+    """
+    keys = []
+    for linha in linhas:
+        line_path = os.path.join(state_path, f"linha={linha}")
+        if os.path.isdir(line_path):
+            keys.extend((ordem, linha) for ordem in sorted(os.listdir(line_path)))
+    return keys
+
+
+class GroupState:
+    """
+    Saved cleaning state of an (ordem, linha) group, so that a run only handles the group's new records.
+
+    The group's enriched records, the input each came from and whether outlier
+    removal kept it are raw binary files that new records are appended to.
+    'meta.json', replaced last, holds the number of valid rows, the input names
+    and the digest of the route the records were checked against ('' when the
+    group was clustered); rows past that count, left by an interrupted run,
+    are ignored.
+    """
+
+    def __init__(self, state_path, key):
+        self.key = key
+        self.path = os.path.join(state_path, f"linha={key[1]}", str(key[0]))
+        meta = {'rows': 0, 'inputs': [], 'route': ''}
+        meta_path = os.path.join(self.path, STATE_META_FILE)
+        if os.path.exists(meta_path):
+            with open(meta_path, 'r', encoding='utf-8') as meta_file:
+                meta = json.load(meta_file)
+        self.rows = meta['rows']
+        self.inputs = meta['inputs']
+        self.route = meta['route']
+
+    def _read(self, name, dtype):
+        return np.fromfile(os.path.join(self.path, name), dtype=dtype, count=self.rows)
+
+    def input_names(self):
+        """
+        Input each saved record came from, as an object array.
+        """
+        if not self.rows:
+            return np.empty(0, dtype=object)
+        return np.array(self.inputs, dtype=object)[self._read('inputs.bin', np.int32)]
+
+    def load(self):
+        """
+        Load the saved records.
+
+        Returns:
+        - Tuple[RecordBatch, np.ndarray, np.ndarray]: The records, the input each came from and the mask
+          of the records kept by outlier removal.
+        """
+        if not self.rows:
+            return RecordBatch.empty(), np.empty(0, dtype=object), np.empty(0, dtype=bool)
+        categories = {'ordem': [self.key[0]], 'linha': [self.key[1]]}
+        return (RecordBatch(self._read('records.bin', RECORD_DTYPE), categories), self.input_names(),
+                self._read('kept.bin', bool))
+
+    def _write(self, mode, batch, inputs, kept, route):
+        os.makedirs(self.path, exist_ok=True)
+        records = batch.data.copy()
+        records['ordem'] = np.where(records['ordem'] >= 0, 0, -1)
+        records['linha'] = 0
+        names = list(self.inputs)
+        lookup = {name: code for code, name in enumerate(names)}
+        codes = np.empty(len(inputs), dtype=np.int32)
+        for position, name in enumerate(inputs):
+            codes[position] = lookup.setdefault(name, len(names))
+            if codes[position] == len(names):
+                names.append(name)
+
+        for name, values in (('records.bin', records), ('inputs.bin', codes), ('kept.bin', np.asarray(kept, dtype=bool))):
+            with open(os.path.join(self.path, name), mode) as state_file:
+                state_file.truncate(self.rows * values.itemsize)
+                state_file.seek(0, os.SEEK_END)
+                values.tofile(state_file)
+
+        self.rows += len(batch)
+        self.inputs = names
+        self.route = route
+        temp_path = os.path.join(self.path, STATE_META_FILE + ".tmp")
+        with open(temp_path, 'w', encoding='utf-8') as meta_file:
+            json.dump({'rows': self.rows, 'inputs': self.inputs, 'route': self.route}, meta_file, ensure_ascii=False)
+        os.replace(temp_path, os.path.join(self.path, STATE_META_FILE))
+
+    def append(self, batch, inputs, kept):
+        """
+        Append new records of the group, checked against the same route as the saved ones.
+        """
+        self._write('a+b', batch, inputs, kept, self.route)
+
+    def replace(self, batch, inputs, kept, route):
+        """
+        Replace the saved records of the group; an empty batch removes the state.
+
+        Args:
+        - batch (RecordBatch): The group's enriched records, all with its ordem and linha.
+        - inputs (np.ndarray): Input each record came from.
+        - kept (np.ndarray): Boolean mask of the records kept by outlier removal.
+        - route (str): Digest of the route the records were checked against, '' when clustered.
+        """
+        if os.path.isdir(self.path):
+            shutil.rmtree(self.path)
+        self.rows, self.inputs, self.route = 0, [], route
+        if len(batch):
+            self._write('wb', batch, inputs, kept, route)
@@ -0,0 +1,184 @@
+import os
+import hashlib
+import numpy as np
+from store import local_days
+
+# Constants of the splitmix64 finalizer, used to spread timestamps over 64 bits
+MIX_MULTIPLIERS = (np.uint64(0xBF58476D1CE4E5B9), np.uint64(0x94D049BB133111EB))
+
+
+def mix64(values):
+    """
+    splitmix64 finalizer: a bijection of uint64 values with good avalanche.
+    """
+    values = np.asarray(values, dtype=np.uint64)
+    with np.errstate(over='ignore'):
+        values = (values ^ (values >> np.uint64(30))) * MIX_MULTIPLIERS[0]
+        values = (values ^ (values >> np.uint64(27))) * MIX_MULTIPLIERS[1]
+    return values ^ (values >> np.uint64(31))
+
+
+def ordem_hashes(ordens):
+    """
+    64-bit hash of each bus identifier.
+    """
+    return np.array([int.from_bytes(hashlib.blake2b(str(ordem).encode('utf-8'), digest_size=8).digest(), 'little')
+                     for ordem in ordens], dtype=np.uint64)
+
+
+def ping_keys(ordem_hash, datahora):
+    """
+    64-bit key of each (ordem, datahora) pair.
+
+    Two different pairs share a key with probability about 2^-64, so a day of
+    n pings has a false duplicate with probability below n^2 / 2^65.
+    """
+    return ordem_hash ^ mix64(np.asarray(datahora, dtype=np.int64).view(np.uint64))
+
+
+class PingDeduplicator:
+    """
+    Remember the pings seen so far, by (ordem, datahora), to drop the ones the feed sends again.
+
+    Keys are kept per local day as sorted uint64 arrays (8 bytes per ping), so
+    checking and merging a file costs a sort of the file plus one pass over its days.
+    'removed' counts the pings dropped so far.
+    """
+
+    def __init__(self):
+        self.days = {}
+        self.removed = 0
+
+    def first_seen(self, keys, days):
+        """
+        Flag the pings not seen before, within this call or any previous one, and remember them.
+
+        Args:
+        - keys (np.ndarray): ping_keys of the pings, in input order.
+        - days (np.ndarray): Local day of each ping.
+
+        Returns:
+        - np.ndarray: Boolean mask, True for the first occurrence of each key.
+        """
+        keep = np.zeros(len(keys), dtype=bool)
+        day_codes, day_values = _factorize(days)
+        for code, day in enumerate(day_values):
+            positions = np.flatnonzero(day_codes == code)
+            unique_keys, first = np.unique(keys[positions], return_index=True)
+            seen = self.days.get(day, np.empty(0, dtype=np.uint64))
+            new = ~np.isin(unique_keys, seen, assume_unique=True)
+            keep[positions[first[new]]] = True
+            self.days[day] = np.union1d(seen, unique_keys[new])
+        return keep
+
+    def remember_keys(self, day, keys):
+        """
+        Remember keys saved by an earlier run (see batch_day_keys) for one local day.
+        """
+        self.days[day] = np.union1d(self.days.get(day, np.empty(0, dtype=np.uint64)), keys)
+
+    def filter_batch(self, batch):
+        """
+        Drop the pings of a RecordBatch already seen. Pings without 'ordem' or 'datahora' are kept.
+        """
+        valid = (batch['ordem'] >= 0) & (batch['datahora'] >= 0)
+        keep = ~valid
+        keep[valid] = self.first_seen(*self._batch_keys(batch, valid))
+        self.removed += int(len(keep) - keep.sum())
+        return batch if keep.all() else batch.take(keep)
+
+    def filter_records(self, records):
+        """
+        Drop the feed records (dictionaries) already seen. Records without a usable 'ordem'
+        or 'datahora' are kept.
+        """
+        ordens, datahora, positions = [], [], []
+        for position, record in enumerate(records):
+            ordem = record.get('ordem')
+            try:
+                timestamp = int(record.get('datahora'))
+            except (TypeError, ValueError):
+                continue
+            if ordem in (None, '') or timestamp < 0:
+                continue
+            ordens.append(ordem)
+            datahora.append(timestamp)
+            positions.append(position)
+
+        keep = np.ones(len(records), dtype=bool)
+        if positions:
+            codes, uniques = _factorize(np.array(ordens, dtype=object))
+            datahora = np.array(datahora, dtype=np.int64)
+            keep[positions] = self.first_seen(ping_keys(ordem_hashes(uniques)[codes], datahora), local_days(datahora))
+        self.removed += int(len(keep) - keep.sum())
+        return records if keep.all() else [record for record, kept in zip(records, keep) if kept]
+
+    @staticmethod
+    def _batch_keys(batch, valid):
+        codes = batch['ordem'][valid]
+        datahora = batch['datahora'][valid]
+        return ping_keys(ordem_hashes(batch.categories['ordem'])[codes], datahora), local_days(datahora)
+
+
+def batch_day_keys(batch):
+    """
+    Sorted, unique ping keys of a RecordBatch, per local day. Pings without 'ordem' or 'datahora' are skipped.
+
+    Returns:
+    - Dict[str, np.ndarray]: uint64 keys of each day.
+    """
+    valid = (batch['ordem'] >= 0) & (batch['datahora'] >= 0)
+    keys, days = PingDeduplicator._batch_keys(batch, valid)
+    day_codes, day_values = _factorize(days)
+    return {day: np.unique(keys[day_codes == code]) for code, day in enumerate(day_values)}
+
+
+def day_keys_path(state_path, day):
+    return os.path.join(state_path, f"keys-{day}.npz")
+
+
+def load_day_keys(state_path, day):
+    """
+    Load the ping keys saved for a local day, per input.
+
+    Args:
+    - state_path (str): Folder of the saved keys.
+    - day (str): Local day ('YYYY-MM-DD').
+
+    Returns:
+    - Dict[str, np.ndarray]: Keys of each input that had pings on that day.
+    """
+    file_path = day_keys_path(state_path, day)
+    if not os.path.exists(file_path):
+        return {}
+    with np.load(file_path) as keys_file:
+        inputs, offsets, keys = keys_file['inputs'], keys_file['offsets'], keys_file['keys']
+    return {str(name): keys[offsets[i]:offsets[i + 1]] for i, name in enumerate(inputs)}
+
+
+def save_day_keys(state_path, day, keys_by_input):
+    """
+    Atomically replace the ping keys saved for a local day; an empty mapping removes them.
+
+    Args:
+    - state_path (str): Folder of the saved keys.
+    - day (str): Local day ('YYYY-MM-DD').
+    - keys_by_input (Dict[str, np.ndarray]): Keys of each input that has pings on that day.
+    """
+    file_path = day_keys_path(state_path, day)
+    if not keys_by_input:
+        if os.path.exists(file_path):
+            os.remove(file_path)
+        return
+    os.makedirs(state_path, exist_ok=True)
+    names = sorted(keys_by_input)
+    offsets = np.cumsum([0] + [len(keys_by_input[name]) for name in names])
+    temp_path = file_path + ".tmp.npz"
+    np.savez(temp_path, inputs=np.array(names, dtype=str), offsets=offsets,
+             keys=np.concatenate([keys_by_input[name] for name in names]).astype(np.uint64))
+    os.replace(temp_path, file_path)
+
+
+def _factorize(values):
+    uniques, codes = np.unique(np.asarray(values, dtype=object).astype(str), return_inverse=True)
+    return codes, uniques.tolist()
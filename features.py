@@ -0,0 +1,133 @@
+import numpy as np
+import pandas as pd
+from localcalendar import calendar_features
+from records import parse_coordinates
+
+# Keys added to each record by add_features
+FEATURE_KEYS = ('velocidadeReal', 'diaSemana', 'feriado')
+
+# Mean earth radius, the same one geopy's great_circle uses
+EARTH_RADIUS_KM = 6371.009
+
+
+def haversine_km(lat1, lon1, lat2, lon2):
+    """
+    Great-circle distance in km between arrays of points given in degrees.
+    """
+    lat1, lon1, lat2, lon2 = map(np.radians, (lat1, lon1, lat2, lon2))
+    a = np.sin((lat2 - lat1) / 2.0) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2.0) ** 2
+    return 2.0 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.clip(a, 0.0, 1.0)))
+
+
+def trajectory_velocities(latitude, longitude, datahora, ordem):
+    """
+    Compute the real velocity of every GPS ping from the previous ping of the same bus.
+
+    Pings are ordered by ('ordem', 'datahora') with a stable sort, so each
+    velocity is measured against the same vehicle's previous position. The
+    first ping of each bus, and pings with a zero or negative time delta or an
+    invalid coordinate, get 0.0.
+
+    Args:
+    - latitude (np.ndarray): Latitudes in degrees.
+    - longitude (np.ndarray): Longitudes in degrees.
+    - datahora (np.ndarray): Timestamps in milliseconds.
+    - ordem (np.ndarray): Vehicle identifiers.
+
+    Returns:
+    - np.ndarray: Velocities in km/h, aligned with the input.
+    """
+    n = len(datahora)
+    velocities = np.zeros(n, dtype=np.float64)
+    if n < 2:
+        return velocities
+
+    ordem_codes = pd.factorize(np.asarray(ordem))[0]
+    datahora = np.asarray(datahora, dtype=np.int64)
+    order = np.lexsort((datahora, ordem_codes))
+
+    lat = np.asarray(latitude, dtype=np.float64)[order]
+    lon = np.asarray(longitude, dtype=np.float64)[order]
+    t = datahora[order]
+    codes = ordem_codes[order]
+
+    distance_km = haversine_km(lat[:-1], lon[:-1], lat[1:], lon[1:])
+    time_diff_seconds = (t[1:] - t[:-1]) / 1000.0
+    valid = (codes[1:] == codes[:-1]) & (time_diff_seconds > 0) & np.isfinite(distance_km)
+
+    sorted_velocities = np.zeros(n, dtype=np.float64)
+    np.divide(distance_km * 3600.0, time_diff_seconds, out=sorted_velocities[1:], where=valid)
+    velocities[order] = sorted_velocities
+    return velocities
+
+
+def compute_features(latitude, longitude, datahora, ordem):
+    """
+    Compute the added features of a set of records.
+
+    Args:
+    - latitude (np.ndarray): Latitudes in degrees.
+    - longitude (np.ndarray): Longitudes in degrees.
+    - datahora (np.ndarray): Timestamps in milliseconds.
+    - ordem (np.ndarray): Vehicle identifiers (or their codes).
+
+    Returns:
+    - Tuple[np.ndarray, np.ndarray, np.ndarray]: Real velocity in km/h from the previous ping
+      of the same 'ordem', local weekday and holiday flag.
+    """
+    velocities = trajectory_velocities(latitude, longitude, datahora, ordem)
+
+    # Local weekday and holiday flag, looked up in the calendar table
+    dia_semana, feriado = calendar_features(datahora)
+    return velocities, dia_semana, feriado
+
+
+def add_batch_features(batch):
+    """
+    Fill the feature fields (velocidadeReal, diaSemana, feriado) of a RecordBatch, in place.
+
+    Args:
+    - batch (RecordBatch): Records sorted by 'linha' and 'datahora'.
+
+    Returns:
+    - RecordBatch: The same batch, for chaining.
+    """
+    if not len(batch):
+        return batch
+    velocities, dia_semana, feriado = compute_features(batch['latitude'], batch['longitude'], batch['datahora'],
+                                                       batch['ordem'])
+    batch['velocidadeReal'][:] = velocities
+    batch['diaSemana'][:] = dia_semana
+    batch['feriado'][:] = feriado
+    return batch
+
+
+def add_features(data):
+    """
+    Add new features (real velocity, day of week, holiday indicator) to each record, in place.
+
+    The real velocity is measured from the previous ping of the same 'ordem';
+    the day of week and holiday indicator refer to the local (America/Sao_Paulo) date.
+
+    Args:
+    - data (List[Dict]): Records sorted by 'linha' and 'datahora'.
+
+    Returns:
+    - List[Dict]: The same list, for chaining.
+    """
+    if not data:
+        return data
+
+    datahora = np.array([int(record['datahora']) for record in data], dtype=np.int64)
+    velocities, dia_semana, feriado = compute_features(parse_coordinates(record['latitude'] for record in data),
+                                                       parse_coordinates(record['longitude'] for record in data),
+                                                       datahora,
+                                                       np.array([record.get('ordem') for record in data], dtype=object))
+
+    for record, velocity_real, day_of_week, is_holiday in zip(data, velocities.tolist(), dia_semana.tolist(),
+                                                              feriado.tolist()):
+        record['velocidadeReal'] = velocity_real
+        record['diaSemana'] = day_of_week
+        record['feriado'] = "Sim" if is_holiday else "Não"
+
+    return data
@@ -0,0 +1,171 @@
+import os
+import io
+import json
+import zipfile
+
+# Size of each text chunk read from an archive member while parsing
+CHUNK_SIZE = 1 << 16
+
+_WHITESPACE = ' \t\n\r'
+
+# Characters that may follow an element of an array
+_DELIMITERS = _WHITESPACE + ',]'
+
+
+def iter_json_array(text_stream, chunk_size=CHUNK_SIZE):
+    """
+    Incrementally parse a JSON array, yielding one element at a time.
+
+    Only the element being decoded and the unread tail of the current chunk
+    are held in memory, so arbitrarily large feed dumps can be scanned.
+
+    Args:
+    - text_stream (io.TextIOBase): Text stream positioned at the start of a JSON array.
+    - chunk_size (int): Number of characters read from the stream at a time.
+
+    Returns:
+    - Iterator[Dict]: The elements of the array, in order.
+    """
+    decoder = json.JSONDecoder()
+    buffer = text_stream.read(chunk_size)
+    pos = 0
+    started = False
+    exhausted = False
+
+    while True:
+        # Skip whitespace and element separators
+        while pos < len(buffer) and (buffer[pos] in _WHITESPACE or (started and buffer[pos] == ',')):
+            pos += 1
+
+        if pos >= len(buffer):
+            chunk = text_stream.read(chunk_size)
+            if not chunk:
+                raise json.JSONDecodeError("Unexpected end of JSON array", buffer, pos)
+            buffer, pos = buffer[pos:] + chunk, 0
+            continue
+
+        if not started:
+            if buffer[pos] != '[':
+                raise json.JSONDecodeError("Expecting JSON array", buffer, pos)
+            started = True
+            pos += 1
+            continue
+
+        if buffer[pos] == ']':
+            return
+
+        try:
+            element, end = decoder.raw_decode(buffer, pos)
+        except json.JSONDecodeError:
+            # The element is split across chunks, read more and retry
+            chunk = text_stream.read(chunk_size)
+            if not chunk:
+                raise
+            buffer, pos = buffer[pos:] + chunk, 0
+            continue
+
+        # A number (or literal) is only complete once a delimiter follows it: one cut by the end of
+        # the buffer ('12' of 12345, '1.' of 1.5) is decoded again with more text
+        scalar = buffer[pos] not in '{["'
+        if scalar and not exhausted and (end == len(buffer) or buffer[end] not in _DELIMITERS):
+            chunk = text_stream.read(chunk_size)
+            if chunk:
+                buffer, pos = buffer[pos:] + chunk, 0
+                continue
+            exhausted = True
+
+        yield element
+        pos = end
+
+
+def filter_records(records, relevant_lines):
+    """
+    Lazily keep only records belonging to one of the relevant lines.
+
+    Args:
+    - records (Iterable[Dict]): GPS records.
+    - relevant_lines (Iterable[str]): Bus lines to keep.
+
+    Returns:
+    - Iterator[Dict]: Records whose 'linha' is relevant.
+    """
+    relevant_lines = set(relevant_lines)
+    for record in records:
+        if record.get('linha') in relevant_lines:
+            yield record
+
+
+def iter_zip_json_members(zip_path):
+    """
+    Iterate over the JSON members of a zip archive without extracting them.
+
+    Each yielded record iterator reads straight from the compressed member and
+    must be consumed before advancing to the next member.
+
+    Args:
+    - zip_path (str): Path to the zip archive.
+
+    Returns:
+    - Iterator[Tuple[str, Iterator[Dict]]]: Member name and its lazily parsed records.
+    """
+    with zipfile.ZipFile(zip_path, 'r') as zip_ref:
+        for member in zip_ref.infolist():
+            if member.is_dir() or not member.filename.endswith(".json"):
+                continue
+            with zip_ref.open(member) as raw:
+                text_stream = io.TextIOWrapper(raw, encoding='utf-8-sig')
+                yield member.filename, iter_json_array(text_stream)
+
+
+def member_output_path(folder_path, member_name):
+    """
+    Resolve where an archive member would have been extracted to.
+
+    Args:
+    - folder_path (str): Folder the archive lives in.
+    - member_name (str): Name of the member inside the archive.
+
+    Returns:
+    - str: Destination path inside folder_path.
+    """
+    destination = os.path.normpath(os.path.join(folder_path, member_name.lstrip('/\\')))
+    if os.path.commonpath([os.path.abspath(destination), os.path.abspath(folder_path)]) != os.path.abspath(folder_path):
+        raise ValueError(f"Archive member {member_name} escapes {folder_path}")
+    return destination
+
+
+def ingest_zip_files(folder_path, relevant_lines):
+    """
+    Stream every zip archive in the given folder, writing only relevant records.
+
+    Replaces extract_zip_files followed by filter_json_files: JSON members are
+    parsed incrementally from the archive and records of irrelevant lines are
+    dropped while streaming, so only the filtered files ever reach the disk.
+    Non-JSON members are extracted unchanged.
+
+    Args:
+    - folder_path (str): Path to the folder containing zip files.
+    - relevant_lines (Iterable[str]): Bus lines to keep.
+    """
+    relevant_lines = set(relevant_lines)
+    for file_name in sorted(os.listdir(folder_path)):
+        if not file_name.endswith(".zip"):
+            continue
+
+        zip_path = os.path.join(folder_path, file_name)
+        with zipfile.ZipFile(zip_path, 'r') as zip_ref:
+            for member in zip_ref.infolist():
+                if not member.is_dir() and not member.filename.endswith(".json"):
+                    zip_ref.extract(member, folder_path)
+
+        for member_name, records in iter_zip_json_members(zip_path):
+            try:
+                filtered_data = list(filter_records(records, relevant_lines))
+            except json.JSONDecodeError as e:
+                print(f"Error decoding JSON member {member_name} in {zip_path}: {e}")
+                continue
+
+            output_path = member_output_path(folder_path, member_name)
+            os.makedirs(os.path.dirname(output_path), exist_ok=True)
+            with open(output_path, 'w', encoding='utf-8') as json_file:
+                json.dump(filtered_data, json_file, ensure_ascii=False, indent=4)
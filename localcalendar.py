@@ -0,0 +1,139 @@
+import datetime
+import functools
+from zoneinfo import ZoneInfo
+import holidays
+import numpy as np
+from dateutil.easter import easter
+
+# Local timezone of the Rio de Janeiro bus feed
+LOCAL_TIMEZONE = 'America/Sao_Paulo'
+
+MS_PER_HOUR = 3600 * 1000
+
+# Fixed-date municipal holidays of the city of Rio de Janeiro (month, day)
+RIO_MUNICIPAL_HOLIDAYS = (
+    (1, 20),  # São Sebastião, padroeiro da cidade
+)
+
+
+def rio_municipal_holidays(year):
+    """
+    Municipal holidays of the city of Rio de Janeiro in a given year.
+
+    Args:
+    - year (int): Calendar year.
+
+    Returns:
+    - Set[datetime.date]: Holiday dates, including Corpus Christi (Easter + 60 days).
+    """
+    dates = {datetime.date(year, month, day) for month, day in RIO_MUNICIPAL_HOLIDAYS}
+    dates.add(easter(year) + datetime.timedelta(days=60))
+    return dates
+
+
+@functools.lru_cache(maxsize=None)
+def build_calendar(first_year, last_year):
+    """
+    Build the day-indexed calendar table for a range of years.
+
+    The table is computed once per process and year range; each day holds the
+    UTC timestamp of its local midnight, its weekday and whether it is a
+    national, Rio de Janeiro state or Rio municipal holiday.
+
+    Args:
+    - first_year (int): First year covered.
+    - last_year (int): Last year covered.
+
+    Returns:
+    - Tuple[np.ndarray, np.ndarray, np.ndarray]: Local day start in ms (int64), weekday
+      (int8, Monday is 0) and holiday flag (bool), one entry per day.
+    """
+    timezone = ZoneInfo(LOCAL_TIMEZONE)
+    first_day = datetime.date(first_year, 1, 1)
+    days = [first_day + datetime.timedelta(days=n)
+            for n in range((datetime.date(last_year, 12, 31) - first_day).days + 1)]
+
+    years = range(first_year, last_year + 1)
+    holiday_dates = set(holidays.Brazil(subdiv='RJ', years=years))
+    for year in years:
+        holiday_dates |= rio_municipal_holidays(year)
+
+    day_start_ms = np.array([int(datetime.datetime(d.year, d.month, d.day, tzinfo=timezone).timestamp() * 1000)
+                             for d in days], dtype=np.int64)
+    dia_semana = np.array([d.weekday() for d in days], dtype=np.int8)
+    feriado = np.array([d in holiday_dates for d in days], dtype=bool)
+    return day_start_ms, dia_semana, feriado
+
+
+def calendar_lookup(datahora):
+    """
+    Locate millisecond timestamps in the calendar table.
+
+    Args:
+    - datahora (np.ndarray): Timestamps in milliseconds since the epoch (UTC).
+
+    Returns:
+    - Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]: Local day index of each timestamp, and the
+      table's day start (ms), weekday and holiday flag (see build_calendar).
+    """
+    # The local day may still be in the previous UTC year
+    first_year = datetime.datetime.fromtimestamp(int(datahora.min()) / 1000.0 - 86400, datetime.timezone.utc).year
+    last_year = datetime.datetime.fromtimestamp(int(datahora.max()) / 1000.0, datetime.timezone.utc).year
+    day_start_ms, dia_semana, feriado = build_calendar(first_year, last_year)
+    return np.searchsorted(day_start_ms, datahora, side='right') - 1, day_start_ms, dia_semana, feriado
+
+
+def calendar_features(datahora):
+    """
+    Look up the local weekday and holiday flag of millisecond timestamps.
+
+    Args:
+    - datahora (np.ndarray): Timestamps in milliseconds since the epoch (UTC).
+
+    Returns:
+    - Tuple[np.ndarray, np.ndarray]: Weekday (Monday is 0) and holiday flag of each timestamp.
+    """
+    datahora = np.asarray(datahora, dtype=np.int64)
+    if len(datahora) == 0:
+        return np.empty(0, dtype=np.int8), np.empty(0, dtype=bool)
+
+    index, _, dia_semana, feriado = calendar_lookup(datahora)
+    return dia_semana[index], feriado[index]
+
+
+def local_time_of_day(datahora):
+    """
+    Milliseconds since local midnight of millisecond timestamps.
+
+    Args:
+    - datahora (np.ndarray): Timestamps in milliseconds since the epoch (UTC).
+
+    Returns:
+    - np.ndarray: Local time of day in milliseconds (int64).
+    """
+    datahora = np.asarray(datahora, dtype=np.int64)
+    if len(datahora) == 0:
+        return np.empty(0, dtype=np.int64)
+
+    index, day_start_ms, _, _ = calendar_lookup(datahora)
+    return datahora - day_start_ms[index]
+
+
+def local_hours(datahora):
+    """
+    Local hour of day (0-23) of millisecond timestamps.
+
+    Args:
+    - datahora (np.ndarray): Timestamps in milliseconds since the epoch (UTC).
+
+    Returns:
+    - np.ndarray: Hours (int64); float64 with NaN where a timestamp is missing (NaN).
+    """
+    datahora = np.asarray(datahora)
+    if datahora.dtype.kind == 'f':
+        valid = np.isfinite(datahora)
+        if not valid.all():
+            hours = np.full(datahora.shape, np.nan)
+            hours[valid] = local_hours(datahora[valid])
+            return hours
+    return (local_time_of_day(datahora) // MS_PER_HOUR).astype(np.int64)
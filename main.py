@@ -1,17 +1,18 @@
 import os
 import json
 import zipfile
-import pandas as pd
-from geopy.distance import geodesic
-import holidays
-from collections import defaultdict
-import datetime
-from geopy.distance import geodesic
-import holidays
-from geopy.distance import great_circle
-import numpy as np
-from sklearn.cluster import DBSCAN
-from collections import defaultdict
+import shutil
+import argparse
+import tempfile
+from ingest import ingest_zip_files, iter_json_array
+from features import add_features
+from cleaning import group_by_vehicle, clean_groups, save_cleaned_groups
+from records import RecordBatch
+from dedup import PingDeduplicator
+from routes import load_routes, update_route_catalogue
+from pipeline import group_sort_by_line, external_group_sort, run_pipeline, list_json_files
+from parallel import run_file_stage, report_errors
+from store import build_store
 
 def extract_zip_files(folder_path):
     """
@@ -23,96 +24,128 @@ def extract_zip_files(folder_path):
             with zipfile.ZipFile(zip_path, 'r') as zip_ref:
                 zip_ref.extractall(folder_path)
 
-def filter_json_files(folder_path, relevant_lines):
+def filter_json_file(file_path, relevant_lines):
+    """
+    Filter a JSON file in place, keeping only records with relevant lines.
+    
+    Args:
+    - file_path (str): Path to the JSON file.
+    - relevant_lines (Iterable[str]): Bus lines to keep.
+    """
+    with open(file_path, 'r', encoding='utf-8') as json_file:
+        data = json.load(json_file)
+    
+    filtered_data = [record for record in data if record.get('linha') in relevant_lines]
+    
+    with open(file_path, 'w', encoding='utf-8') as json_file:
+        json.dump(filtered_data, json_file, ensure_ascii=False, indent=4)
+
+def filter_json_files(folder_path, relevant_lines, workers=1):
     """
     Recursively filter JSON files in the given folder and its subdirectories,
-    keeping only records with relevant lines.
+    keeping only records with relevant lines. Outputs of the later stages are left untouched.
+    
+    Returns:
+    - List[Tuple[str, str]]: Per-file errors.
     """
-    for root, dirs, files in os.walk(folder_path):
-        for file_name in files:
-            if not file_name.endswith(".json"):
-                continue
-            
-            file_path = os.path.join(root, file_name)
-            
-            with open(file_path, 'r', encoding='utf-8') as json_file:
-                try:
-                    data = json.load(json_file)
-                except json.JSONDecodeError:
-                    continue
-                
-            filtered_data = [record for record in data if record.get('linha') in relevant_lines]
-            
-            with open(file_path, 'w', encoding='utf-8') as json_file:
-                json.dump(filtered_data, json_file, ensure_ascii=False, indent=4)
+    file_paths = list_json_files(folder_path, exclude_outputs=True)
+    _, errors = run_file_stage(filter_json_file, file_paths, set(relevant_lines), workers=workers)
+    return errors
 
-def group_sequence_json_files(folder_path):
+def write_line_groups(json_file, line_records):
     """
-    Group JSON files by 'linha' and sequence them by 'datahora', then rewrite the JSON files.
+    Write (linha, record) pairs, grouped by line, as one indented JSON array per line.
     
-    Args:
-    - folder_path (str): Path to the folder containing JSON files.
+    The output is the same as dumping each line's list of records with json.dump,
+    without holding the lists in memory.
     """
-    # Traverse the folder and subfolders to process all JSON files
-    for root, _, files in os.walk(folder_path):
-        for file_name in files:
-            if not file_name.endswith(".json"):
-                continue
-            
-            file_path = os.path.join(root, file_name)
-            output_file_path = os.path.join(root, f"{os.path.splitext(file_name)[0]}_sorted.json")
-            
-            data_by_line = defaultdict(list)
-            
+    current_line = None
+    for linha, record in line_records:
+        if linha != current_line:
+            if current_line is not None:
+                json_file.write('\n]\n')
+            json_file.write('[\n')
+            current_line = linha
+        else:
+            json_file.write(',\n')
+        json_file.write('    ' + json.dumps(record, ensure_ascii=False, indent=4).replace('\n', '\n    '))
+    if current_line is not None:
+        json_file.write('\n]\n')
+
+def dedup_json_files(folder_path):
+    """
+    Remove the pings the feed sent more than once (same 'ordem' and 'datahora') from the JSON files
+    of a folder, keeping the first occurrence in file order. Files are rewritten in place.
+    
+    The files are read one at a time, in order, since a ping can be repeated in a later file.
+    
+    Returns:
+    - Tuple[int, List[Tuple[str, str]]]: Number of records removed and per-file errors.
+    """
+    deduplicator = PingDeduplicator()
+    errors = []
+    for file_path in list_json_files(folder_path, exclude_outputs=True):
+        try:
             with open(file_path, 'r', encoding='utf-8') as json_file:
-                try:
-                    data = json.load(json_file)
-                except json.JSONDecodeError:
-                    continue
-            
-            for record in data:
-                linha = record.get('linha')
-                datahora = record.get('datahora')
-                
-                if linha and datahora:
-                    data_by_line[linha].append(record)
-            
-            # Sort records by 'datahora' within each 'linha'
-            for linha, records in data_by_line.items():
-                data_by_line[linha] = sorted(records, key=lambda x: x['datahora'])
-            
-            # Write sorted records back to a new JSON file
-            with open(output_file_path, 'w', encoding='utf-8') as json_file:
-                for linha, records in data_by_line.items():
-                    json.dump(records, json_file, ensure_ascii=False, indent=4)
-                    json_file.write('\n')
+                data = json.load(json_file)
+            removed = deduplicator.removed
+            data = deduplicator.filter_records(data)
+            if deduplicator.removed > removed:
+                save_json_file(file_path, data)
+        except Exception as e:
+            errors.append((file_path, f"{type(e).__name__}: {e}"))
+    return deduplicator.removed, errors
+
+def group_sequence_json_file(file_path, memory_limit=None):
+    """
+    Group a JSON file by 'linha' and sequence it by 'datahora' into '<name>_sorted.json'.
+    
+    Args:
+    - file_path (str): Path to the JSON file.
+    - memory_limit (int): If set, sort with an external merge sort holding about this many bytes
+      of records in memory, instead of loading the whole file. The output is the same.
+    """
+    root, file_name = os.path.split(file_path)
+    output_file_path = os.path.join(root, f"{os.path.splitext(file_name)[0]}_sorted.json")
+    
+    if memory_limit is not None:
+        # Runs are spilled next to the data rather than to the system temp folder, which may live in memory
+        with open(file_path, 'r', encoding='utf-8') as json_file, \
+                tempfile.TemporaryDirectory(dir=root, prefix='.sort-') as temp_dir, \
+                open(output_file_path, 'w', encoding='utf-8') as output_file:
+            write_line_groups(output_file, external_group_sort(iter_json_array(json_file), memory_limit, temp_dir))
+        return
+    
+    with open(file_path, 'r', encoding='utf-8') as json_file:
+        data = json.load(json_file)
+    
+    # Group records by 'linha' and sort them by 'datahora' within each 'linha'
+    data_by_line = group_sort_by_line(data)
+    
+    # Write sorted records back to a new JSON file
+    with open(output_file_path, 'w', encoding='utf-8') as json_file:
+        for linha, records in data_by_line.items():
+            json.dump(records, json_file, ensure_ascii=False, indent=4)
+            json_file.write('\n')
 
-                
-def calculate_velocity(lat1, lon1, lat2, lon2, time_diff_seconds):
+def group_sequence_json_files(folder_path, workers=1, memory_limit=None):
     """
-    Calculate real velocity between two geographic points.
+    Group JSON files by 'linha' and sequence them by 'datahora', then rewrite the JSON files.
+    
+    Outputs of earlier runs are not read back as inputs, so every file is
+    written by exactly one task.
     
     Args:
-    - lat1, lon1: Latitude and longitude of the first point (as strings).
-    - lat2, lon2: Latitude and longitude of the second point (as strings).
-    - time_diff_seconds: Time difference between points in seconds (as float).
+    - folder_path (str): Path to the folder containing JSON files.
+    - workers (int): Number of worker processes.
+    - memory_limit (int): Memory, in bytes, for each file's external sort; None sorts each file in memory.
     
     Returns:
-    - Real velocity in km/h (as float).
+    - List[Tuple[str, str]]: Per-file errors.
     """
-    try:
-        point1 = (float(lat1.replace(',', '.')), float(lon1.replace(',', '.')))
-        point2 = (float(lat2.replace(',', '.')), float(lon2.replace(',', '.')))
-        
-        distance_km = geodesic(point1, point2).kilometers
-        velocity_kmh = (distance_km / (time_diff_seconds / 3600)) if time_diff_seconds > 0 else 0.0
-        
-        return velocity_kmh
-    except ValueError:
-        return 0.0
-    except Exception as e:
-        print(f"Error calculating velocity: {e}")
-        return 0.0
+    file_paths = list_json_files(folder_path, exclude_outputs=True)
+    _, errors = run_file_stage(group_sequence_json_file, file_paths, memory_limit, workers=workers)
+    return errors
 
 def load_json_file(file_path):
     """
@@ -143,30 +176,6 @@ def save_json_file(file_path, data):
     with open(file_path, 'w', encoding='utf-8') as json_file:
         json.dump(data, json_file, ensure_ascii=False, indent=4)
 
-def calculate_velocity(lat1, lon1, lat2, lon2, time_diff_seconds):
-    """
-    Calculate velocity between two points in km/h.
-
-    Args:
-    - lat1 (str): Latitude of the first point.
-    - lon1 (str): Longitude of the first point.
-    - lat2 (str): Latitude of the second point.
-    - lon2 (str): Longitude of the second point.
-    - time_diff_seconds (float): Time difference between two points in seconds.
-
-    Returns:
-    - float: Velocity in km/h.
-    """
-    coords_1 = (float(lat1.replace(',', '.')), float(lon1.replace(',', '.')))
-    coords_2 = (float(lat2.replace(',', '.')), float(lon2.replace(',', '.')))
-    distance_km = great_circle(coords_1, coords_2).kilometers
-    
-    if time_diff_seconds == 0:
-        return 0.0  # Return 0 velocity if time difference is zero
-    
-    velocity = (distance_km / time_diff_seconds) * 3600.0  # Convert to km/h
-    return velocity
-
 def add_features_to_json(sorted_file_path):
     """
     Add new features (real velocity, day of week, holiday indicator) to each record in sorted JSON file.
@@ -175,179 +184,115 @@ def add_features_to_json(sorted_file_path):
     - sorted_file_path (str): Path to the sorted JSON file.
     """
     # Load sorted JSON data
-    data = load_json_file(sorted_file_path)
+    with open(sorted_file_path, 'r', encoding='utf-8') as json_file:
+        data = json.load(json_file)
     if not data:
         return
     
-    # Iterate through data to add features
-    for i in range(1, len(data)):
-        current_record = data[i]
-        previous_record = data[i - 1]
-        
-        current_datahora = int(current_record['datahora'])
-        previous_datahora = int(previous_record['datahora'])
-        
-        # Calculate real velocity
-        time_diff_seconds = (current_datahora - previous_datahora) / 1000.0
-        velocity_real = calculate_velocity(previous_record['latitude'], previous_record['longitude'],
-                                           current_record['latitude'], current_record['longitude'],
-                                           time_diff_seconds)
-        
-        # Add real velocity to current record
-        current_record['velocidadeReal'] = velocity_real
-        
-        # Add day of week
-        current_datetime = datetime.datetime.utcfromtimestamp(current_datahora / 1000.0)
-        day_of_week = current_datetime.weekday()
-        current_record['diaSemana'] = day_of_week
-        
-        # Check if it's a holiday
-        br_holidays = holidays.Brazil()
-        current_date = current_datetime.date()
-        is_holiday = "Sim" if current_date in br_holidays else "Não"
-        current_record['feriado'] = is_holiday
+    add_features(data)
     
     # Write updated data back to the same JSON file
     save_json_file(sorted_file_path, data)
 
-def process_all_sorted_json_files(folder_path):
+def process_all_sorted_json_files(folder_path, workers=1):
     """
     Process all sorted JSON files in the given folder path by adding new features.
     
     Args:
     - folder_path (str): Path to the folder containing sorted JSON files.
+    - workers (int): Number of worker processes.
+    
+    Returns:
+    - List[Tuple[str, str]]: Per-file errors.
     """
-    for root, _, files in os.walk(folder_path):
-        for file_name in files:
-            if file_name.endswith("_sorted.json"):
-                file_path = os.path.join(root, file_name)
-                add_features_to_json(file_path)
+    file_paths = list_json_files(folder_path, suffix="_sorted.json")
+    _, errors = run_file_stage(add_features_to_json, file_paths, workers=workers)
+    return errors
 
 def fix_json_file(file_path):
     """
     Fix JSON file by correcting the JSON array structure.
     
+    The file is left untouched and the error is raised if the repaired
+    content is still not valid JSON.
+    
     Args:
     - file_path (str): Path to the JSON file to fix.
     """
-    try:
-        # Read the entire content of the file
-        with open(file_path, 'r', encoding='utf-8') as json_file:
-            content = json_file.read()
-        
-        # Clean up unnecessary new lines and spaces
-        content = content.replace("}]\n[", ",")
-        content = content.replace("}\n[", ",")
-        content = content.replace("]\n[", ",")
-        
-        # Remove leading/trailing whitespaces
-        content = content.strip()
-        
-        # Ensure the file ends with a correct JSON structure
-        if content.startswith("[") and content.endswith("]"):
-            fixed_content = content
-        else:
-            fixed_content = f"[{content}]"
-        
-        # Validate JSON structure before writing
-        try:
-            json.loads(fixed_content)
-        except json.JSONDecodeError as e:
-            print(f"JSON decode error in file {file_path}: {e}")
-            return
-        
-        # Write the fixed content back to the file
-        with open(file_path, 'w', encoding='utf-8') as json_file:
-            json_file.write(fixed_content)
-        
-        print(f"File {file_path} successfully fixed.")
+    # Read the entire content of the file
+    with open(file_path, 'r', encoding='utf-8') as json_file:
+        content = json_file.read()
+    
+    # Clean up unnecessary new lines and spaces
+    content = content.replace("}]\n[", ",")
+    content = content.replace("}\n[", ",")
+    content = content.replace("]\n[", ",")
+    
+    # Remove leading/trailing whitespaces
+    content = content.strip()
+    
+    # Ensure the file ends with a correct JSON structure
+    if content.startswith("[") and content.endswith("]"):
+        fixed_content = content
+    else:
+        fixed_content = f"[{content}]"
+    
+    # Validate JSON structure before writing
+    json.loads(fixed_content)
     
-    except FileNotFoundError:
-        print(f"File {file_path} not found.")
-    except Exception as e:
-        print(f"Error fixing file {file_path}: {e}")
+    # Write the fixed content back to the file
+    with open(file_path, 'w', encoding='utf-8') as json_file:
+        json_file.write(fixed_content)
+    
+    print(f"File {file_path} successfully fixed.")
 
-def fix_all_sorted_json_files(root_folder):
+def fix_all_sorted_json_files(root_folder, workers=1):
     """
     Recursively fix all JSON files with '_sorted.json' suffix in the given root folder.
     
     Args:
     - root_folder (str): Root folder containing 'dataGPS' and 'dataTest' subdirectories.
+    - workers (int): Number of worker processes.
+    
+    Returns:
+    - List[Tuple[str, str]]: Per-file errors.
     """
-    for root, _, files in os.walk(root_folder):
-        for file_name in files:
-            if file_name.endswith("_sorted.json"):
-                file_path = os.path.join(root, file_name)
-                fix_json_file(file_path)
+    file_paths = list_json_files(root_folder, suffix="_sorted.json")
+    _, errors = run_file_stage(fix_json_file, file_paths, workers=workers)
+    return errors
 
 def load_json_files(folder_path):
     """
     Load JSON files from the specified folder.
 
-    Args:
-    - folder_path (str): Path to the folder containing JSON files.
-
-    Returns:
-    - List[Dict]: List of dictionaries containing the JSON data.
-    """
-    data = []
-    for root, _, files in os.walk(folder_path):
-        for file_name in files:
-            if file_name.endswith("_sorted.json"):
-                file_path = os.path.join(root, file_name)
-                try:
-                    with open(file_path, 'r', encoding='utf-8') as json_file:
-                        data.extend(json.load(json_file))
-                except json.JSONDecodeError as e:
-                    print(f"Error decoding JSON in file {file_path}: {e}")
-                except Exception as e:
-                    print(f"Error reading file {file_path}: {e}")
-    return data
-
-def find_main_route(data, eps=0.001, min_samples=5):
-    """
-    Find the main route using DBSCAN clustering.
+    Each file is converted to a compact RecordBatch as soon as it is read, so
+    only one file is held as Python dictionaries at a time.
 
     Args:
-    - data (List[Dict]): List of dictionaries containing the GPS data.
-    - eps (float): The maximum distance between two samples for them to be considered as in the same neighborhood.
-    - min_samples (int): The number of samples in a neighborhood for a point to be considered as a core point.
-
-    Returns:
-    - List[Dict]: List of dictionaries containing the main route data.
-    """
-    coordinates = np.array([[float(d['latitude'].replace(',', '.')), float(d['longitude'].replace(',', '.'))] for d in data])
-    clustering = DBSCAN(eps=eps, min_samples=min_samples).fit(coordinates)
-
-    labels = clustering.labels_
-    main_cluster = np.argmax(np.bincount(labels[labels >= 0]))
-
-    main_route = [data[i] for i in range(len(data)) if labels[i] == main_cluster]
-
-    return main_route
-
-def remove_outliers(data, main_route):
-    """
-    Remove outliers from the data based on the main route.
-
-    Args:
-    - data (List[Dict]): List of dictionaries containing the GPS data.
-    - main_route (List[Dict]): List of dictionaries containing the main route data.
+    - folder_path (str): Path to the folder containing JSON files.
 
     Returns:
-    - List[Dict]: List of dictionaries containing the cleaned data.
+    - RecordBatch: Records of all the '_sorted.json' files.
     """
-    main_route_set = set((d['latitude'], d['longitude']) for d in main_route)
-    cleaned_data = [d for d in data if (d['latitude'], d['longitude']) in main_route_set]
-
-    return cleaned_data
+    batches = []
+    for file_path in list_json_files(folder_path, suffix="_sorted.json"):
+        try:
+            with open(file_path, 'r', encoding='utf-8') as json_file:
+                batches.append(RecordBatch.from_dicts(json.load(json_file)))
+        except json.JSONDecodeError as e:
+            print(f"Error decoding JSON in file {file_path}: {e}")
+        except Exception as e:
+            print(f"Error reading file {file_path}: {e}")
+    return RecordBatch.concat(batches)
 
-def process_all_files(root_folder):
+def process_all_files(root_folder, workers=1, routes_path=None):
     """
     Process all JSON files to find the main route and remove outliers.
 
     Args:
     - root_folder (str): Root folder containing 'dataGPS' and 'dataTest' subdirectories.
+    - workers (int): Number of worker processes cleaning the (ordem, linha) groups.
+    - routes_path (str): Folder of the route catalogue, completed from 'dataGPS'; None clusters every group.
     """
     data_gps_path = os.path.join(root_folder, 'dataGPS')
     data_test_path = os.path.join(root_folder, 'dataTest')
@@ -355,73 +300,138 @@ def process_all_files(root_folder):
     for path in [data_gps_path, data_test_path]:
         data = load_json_files(path)
 
-        # Group data by 'ordem' and 'linha'
-        grouped_data = defaultdict(list)
-        for entry in data:
-            key = (entry['ordem'], entry['linha'])
-            grouped_data[key].append(entry)
-
-        for key, group in grouped_data.items():
-            main_route = find_main_route(group)
-            cleaned_data = remove_outliers(group, main_route)
-
-            # Save the cleaned data back to file
-            file_name = f"{key[0]}_{key[1]}_cleaned.json"
-            file_path = os.path.join(path, file_name)
-            try:
-                with open(file_path, 'w', encoding='utf-8') as json_file:
-                    json.dump(cleaned_data, json_file, ensure_ascii=False, indent=4)
-                print(f"File {file_path} successfully saved.")
-            except Exception as e:
-                print(f"Error saving file {file_path}: {e}")
-                                      
-def main():
+        # Routes are built from the historical data and reused for the test data
+        routes = {}
+        if routes_path is not None and path == data_gps_path:
+            routes = update_route_catalogue(routes_path, data, workers=workers)
+        elif routes_path is not None:
+            routes = load_routes(routes_path, data.unique('linha'))
+
+        # Group data by 'ordem' and 'linha', remove outliers and save each group
+        save_cleaned_groups(path, data, clean_groups(data, group_by_vehicle(data), workers=workers, routes=routes))
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Process the bus GPS data in 'dataGPS' and 'dataTest'.")
+    parser.add_argument('--ingest', choices=['extract', 'stream'], default='extract',
+                        help="'extract' unpacks the archives and filters the files in place; "
+                             "'stream' reads the archives directly and only writes relevant records.")
+    parser.add_argument('--staged', action='store_true',
+                        help="Run one pass over every file per stage, reprocessing all of them, instead of the "
+                             "default single pass over the new or changed inputs.")
+    parser.add_argument('--fused', action='store_true',
+                        help="Deprecated and ignored: the single pass over the new or changed inputs is the default.")
+    parser.add_argument('--workers', type=int, default=1,
+                        help="Number of processes handling the per-file stages (default: 1, serial).")
+    parser.add_argument('--force', action='store_true',
+                        help="Reprocess every input even if the manifest says it is up to date.")
+    parser.add_argument('--sort-memory', type=int, metavar='MB',
+                        help="With --staged, sort each file with an external merge sort using about MB megabytes "
+                             "per worker, instead of loading the whole file. Ignored without --staged: the default "
+                             "pipeline sorts each file's filtered records in memory.")
+    parser.add_argument('--rebuild-routes', action='store_true',
+                        help="Discard the route catalogue and rebuild each line's route from 'dataGPS'.")
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    
     # Define paths relative to the current directory
     current_dir = os.path.dirname(os.path.abspath(__file__))
     data_gps_path = os.path.join(current_dir, 'dataGPS')
     data_test_path = os.path.join(current_dir, 'dataTest')
     
     models_path = os.path.join(current_dir, 'models')
+    store_gps_path = os.path.join(current_dir, 'store', 'dataGPS')
+    store_test_path = os.path.join(current_dir, 'store', 'dataTest')
+    routes_path = os.path.join(current_dir, 'store', 'routes')
     
     # Define relevant bus lines
     relevant_lines = [
         '107', '177', '203', '222', '230', '232', '415', '2803', '324', '852', '557', '759', '343', '779', '905', '108',
         '483', '864', '639', '3', '309', '774', '629', '371', '397', '100', '838', '315', '624', '388', '918', '665',
         '328', '497', '878', '355', '138', '606', '457', '550', '803', '917', '638', '2336', '399', '298', '867', '553',
-        '565', '422', '756', '186012003', '292', '554', '634', '232', '415', '2803', '324', '852', '557', '759', '343',
-        '779', '905', '108'
+        '565', '422', '756', '186012003', '292', '554', '634'
     ]
     
-    # Extract zip files
-    extract_zip_files(data_gps_path)
-    extract_zip_files(data_test_path)
-    
-    # Process data files
-    # Filter JSON files in dataGPS folder
-    filter_json_files(data_gps_path, relevant_lines)
-    
-    # Filter JSON files in dataTest folder
-    filter_json_files(data_test_path, relevant_lines)
-    
-    # Group and sequence JSON files in dataGPS folder
-    group_sequence_json_files(data_gps_path)
+    workers = args.workers
+    sort_memory = args.sort_memory * 1024 * 1024 if args.sort_memory else None
+    errors = {}
     
-    # Group and sequence JSON files in dataTest folder
-    group_sequence_json_files(data_test_path)
+    if args.rebuild_routes:
+        shutil.rmtree(routes_path, ignore_errors=True)
     
-    # Fix files in dataGPS directory
-    fix_all_sorted_json_files(data_gps_path)
+    if args.fused:
+        print("--fused is deprecated and has no effect; the single pass is the default.")
     
-    # Fix files in dataTest directory
-    fix_all_sorted_json_files(data_test_path)
-    
-    process_all_files(current_dir)
-    
-    # Process all sorted JSON files in dataGPS folder
-    process_all_sorted_json_files(data_gps_path)
+    if not args.staged:
+        if sort_memory is not None:
+            print("--sort-memory only applies with --staged; ignored.")
+        if args.ingest == 'extract':
+            extract_zip_files(data_gps_path)
+            extract_zip_files(data_test_path)
+        
+        # Filter, sort, clean and enrich each file in a single pass
+        # Only new or changed inputs are processed, as recorded in each folder's manifest, and the
+        # inputs already processed are represented by the state saved next to it
+        errors['pipeline (dataGPS)'] = run_pipeline(data_gps_path, relevant_lines, ingest=args.ingest,
+                                                    store_path=store_gps_path, workers=workers,
+                                                    manifest_path=os.path.join(store_gps_path, 'manifest.json'),
+                                                    force=args.force or args.rebuild_routes,
+                                                    routes_path=routes_path, build_routes=True)
+        errors['pipeline (dataTest)'] = run_pipeline(data_test_path, relevant_lines, ingest=args.ingest,
+                                                     store_path=store_test_path, workers=workers,
+                                                     manifest_path=os.path.join(store_test_path, 'manifest.json'),
+                                                     force=args.force or args.rebuild_routes,
+                                                     routes_path=routes_path)
+    else:
+        if args.ingest == 'stream':
+            # Stream the zip files, writing only records of relevant lines
+            ingest_zip_files(data_gps_path, relevant_lines)
+            ingest_zip_files(data_test_path, relevant_lines)
+        else:
+            # Extract zip files
+            extract_zip_files(data_gps_path)
+            extract_zip_files(data_test_path)
+            
+            # Process data files
+            # Filter JSON files in dataGPS folder
+            errors['filter (dataGPS)'] = filter_json_files(data_gps_path, relevant_lines, workers)
+            
+            # Filter JSON files in dataTest folder
+            errors['filter (dataTest)'] = filter_json_files(data_test_path, relevant_lines, workers)
+        
+        # Remove the pings sent more than once, across the files of each folder
+        for folder_name, folder_path in [('dataGPS', data_gps_path), ('dataTest', data_test_path)]:
+            removed, errors[f'dedup ({folder_name})'] = dedup_json_files(folder_path)
+            print(f"{folder_path}: {removed} duplicate ping(s) removed.")
+        
+        # Group and sequence JSON files in dataGPS folder
+        errors['group (dataGPS)'] = group_sequence_json_files(data_gps_path, workers, sort_memory)
+        
+        # Group and sequence JSON files in dataTest folder
+        errors['group (dataTest)'] = group_sequence_json_files(data_test_path, workers, sort_memory)
+        
+        # Fix files in dataGPS directory
+        errors['fix (dataGPS)'] = fix_all_sorted_json_files(data_gps_path, workers)
+        
+        # Fix files in dataTest directory
+        errors['fix (dataTest)'] = fix_all_sorted_json_files(data_test_path, workers)
+        
+        process_all_files(current_dir, workers, routes_path)
+        
+        # Process all sorted JSON files in dataGPS folder
+        errors['features (dataGPS)'] = process_all_sorted_json_files(data_gps_path, workers)
+        
+        # Process all sorted JSON files in dataTest folder
+        errors['features (dataTest)'] = process_all_sorted_json_files(data_test_path, workers)
+        
+        # Write the enriched records to the columnar store
+        build_store(data_gps_path, store_gps_path)
+        build_store(data_test_path, store_test_path)
     
-    # Process all sorted JSON files in dataTest folder
-    process_all_sorted_json_files(data_test_path)
+    # Report the files that failed in any stage
+    for stage_name, stage_errors in errors.items():
+        report_errors(stage_name, stage_errors)
     
 if __name__ == "__main__":
     main()
@@ -0,0 +1,97 @@
+import os
+import json
+import hashlib
+
+MANIFEST_VERSION = 1
+
+
+def file_sha256(file_path, chunk_size=1 << 20):
+    """
+    Compute the SHA-256 of a file's content.
+
+    Args:
+    - file_path (str): Path to the file.
+    - chunk_size (int): Number of bytes read at a time.
+
+    Returns:
+    - str: Hexadecimal digest.
+    """
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as input_file:
+        for chunk in iter(lambda: input_file.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def load_manifest(manifest_path):
+    """
+    Load a processing manifest, or an empty one if it does not exist yet.
+
+    Args:
+    - manifest_path (str): Path to the manifest file.
+
+    Returns:
+    - Dict: Manifest with an 'inputs' mapping from input path (relative to the data folder) to its entry.
+    """
+    if not os.path.exists(manifest_path):
+        return {'version': MANIFEST_VERSION, 'inputs': {}}
+    with open(manifest_path, 'r', encoding='utf-8') as manifest_file:
+        manifest = json.load(manifest_file)
+    if manifest.get('version') != MANIFEST_VERSION:
+        return {'version': MANIFEST_VERSION, 'inputs': {}}
+    return manifest
+
+
+def save_manifest(manifest_path, manifest):
+    """
+    Atomically write a processing manifest.
+
+    Args:
+    - manifest_path (str): Path to the manifest file.
+    - manifest (Dict): Manifest to write.
+    """
+    os.makedirs(os.path.dirname(os.path.abspath(manifest_path)), exist_ok=True)
+    temp_path = f"{manifest_path}.tmp"
+    with open(temp_path, 'w', encoding='utf-8') as manifest_file:
+        json.dump(manifest, manifest_file, ensure_ascii=False, indent=4, sort_keys=True)
+    os.replace(temp_path, manifest_path)
+
+
+def make_entry(sha256, stage_versions, outputs, linhas):
+    """
+    Build the manifest entry of a processed input.
+
+    Args:
+    - sha256 (str): Content hash of the input.
+    - stage_versions (Dict[str, int]): Versions of the stages that produced the outputs.
+    - outputs (List[str]): Paths written from the input.
+    - linhas (Iterable[str]): Bus lines present in the input after filtering.
+
+    Returns:
+    - Dict: Manifest entry.
+    """
+    return {
+        'sha256': sha256,
+        'stage_versions': dict(stage_versions),
+        'outputs': sorted(outputs),
+        'linhas': sorted(set(linhas)),
+    }
+
+
+def is_current(entry, sha256, stage_versions, base_path):
+    """
+    Check whether an input's recorded outputs are still valid.
+
+    Args:
+    - entry (Dict): Manifest entry of the input, or None.
+    - sha256 (str): Current content hash of the input.
+    - stage_versions (Dict[str, int]): Current stage versions.
+    - base_path (str): Folder the recorded output paths are relative to.
+
+    Returns:
+    - bool: True if the input is unchanged, was processed by the same stage versions
+      and all of its outputs still exist.
+    """
+    if entry is None or entry.get('sha256') != sha256 or entry.get('stage_versions') != dict(stage_versions):
+        return False
+    return all(os.path.exists(os.path.join(base_path, output)) for output in entry.get('outputs', []))
@@ -0,0 +1,259 @@
+import os
+import sys
+import hashlib
+import numpy as np
+import joblib
+from manifest import file_sha256
+
+BUNDLE_VERSION = 2
+BUNDLE_FILE = 'models.npz'
+
+# Model families: file prefix -> input features, in the order the models were trained with
+FAMILIES = {
+    'model': ('hora_do_dia',),
+    'model_speed': ('hora_do_dia', 'latitude', 'longitude'),
+    'model_coords': ('hora_do_dia', 'velocidade'),
+}
+
+
+def parse_model_filename(filename):
+    """
+    Split a model file name into its family and line, e.g. 'model_speed_107.joblib' -> ('model_speed', '107').
+
+    Returns:
+    - Tuple[str, str]: Family and line, or None if the file is not a model of a known family.
+    """
+    if not filename.endswith('.joblib'):
+        return None
+    family, _, linha = filename[:-len('.joblib')].rpartition('_')
+    if family not in FAMILIES or not linha:
+        return None
+    return family, linha
+
+
+def linear_parameters(pipeline, features):
+    """
+    Extract the scaler and regression parameters of a StandardScaler + LinearRegression pipeline.
+
+    Args:
+    - pipeline (sklearn.pipeline.Pipeline): ColumnTransformer scaling the features, then LinearRegression.
+    - features (Tuple[str, ...]): Expected input features.
+
+    Returns:
+    - Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]: Scaler mean and scale (features,),
+      coefficients (outputs, features) and intercepts (outputs,).
+    """
+    transformer, regression = pipeline[0], pipeline[-1]
+    (_, scaler, columns), = [t for t in transformer.transformers_ if t[0] != 'remainder']
+    if tuple(columns) != tuple(features):
+        raise ValueError(f"Unexpected features {list(columns)}, expected {list(features)}")
+    mean = scaler.mean_ if scaler.with_mean else np.zeros(len(features))
+    scale = scaler.scale_ if scaler.with_std else np.ones(len(features))
+    coef = np.atleast_2d(regression.coef_)
+    intercept = np.atleast_1d(regression.intercept_)
+    return mean, scale, coef, intercept
+
+
+def model_files(models_path):
+    """
+    Joblib model files of known families in a folder, sorted by name.
+    """
+    return sorted(filename for filename in os.listdir(models_path) if parse_model_filename(filename) is not None)
+
+
+def sources_digest(models_path):
+    """
+    SHA-256 over the names and contents of the joblib models, identifying the models a bundle was compiled from.
+    """
+    digest = hashlib.sha256()
+    for filename in model_files(models_path):
+        digest.update(f"{filename}\0{file_sha256(os.path.join(models_path, filename))}\n".encode('utf-8'))
+    return digest.hexdigest()
+
+
+def compile_bundle(models_path, bundle_path=None):
+    """
+    Compile every per-line joblib model in a folder into a single .npz bundle.
+
+    For each family the bundle holds the lines (sorted) and, indexed like them,
+    the scaler mean and scale, the coefficients and the intercepts. The digest of
+    the joblib files (sources_digest) is stored with them.
+
+    Args:
+    - models_path (str): Folder with the 'model_*', 'model_speed_*' and 'model_coords_*' joblib files.
+    - bundle_path (str): Output path, by default 'models.npz' in models_path.
+
+    Returns:
+    - str: Path of the bundle.
+    """
+    bundle_path = bundle_path or os.path.join(models_path, BUNDLE_FILE)
+    parameters = {family: {} for family in FAMILIES}
+    for filename in model_files(models_path):
+        family, linha = parse_model_filename(filename)
+        pipeline = joblib.load(os.path.join(models_path, filename))
+        parameters[family][linha] = linear_parameters(pipeline, FAMILIES[family])
+
+    arrays = {'version': np.array(BUNDLE_VERSION), 'sources': np.array(sources_digest(models_path))}
+    for family, features in FAMILIES.items():
+        linhas = sorted(parameters[family])
+        outputs = max((len(parameters[family][linha][3]) for linha in linhas), default=1)
+        arrays[f'{family}/linhas'] = np.array(linhas, dtype=str)
+        arrays[f'{family}/features'] = np.array(features, dtype=str)
+        arrays[f'{family}/mean'] = np.array([parameters[family][linha][0] for linha in linhas]).reshape(-1, len(features))
+        arrays[f'{family}/scale'] = np.array([parameters[family][linha][1] for linha in linhas]).reshape(-1, len(features))
+        arrays[f'{family}/coef'] = np.array([parameters[family][linha][2] for linha in linhas]).reshape(-1, outputs,
+                                                                                                        len(features))
+        arrays[f'{family}/intercept'] = np.array([parameters[family][linha][3] for linha in linhas]).reshape(-1, outputs)
+
+    temp_path = f"{bundle_path}.tmp.npz"
+    np.savez(temp_path, **arrays)
+    os.replace(temp_path, bundle_path)
+    return bundle_path
+
+
+def is_stale(models_path, bundle_path=None):
+    """
+    Check whether the bundle is missing, has another version or was compiled from other joblib models.
+
+    A folder without joblib models (e.g. a deployment shipping only the bundle) never makes the bundle stale.
+    """
+    bundle_path = bundle_path or os.path.join(models_path, BUNDLE_FILE)
+    if not os.path.exists(bundle_path):
+        return True
+    with np.load(bundle_path) as arrays:
+        if int(arrays['version']) != BUNDLE_VERSION:
+            return True
+        compiled_from = str(arrays['sources'])
+    return bool(model_files(models_path)) and compiled_from != sources_digest(models_path)
+
+
+class LinearModel:
+    """
+    One line's model from a bundle, with the predict interface of the sklearn pipeline it was compiled from.
+    """
+
+    __slots__ = ('features', 'mean', 'scale', 'coef', 'intercept')
+
+    def __init__(self, features, mean, scale, coef, intercept):
+        self.features = features
+        self.mean = mean
+        self.scale = scale
+        self.coef = coef
+        self.intercept = intercept
+
+    def predict(self, X):
+        """
+        Args:
+        - X (pd.DataFrame): Rows with (at least) the model's features.
+
+        Returns:
+        - np.ndarray: (n,) predictions for single-output models, (n, outputs) otherwise.
+        """
+        values = X[list(self.features)].to_numpy(dtype=np.float64)
+        predicted = ((values - self.mean) / self.scale) @ self.coef.T + self.intercept
+        return predicted[:, 0] if len(self.intercept) == 1 else predicted
+
+
+class ModelBundle:
+    """
+    All per-line linear models, as parameter matrices indexed by line.
+    """
+
+    def __init__(self, arrays):
+        version = int(arrays['version'])
+        if version != BUNDLE_VERSION:
+            raise ValueError(f"Unsupported model bundle version {version}, expected {BUNDLE_VERSION}")
+        self.families = {}
+        for family in FAMILIES:
+            linhas = arrays[f'{family}/linhas'].tolist()
+            self.families[family] = {
+                'index': {linha: i for i, linha in enumerate(linhas)},
+                'features': tuple(arrays[f'{family}/features'].tolist()),
+                'mean': arrays[f'{family}/mean'],
+                'scale': arrays[f'{family}/scale'],
+                'coef': arrays[f'{family}/coef'],
+                'intercept': arrays[f'{family}/intercept'],
+            }
+
+    def linhas(self, family):
+        return list(self.families[family]['index'])
+
+    def __contains__(self, key):
+        family, linha = key
+        return linha in self.families[family]['index']
+
+    def lookup(self, family, linhas):
+        """
+        Row of each line in a family's parameter matrices.
+
+        Args:
+        - family (str): Model family.
+        - linhas (Iterable[str]): Lines.
+
+        Returns:
+        - np.ndarray: Row index of each line, -1 where the line has no model.
+        """
+        index = self.families[family]['index']
+        return np.array([index.get(linha, -1) for linha in linhas], dtype=np.int64)
+
+    def predict(self, family, rows, X):
+        """
+        Evaluate many lines' models at once, each input row with its own line's model.
+
+        Args:
+        - family (str): Model family.
+        - rows (np.ndarray): Parameter row of each input (from lookup), -1 for none.
+        - X (np.ndarray): (n, features) inputs, columns in the family's feature order.
+
+        Returns:
+        - np.ndarray: (n, outputs) predictions, NaN where rows is -1.
+        """
+        parameters = self.families[family]
+        rows = np.asarray(rows)
+        X = np.asarray(X, dtype=np.float64)
+        predicted = np.full((len(rows), parameters['intercept'].shape[1]), np.nan)
+        valid = rows >= 0
+        i = rows[valid]
+        scaled = (X[valid] - parameters['mean'][i]) / parameters['scale'][i]
+        predicted[valid] = np.einsum('nof,nf->no', parameters['coef'][i], scaled) + parameters['intercept'][i]
+        return predicted
+
+    def model(self, family, linha):
+        """
+        The model of a family for a line, as a LinearModel.
+        """
+        parameters = self.families[family]
+        i = parameters['index'][linha]
+        return LinearModel(parameters['features'], parameters['mean'][i], parameters['scale'][i],
+                           parameters['coef'][i], parameters['intercept'][i])
+
+
+def load_bundle(models_path, bundle_path=None):
+    """
+    Load the model bundle. Loading never writes: the bundle is compiled by trainModels.py
+    or by running this module.
+
+    Args:
+    - models_path (str): Folder with the joblib models.
+    - bundle_path (str): Bundle path, by default 'models.npz' in models_path.
+
+    Returns:
+    - ModelBundle: The models.
+
+    Raises:
+    - FileNotFoundError: If there is no bundle.
+    - ValueError: If the bundle is stale (see is_stale).
+    """
+    bundle_path = bundle_path or os.path.join(models_path, BUNDLE_FILE)
+    if not os.path.exists(bundle_path):
+        raise FileNotFoundError(f"Model bundle {bundle_path} not found; compile it with 'python modelbundle.py {models_path}'")
+    if is_stale(models_path, bundle_path):
+        raise ValueError(f"Model bundle {bundle_path} does not match the joblib models in {models_path}; "
+                         f"compile it again with 'python modelbundle.py {models_path}'")
+    with np.load(bundle_path) as arrays:
+        return ModelBundle({name: arrays[name] for name in arrays.files})
+
+
+if __name__ == "__main__":
+    models_dir = sys.argv[1] if len(sys.argv) > 1 else os.path.join(os.path.dirname(os.path.abspath(__file__)), 'models')
+    print(f"Model bundle written to {compile_bundle(models_dir)}")
@@ -0,0 +1,48 @@
+from concurrent.futures import ProcessPoolExecutor
+
+
+def run_file_stage(func, items, *args, workers=1):
+    """
+    Apply a per-file stage to each item, optionally over a process pool.
+
+    Every item is processed independently, so the outputs are identical to a
+    serial run. Exceptions are collected per item instead of aborting the stage.
+
+    Args:
+    - func (Callable): Module-level function called as func(item, *args).
+    - items (List): Files (or sources) to process.
+    - args: Extra arguments passed to func.
+    - workers (int): Number of worker processes; 1 runs serially in this process.
+
+    Returns:
+    - Tuple[List[Tuple], List[Tuple[str, str]]]: (item, result) pairs of the successful items,
+      in input order, and (item, error message) pairs of the failed ones.
+    """
+    results, errors = [], []
+    if workers <= 1:
+        for item in items:
+            try:
+                results.append((item, func(item, *args)))
+            except Exception as e:
+                errors.append((item, f"{type(e).__name__}: {e}"))
+        return results, errors
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(func, item, *args) for item in items]
+        for item, future in zip(items, futures):
+            try:
+                results.append((item, future.result()))
+            except Exception as e:
+                errors.append((item, f"{type(e).__name__}: {e}"))
+    return results, errors
+
+
+def report_errors(stage_name, errors):
+    """
+    Print the per-file errors collected by a stage.
+    """
+    if not errors:
+        return
+    print(f"{stage_name}: {len(errors)} file(s) failed")
+    for item, message in errors:
+        print(f"  {item}: {message}")
@@ -0,0 +1,676 @@
+import os
+import json
+import shutil
+import tempfile
+import heapq
+import zipfile
+import io
+from collections import defaultdict
+from ingest import iter_json_array, filter_records, member_output_path
+import numpy as np
+from records import RecordBatch
+from features import add_batch_features
+from dedup import PingDeduplicator, batch_day_keys, load_day_keys, save_day_keys
+from cleaning import (group_by_vehicle, clean_groups, save_cleaned_groups, append_cleaned_group, group_state_keys,
+                      remove_cleaned_group, GroupState)
+from routes import load_routes, update_route_catalogue
+from store import write_partitions, remove_chunk, chunk_name_for, local_days
+from manifest import file_sha256, load_manifest, save_manifest, make_entry, is_current
+from parallel import run_file_stage
+
+# Version of each stage; bump it when a stage's output changes so that the
+# manifest marks every input as stale
+STAGE_VERSIONS = {
+    'filter': 1,
+    'dedup': 2,
+    'group_sort': 2,
+    'features': 3,
+    'cleaning': 5,
+    'store': 2,
+}
+
+# Approximate memory of a buffered record on top of its serialized size (key tuple and string objects),
+# used to keep the external sort under its memory limit
+SORT_RECORD_OVERHEAD_BYTES = 200
+
+# Maximum number of run files the external sort reads at once
+MAX_MERGE_RUNS = 64
+
+# Folder, next to the manifest, of the state saved between runs: ping keys per day ('dedup')
+# and cleaning state per (ordem, linha) group ('groups')
+STATE_FOLDER = 'state'
+
+# Suffixes of files written by the pipeline, never read back as raw input
+STAGE_OUTPUT_SUFFIXES = ("_sorted.json", "_cleaned.json")
+
+
+def is_stage_output(file_name):
+    """
+    Check whether a file name belongs to a pipeline output rather than raw feed data.
+    """
+    return file_name.endswith(STAGE_OUTPUT_SUFFIXES)
+
+
+def group_sort_by_line(data):
+    """
+    Group records by 'linha' and sort each group by 'datahora'.
+
+    Records without 'linha' or 'datahora' are dropped. Lines keep the order in
+    which they first appear.
+
+    Args:
+    - data (Iterable[Dict]): GPS records.
+
+    Returns:
+    - Dict[str, List[Dict]]: Sorted records of each line.
+    """
+    data_by_line = defaultdict(list)
+    for record in data:
+        linha = record.get('linha')
+        datahora = record.get('datahora')
+
+        if linha and datahora:
+            data_by_line[linha].append(record)
+
+    for linha, records in data_by_line.items():
+        records.sort(key=lambda x: x['datahora'])
+
+    return data_by_line
+
+
+def write_sorted_run(run_path, items):
+    """
+    Write sorted (key, serialized record) pairs to a run file, one per line.
+    """
+    with open(run_path, 'w', encoding='utf-8') as run_file:
+        for key, line in items:
+            run_file.write(json.dumps(key, ensure_ascii=False))
+            run_file.write('\t')
+            run_file.write(line)
+            run_file.write('\n')
+
+
+def iter_sorted_run(run_path):
+    """
+    Read back a run file as (key, serialized record) pairs.
+    """
+    with open(run_path, 'r', encoding='utf-8') as run_file:
+        for line in run_file:
+            # Tabs inside JSON strings are escaped, so the first one ends the key
+            key, record = line.rstrip('\n').split('\t', 1)
+            yield tuple(json.loads(key)), record
+
+
+def merge_sorted_runs(runs):
+    """
+    Merge sorted iterators of (key, serialized record) pairs.
+    """
+    return heapq.merge(*runs, key=lambda item: item[0])
+
+
+def external_group_sort(records, memory_limit, temp_dir):
+    """
+    Group records by 'linha' and sort each group by 'datahora' with bounded memory.
+
+    Produces the same order as group_sort_by_line: records are keyed on (rank of
+    their line by first appearance, 'datahora', position in the input), sorted
+    runs of at most memory_limit bytes are spilled to temp_dir and the runs are
+    merged, at most MAX_MERGE_RUNS at a time. Records without 'linha' or
+    'datahora' are dropped.
+
+    Args:
+    - records (Iterable[Dict]): GPS records, e.g. streamed with iter_json_array.
+    - memory_limit (int): Approximate memory, in bytes, for buffered records.
+    - temp_dir (str): Folder for the sorted runs.
+
+    Returns:
+    - Iterator[Tuple[str, Dict]]: Line and record, lines in first-appearance order.
+    """
+    line_rank = {}
+    buffer = []
+    buffered_bytes = 0
+    run_paths = []
+
+    def spill(items):
+        run_paths.append(os.path.join(temp_dir, f"run_{len(run_paths):06d}.jsonl"))
+        write_sorted_run(run_paths[-1], items)
+
+    for position, record in enumerate(records):
+        linha = record.get('linha')
+        datahora = record.get('datahora')
+        if not (linha and datahora):
+            continue
+
+        rank = line_rank.setdefault(linha, len(line_rank))
+        line = json.dumps(record, ensure_ascii=False)
+        buffer.append(((rank, datahora, position), line))
+        buffered_bytes += len(line) + SORT_RECORD_OVERHEAD_BYTES
+        if buffered_bytes >= memory_limit:
+            buffer.sort(key=lambda item: item[0])
+            spill(buffer)
+            buffer, buffered_bytes = [], 0
+
+    # Merge the oldest runs into larger ones until the remaining runs can be merged at once
+    merged = 0
+    while len(run_paths) - merged >= MAX_MERGE_RUNS:
+        batch = run_paths[merged:merged + MAX_MERGE_RUNS]
+        spill(merge_sorted_runs(iter_sorted_run(run_path) for run_path in batch))
+        for run_path in batch:
+            os.remove(run_path)
+        merged += len(batch)
+
+    # The last run stays in memory
+    buffer.sort(key=lambda item: item[0])
+    lines = list(line_rank)
+    runs = [iter_sorted_run(run_path) for run_path in run_paths[merged:]] + [iter(buffer)]
+    for (rank, _, _), line in merge_sorted_runs(runs):
+        yield lines[rank], json.loads(line)
+
+
+def group_sort_batch(batch):
+    """
+    Group a RecordBatch by 'linha' and sort by 'datahora'.
+
+    This is the in-memory equivalent of group_sequence_json_files followed by
+    fix_json_file.
+
+    Records without 'linha' or 'datahora' are dropped, lines keep the order in
+    which they first appear and the sort is stable within a line.
+
+    Args:
+    - batch (RecordBatch): GPS records.
+
+    Returns:
+    - RecordBatch: Records ordered by line, then by time.
+    """
+    batch = batch.take((batch['linha'] >= 0) & (batch['datahora'] >= 0))
+    if not len(batch):
+        return batch
+
+    # Rank each line by its first appearance
+    lines, first_index = np.unique(batch['linha'], return_index=True)
+    rank = np.empty(lines.max() + 1, dtype=np.int64)
+    rank[lines] = np.argsort(np.argsort(first_index))
+    order = np.lexsort((batch['datahora'], rank[batch['linha']]))
+    return batch.take(order)
+
+
+def list_json_files(folder_path, suffix=".json", exclude_outputs=False):
+    """
+    List the JSON files under a folder in a deterministic order.
+
+    Args:
+    - folder_path (str): Folder to walk recursively.
+    - suffix (str): Suffix the file names must end with.
+    - exclude_outputs (bool): Skip files written by the pipeline stages.
+
+    Returns:
+    - List[str]: Sorted file paths.
+    """
+    file_paths = []
+    for root, _, files in os.walk(folder_path):
+        for file_name in files:
+            if not file_name.endswith(suffix) or (exclude_outputs and is_stage_output(file_name)):
+                continue
+            file_paths.append(os.path.join(root, file_name))
+    return sorted(file_paths)
+
+
+def list_input_sources(folder_path, ingest='stream'):
+    """
+    List the raw feed files of a folder.
+
+    Args:
+    - folder_path (str): Folder containing zip archives or extracted JSON files.
+    - ingest (str): 'stream' lists the JSON members of the zip archives,
+      'extract' lists the JSON files already extracted on disk.
+
+    Returns:
+    - List[Tuple[str, str, str]]: For each source, the path of the raw file as if it were
+      extracted, the archive holding it (or None) and its member name (or None).
+    """
+    if ingest != 'stream':
+        return [(file_path, None, None) for file_path in list_json_files(folder_path, exclude_outputs=True)]
+
+    sources = []
+    for file_name in sorted(os.listdir(folder_path)):
+        if not file_name.endswith(".zip"):
+            continue
+        zip_path = os.path.join(folder_path, file_name)
+        with zipfile.ZipFile(zip_path, 'r') as zip_ref:
+            for member in zip_ref.infolist():
+                if not member.is_dir() and member.filename.endswith(".json"):
+                    sources.append((member_output_path(folder_path, member.filename), zip_path, member.filename))
+    return sources
+
+
+def iter_input_source(source):
+    """
+    Lazily parse the records of a raw feed source.
+
+    Args:
+    - source (Tuple[str, str, str]): Source as returned by list_input_sources.
+
+    Returns:
+    - Iterator[Dict]: Parsed records.
+    """
+    file_path, zip_path, member_name = source
+    if zip_path is None:
+        with open(file_path, 'r', encoding='utf-8') as json_file:
+            yield from iter_json_array(json_file)
+        return
+    with zipfile.ZipFile(zip_path, 'r') as zip_ref, zip_ref.open(member_name) as raw:
+        yield from iter_json_array(io.TextIOWrapper(raw, encoding='utf-8-sig'))
+
+
+def sorted_output_path(file_path):
+    """
+    Path of the '_sorted.json' artifact produced from a raw feed file.
+    """
+    return f"{os.path.splitext(file_path)[0]}_sorted.json"
+
+
+def load_input_source(source, relevant_lines):
+    """
+    Parse a raw source, keeping only the records of relevant lines.
+
+    Only those records are converted to the compact RecordBatch representation
+    that the remaining stages share.
+
+    Args:
+    - source (Tuple[str, str, str]): Source as returned by list_input_sources.
+    - relevant_lines (Set[str]): Bus lines to keep.
+
+    Returns:
+    - RecordBatch: Records of the relevant lines, in feed order.
+    """
+    return RecordBatch.from_dicts(filter_records(iter_input_source(source), relevant_lines))
+
+
+def run_file_stages(batch):
+    """
+    Run the per-file stages after filtering and deduplication over a file's records.
+
+    Args:
+    - batch (RecordBatch): Filtered records of the file.
+
+    Returns:
+    - RecordBatch: Sorted and enriched records.
+    """
+    stages = [
+        group_sort_batch,
+        add_batch_features,
+    ]
+    data = batch
+    for stage in stages:
+        data = stage(data)
+    return data
+
+
+def input_path(source):
+    """
+    Path of the input unit a source belongs to: its zip archive, or the JSON file itself.
+    """
+    file_path, zip_path, _ = source
+    return zip_path if zip_path is not None else file_path
+
+
+def process_input_source(item, folder_path, store_path=None):
+    """
+    Run the per-file stages over one raw source's filtered records and write its artifacts.
+
+    Args:
+    - item (Tuple[Tuple[str, str, str], RecordBatch]): Source as returned by list_input_sources
+      and its filtered, deduplicated records.
+    - folder_path (str): Data folder the source belongs to.
+    - store_path (str): Root of the columnar store, or None.
+
+    Returns:
+    - Tuple[RecordBatch, List[str]]: The enriched records, also input of the outlier
+      removal stage, and the paths written.
+    """
+    source, batch = item
+    file_path = source[0]
+    batch = run_file_stages(batch)
+
+    output_path = sorted_output_path(file_path)
+    os.makedirs(os.path.dirname(output_path), exist_ok=True)
+    with open(output_path, 'w', encoding='utf-8') as json_file:
+        json.dump(batch.to_dicts(), json_file, ensure_ascii=False, indent=4)
+    outputs = [output_path]
+    if store_path is not None:
+        outputs.extend(write_partitions(store_path, batch, chunk_name_for(folder_path, file_path)))
+    return batch, outputs
+
+
+def remove_outputs(folder_path, outputs):
+    """
+    Remove the artifacts recorded for an input: its '_sorted.json' files and store chunks.
+
+    Args:
+    - folder_path (str): Data folder the output paths are relative to.
+    - outputs (Iterable[str]): Output paths, as recorded in the input's manifest entry.
+    """
+    for output in outputs:
+        path = os.path.join(folder_path, output)
+        if os.path.isdir(path):
+            remove_chunk(path)
+        elif os.path.exists(path):
+            os.remove(path)
+
+
+def find_pending_inputs(folder_path, inputs, manifest, force=False):
+    """
+    Select the inputs that are new, changed or were processed by older stage versions.
+
+    A file whose size and modification time match its manifest entry reuses the
+    recorded hash instead of being read again.
+
+    Args:
+    - folder_path (str): Data folder the inputs belong to.
+    - inputs (Iterable[str]): Input paths.
+    - manifest (Dict): Processing manifest.
+    - force (bool): Select every input.
+
+    Returns:
+    - Dict[str, Dict]: For each pending input, its hash, size and modification time.
+    """
+    pending = {}
+    for path in inputs:
+        key = os.path.relpath(path, folder_path)
+        entry = manifest['inputs'].get(key)
+        stat = os.stat(path)
+        if entry is not None and entry.get('size') == stat.st_size and entry.get('mtime_ns') == stat.st_mtime_ns:
+            sha256 = entry['sha256']
+        else:
+            sha256 = file_sha256(path)
+        if force or not is_current(entry, sha256, STAGE_VERSIONS, folder_path):
+            pending[path] = {'sha256': sha256, 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+    return pending
+
+
+def find_dependent_inputs(inputs, input_keys, input_order, manifest, pending, vanished):
+    """
+    Add to the pending inputs the processed ones whose deduplication depended on a stale input.
+
+    Pings of a later input dropped as repeats of a stale (changed or vanished)
+    input's pings may now be the first ones sent, so every processed input
+    after a stale one that shares a day with it is processed again, until no
+    more inputs are added. A vanished input counts as the first of its days.
+
+    Args:
+    - inputs (Dict[str, List]): Sources of each input path, in source order.
+    - input_keys (Dict[str, str]): Manifest key of each input path.
+    - input_order (Dict[str, int]): Position of each input key in source order.
+    - manifest (Dict): Processing manifest.
+    - pending (Dict[str, Dict]): Pending inputs, as returned by find_pending_inputs.
+    - vanished (Set[str]): Manifest keys of the inputs that disappeared.
+
+    Returns:
+    - Dict[str, Dict]: The pending inputs, in source order.
+    """
+    pending = dict(pending)
+    while True:
+        first = {}
+        for key in {input_keys[path] for path in pending} | vanished:
+            for day in manifest['inputs'].get(key, {}).get('days', []):
+                first[day] = min(first.get(day, len(input_order)), input_order.get(key, -1))
+        added = False
+        for path in inputs:
+            entry = manifest['inputs'].get(input_keys[path])
+            if path in pending or entry is None:
+                continue
+            if any(input_order[input_keys[path]] > first.get(day, len(input_order)) for day in entry.get('days', [])):
+                pending[path] = {name: entry[name] for name in ('sha256', 'size', 'mtime_ns')}
+                added = True
+        if not added:
+            return {path: pending[path] for path in inputs if path in pending}
+
+
+def input_days(batch):
+    """
+    Local days of the pings of a RecordBatch that can be deduplicated.
+    """
+    datahora = batch['datahora'][(batch['ordem'] >= 0) & (batch['datahora'] >= 0)]
+    return set(np.unique(local_days(datahora)).tolist()) if len(datahora) else set()
+
+
+def merge_group(state, stale, new_batch, new_inputs, input_order):
+    """
+    Merge a group's saved records, minus those of stale inputs, with its new records, in source order.
+
+    Returns:
+    - Tuple[RecordBatch, np.ndarray]: The group's records and the input each came from.
+    """
+    batch, inputs, _ = state.load()
+    keep = ~np.isin(inputs, list(stale)) if len(inputs) else np.zeros(0, dtype=bool)
+    batch = RecordBatch.concat([batch.take(keep), new_batch])
+    inputs = np.concatenate([inputs[keep], new_inputs])
+    order = np.argsort(np.array([input_order[name] for name in inputs], dtype=np.int64), kind='stable')
+    return batch.take(order), inputs[order]
+
+
+def update_cleaned_groups(folder_path, state_path, new_batches, input_order, stale, stale_lines, routes_path=None,
+                          build_routes=False, workers=1):
+    """
+    Remove outliers from the groups touched by a run, starting from their saved cleaning state.
+
+    A group whose line has a route that its saved records were already checked
+    against only checks its new records, and appends the ones kept to its
+    '_cleaned.json' file and its state. Groups that are clustered, lost records
+    of stale inputs or whose route changed are cleaned again from their saved
+    records; the routes of new lines are built from the saved records of the line.
+
+    Args:
+    - folder_path (str): Data folder the '_cleaned.json' files are written to.
+    - state_path (str): Folder of the cleaning state of each group.
+    - new_batches (List[Tuple[str, RecordBatch]]): Enriched records of each processed source, with its input, in source order.
+    - input_order (Dict[str, int]): Position of each current input in source order.
+    - stale (Set[str]): Inputs whose saved records are replaced or dropped.
+    - stale_lines (Set[str]): Lines the stale inputs had records of.
+    - routes_path (str): Folder of the route catalogue, or None to cluster every group.
+    - build_routes (bool): Build and persist the routes of lines missing from the catalogue.
+    - workers (int): Number of processes for the clustering.
+    """
+    new = RecordBatch.concat([batch for _, batch in new_batches])
+    new_inputs = np.repeat(np.array([name for name, _ in new_batches], dtype=object),
+                           [len(batch) for _, batch in new_batches])
+    new_groups = {(str(ordem), linha): index for (ordem, linha), index in group_by_vehicle(new).items()}
+    touched_lines = set(new.unique('linha'))
+    keys = sorted(set(new_groups) | set(group_state_keys(state_path, touched_lines | set(stale_lines))))
+    states = {key: GroupState(state_path, key) for key in keys}
+    empty = np.empty(0, dtype=np.int64)
+    merged = {}
+
+    def merged_group(key):
+        if key not in merged:
+            index = new_groups.get(key, empty)
+            merged[key] = merge_group(states[key], stale, new.take(index), new_inputs[index], input_order)
+        return merged[key]
+
+    routes = {}
+    if routes_path is not None:
+        routes = load_routes(routes_path, touched_lines | set(stale_lines))
+        missing = touched_lines - set(routes)
+        if build_routes and missing:
+            history = RecordBatch.concat([merged_group(key)[0] for key in keys if key[1] in missing])
+            routes.update(update_route_catalogue(routes_path, history, workers=workers))
+    digests = {linha: route.digest() for linha, route in routes.items()}
+
+    rebuilt = []
+    for key in keys:
+        state = states[key]
+        digest = digests.get(key[1], '')
+        index = new_groups.get(key, empty)
+        has_stale = bool(state.rows) and bool(stale.intersection(state.inputs))
+        if not has_stale and not len(index) and (state.route == digest or not state.rows):
+            continue  # Nothing changed for this group
+
+        # Route already checked and new records after the saved ones: check only the new records
+        appendable = (digest and len(index) and not has_stale and (not state.rows or state.route == digest)
+                      and key not in merged and (not state.rows or max(input_order[name] for name in state.inputs)
+                                                 <= min(input_order[name] for name in new_inputs[index])))
+        if appendable:
+            batch = new.take(index)
+            kept = routes[key[1]].on_route(np.column_stack((batch['latitude'], batch['longitude'])))
+            if state.rows and append_cleaned_group(folder_path, key, batch.take(kept)):
+                state.append(batch, new_inputs[index], kept)
+                continue
+            if not state.rows:
+                state.route = digest
+                save_cleaned_groups(folder_path, batch, [(key, np.flatnonzero(kept))])
+                state.append(batch, new_inputs[index], kept)
+                continue
+        rebuilt.append(key)
+
+    # Clean the remaining groups again from all of their records
+    batches = [merged_group(key) for key in rebuilt]
+    combined = RecordBatch.concat([batch for batch, _ in batches])
+    offsets = np.cumsum([0] + [len(batch) for batch, _ in batches])
+    grouped = {key: np.arange(offsets[i], offsets[i + 1]) for i, key in enumerate(rebuilt) if offsets[i + 1] > offsets[i]}
+    kept = np.zeros(len(combined), dtype=bool)
+    for key, index in clean_groups(combined, grouped, workers=workers, routes=routes):
+        kept[index] = True
+    save_cleaned_groups(folder_path, combined, ((key, index[kept[index]]) for key, index in grouped.items()))
+    for i, key in enumerate(rebuilt):
+        index = np.arange(offsets[i], offsets[i + 1])
+        if not len(index):
+            remove_cleaned_group(folder_path, key)  # Only records of stale inputs were left
+        states[key].replace(combined.take(index), batches[i][1], kept[index], digests.get(key[1], ''))
+
+
+def run_pipeline(folder_path, relevant_lines, ingest='stream', store_path=None, workers=1,
+                 manifest_path=None, force=False, routes_path=None, build_routes=False):
+    """
+    Run filter, dedup, group/sort, JSON repair, outlier removal and feature stages in a single pass.
+
+    Each raw file is parsed once and chained through the stages in memory; the
+    '_sorted.json' and '_cleaned.json' artifacts are each written exactly once.
+    Pings sent more than once (same 'ordem' and 'datahora') are dropped across
+    files, keeping the first one in source order; files already processed count
+    as earlier sources.
+
+    With a manifest, only inputs (zip archives, or JSON files when extracted)
+    that are new or changed since the last run are processed. The inputs already
+    processed are not read again: the ping keys of each day and the cleaning
+    state of each (ordem, linha) group are saved next to the manifest, and only
+    the days and groups the new data touches are loaded (see
+    update_cleaned_groups). Without the saved state, every input is processed again.
+
+    Args:
+    - folder_path (str): Folder containing the raw feed data ('dataGPS' or 'dataTest').
+    - relevant_lines (Iterable[str]): Bus lines to keep.
+    - ingest (str): 'stream' to read from the zip archives, 'extract' for extracted JSON files.
+    - store_path (str): Root of the columnar store to also write the enriched records to, or None.
+    - workers (int): Number of processes handling the raw files and the outlier removal.
+    - manifest_path (str): Path to the processing manifest, or None to process everything.
+    - force (bool): Reprocess every input even if the manifest says it is current.
+    - routes_path (str): Folder of the route catalogue used for outlier removal, or None to cluster every group.
+    - build_routes (bool): Build and persist the routes of lines missing from the catalogue.
+
+    Returns:
+    - List[Tuple[str, str]]: Per-file errors.
+    """
+    relevant_lines = set(relevant_lines)
+    sources = list_input_sources(folder_path, ingest)
+    inputs = defaultdict(list)
+    for source in sources:
+        inputs[input_path(source)].append(source)
+
+    if manifest_path is None:
+        # Nothing is kept between runs: the state only lives for this one
+        with tempfile.TemporaryDirectory() as state_path:
+            return _run_pipeline(folder_path, sources, inputs, relevant_lines, {'inputs': {}}, state_path, True,
+                                 ingest, store_path, workers, routes_path, build_routes)
+
+    manifest = load_manifest(manifest_path)
+    state_path = os.path.join(os.path.dirname(os.path.abspath(manifest_path)), STATE_FOLDER)
+    # Without the saved state the inputs already processed are unknown: start over
+    rebuild = force or not os.path.isdir(state_path)
+    errors = _run_pipeline(folder_path, sources, inputs, relevant_lines, manifest, state_path, rebuild,
+                           ingest, store_path, workers, routes_path, build_routes)
+    if errors is not None:
+        save_manifest(manifest_path, manifest)
+    return errors or []
+
+
+def _run_pipeline(folder_path, sources, inputs, relevant_lines, manifest, state_path, rebuild, ingest, store_path,
+                  workers, routes_path, build_routes):
+    """
+    Body of run_pipeline over a loaded manifest and state folder. Returns None when there is nothing to do.
+    """
+    input_keys = {path: os.path.relpath(path, folder_path) for path in inputs}
+    input_order = {input_keys[path]: position for position, path in enumerate(inputs)}
+    dedup_path = os.path.join(state_path, 'dedup')
+    cleaning_path = os.path.join(state_path, 'groups')
+    previous = manifest['inputs']
+    if rebuild:
+        manifest['inputs'] = {}
+        shutil.rmtree(state_path, ignore_errors=True)
+    pending = find_pending_inputs(folder_path, inputs, manifest, force=rebuild)
+    vanished = set(manifest['inputs']) - set(input_keys.values())
+    pending = find_dependent_inputs(inputs, input_keys, input_order, manifest, pending, vanished)
+    if not pending and not vanished:
+        print(f"{folder_path}: nothing to do, all inputs are up to date.")
+        return None
+
+    # The artifacts of the inputs processed again or gone are removed; the new ones are written below
+    for key in set(previous) - (set(input_keys.values()) - {input_keys[path] for path in pending}):
+        remove_outputs(folder_path, previous[key].get('outputs', []))
+
+    pending_sources = [source for path in pending for source in inputs[path]]
+    loaded, errors = run_file_stage(load_input_source, pending_sources, relevant_lines, workers=workers)
+    loaded = dict(loaded)
+
+    # What the inputs processed again or gone contributed to the saved state is replaced
+    stale = {input_keys[path] for path in pending} | vanished
+    stale_entries = [manifest['inputs'][key] for key in stale if key in manifest['inputs']]
+    stale_lines = {linha for entry in stale_entries for linha in entry.get('linhas', [])}
+
+    # Drop the pings already seen, in source order; the inputs already processed only
+    # contribute their saved keys, for the days the new data touches
+    days = set().union(*(input_days(batch) for batch in loaded.values()),
+                       *(entry.get('days', []) for entry in stale_entries))
+    saved_keys = {day: {key: keys for key, keys in load_day_keys(dedup_path, day).items() if key not in stale}
+                  for day in sorted(days)}
+    deduplicator = PingDeduplicator()
+    for day, keys_by_input in saved_keys.items():
+        for keys in keys_by_input.values():
+            deduplicator.remember_keys(day, keys)
+    items = [(source, deduplicator.filter_batch(loaded[source])) for source in pending_sources if source in loaded]
+    print(f"{folder_path}: {deduplicator.removed} duplicate ping(s) removed.")
+
+    results, process_errors = run_file_stage(process_input_source, items, folder_path, store_path, workers=workers)
+    processed = {source: result for (source, _), result in results}
+    errors += [(source, message) for (source, _), message in process_errors]
+    failed_inputs = {input_path(source) for source, _ in errors}
+
+    # Record the processed inputs and their ping keys, and forget the ones that disappeared
+    filtered = dict(items)
+    for path, state in pending.items():
+        key = input_keys[path]
+        if path in failed_inputs:
+            manifest['inputs'].pop(key, None)
+            continue
+        input_keys_by_day = defaultdict(list)
+        for source in inputs[path]:
+            for day, keys in batch_day_keys(filtered[source]).items():
+                input_keys_by_day[day].append(keys)
+        for day, keys in input_keys_by_day.items():
+            saved_keys[day][key] = np.unique(np.concatenate(keys))
+        outputs = [os.path.relpath(output, folder_path) for source in inputs[path] for output in processed[source][1]]
+        linhas = {linha for source in inputs[path] for linha in processed[source][0].unique('linha')}
+        # Days of all of the input's pings, including the repeats dropped (see find_dependent_inputs)
+        days = set().union(*(input_days(loaded[source]) for source in inputs[path]))
+        manifest['inputs'][key] = dict(make_entry(state['sha256'], STAGE_VERSIONS, outputs, linhas),
+                                       size=state['size'], mtime_ns=state['mtime_ns'], days=sorted(days))
+    manifest['inputs'] = {key: entry for key, entry in manifest['inputs'].items() if key in input_order}
+    for day, keys_by_input in saved_keys.items():
+        save_day_keys(dedup_path, day, keys_by_input)
+
+    # Outlier removal spans all inputs: update the groups the new data touches from their saved state
+    new_batches = [(input_keys[input_path(source)], processed[source][0]) for source in sources
+                   if source in processed and input_path(source) not in failed_inputs]
+    update_cleaned_groups(folder_path, cleaning_path, new_batches, input_order, stale, stale_lines,
+                          routes_path=routes_path, build_routes=build_routes, workers=workers)
+    return [(source[0], message) for source, message in errors]
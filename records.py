@@ -0,0 +1,234 @@
+import numpy as np
+import pandas as pd
+
+# Schema of a GPS record: (field, dtype, missing value), in the feed's key order
+FIELDS = (
+    ('ordem', np.int32, -1),
+    ('latitude', np.float64, np.nan),
+    ('longitude', np.float64, np.nan),
+    ('datahora', np.int64, -1),
+    ('velocidade', np.float64, np.nan),
+    ('linha', np.int32, -1),
+    ('datahoraenvio', np.int64, -1),
+    ('datahoraservidor', np.int64, -1),
+    ('velocidadeReal', np.float64, np.nan),
+    ('diaSemana', np.int8, -1),
+    ('feriado', np.int8, -1),
+)
+
+RECORD_DTYPE = np.dtype([(name, dtype) for name, dtype, _ in FIELDS])
+
+MISSING = {name: missing for name, _, missing in FIELDS}
+
+# Fields stored as int32 codes into a per-batch list of strings
+CATEGORICAL_FIELDS = ('ordem', 'linha')
+
+# Fields written back as the feed's comma-decimal strings
+COORDINATE_FIELDS = ('latitude', 'longitude')
+
+# Fields the feed sends as strings and that are written back as strings
+FEED_STRING_FIELDS = ('datahora', 'velocidade', 'datahoraenvio', 'datahoraservidor')
+
+
+def parse_coordinates(values):
+    """
+    Parse feed coordinates (strings with ',' as decimal separator, or numbers) into floats.
+
+    Args:
+    - values (Iterable): Coordinate values.
+
+    Returns:
+    - np.ndarray: Float array, NaN where a value cannot be parsed.
+    """
+    series = pd.Series(list(values), dtype=object)
+    return pd.to_numeric(series.astype(str).str.replace(',', '.', regex=False), errors='coerce').to_numpy(dtype=np.float64)
+
+
+def format_coordinate(value):
+    """
+    Format a coordinate the way the feed does, with ',' as decimal separator.
+    """
+    return repr(value).replace('.', ',')
+
+
+def format_number(value):
+    """
+    Format a numeric feed field as a string, without a trailing '.0' for whole numbers.
+    """
+    value = float(value)
+    return str(int(value)) if value.is_integer() else repr(value)
+
+
+class RecordBatch:
+    """
+    Compact, schema-backed batch of GPS records.
+
+    Records live in a NumPy structured array (RECORD_DTYPE, about 70 bytes per
+    ping); 'linha' and 'ordem' are dictionary-encoded and numeric fields are
+    parsed once when the batch is built. Missing values use the sentinels in
+    MISSING.
+    """
+
+    __slots__ = ('data', 'categories')
+
+    def __init__(self, data, categories):
+        self.data = data
+        self.categories = categories
+
+    @classmethod
+    def empty(cls):
+        return cls(np.empty(0, dtype=RECORD_DTYPE), {name: [] for name in CATEGORICAL_FIELDS})
+
+    @classmethod
+    def from_dicts(cls, records):
+        """
+        Build a batch from GPS record dictionaries.
+
+        Args:
+        - records (Iterable[Dict]): GPS records, as parsed from the feed or from pipeline outputs.
+
+        Returns:
+        - RecordBatch: The records; empty strings and None become missing values.
+        """
+        records = list(records)
+        data = np.empty(len(records), dtype=RECORD_DTYPE)
+        categories = {}
+
+        for name in CATEGORICAL_FIELDS:
+            values = [record.get(name) for record in records]
+            values = [None if value in (None, '') else str(value) for value in values]
+            codes, uniques = pd.factorize(pd.Series(values, dtype=object), use_na_sentinel=True)
+            data[name] = codes
+            categories[name] = list(uniques)
+
+        for name in COORDINATE_FIELDS:
+            data[name] = parse_coordinates(record.get(name) for record in records)
+
+        for name, dtype, missing in FIELDS:
+            if name in CATEGORICAL_FIELDS or name in COORDINATE_FIELDS:
+                continue
+            if name == 'feriado':
+                values = np.array([np.nan if record.get(name) is None else float(record.get(name) == "Sim")
+                                   for record in records], dtype=np.float64)
+            else:
+                values = parse_coordinates(record.get(name) for record in records)
+            values = np.where(np.isnan(values), missing, values)
+            data[name] = values.astype(dtype) if np.issubdtype(dtype, np.integer) else values
+
+        return cls(data, categories)
+
+    @classmethod
+    def concat(cls, batches):
+        """
+        Concatenate batches, merging their category dictionaries.
+
+        Args:
+        - batches (Iterable[RecordBatch]): Batches to concatenate.
+
+        Returns:
+        - RecordBatch: All records, in order.
+        """
+        batches = [batch for batch in batches if len(batch)]
+        if not batches:
+            return cls.empty()
+        if len(batches) == 1:
+            return batches[0]
+
+        categories = {name: [] for name in CATEGORICAL_FIELDS}
+        lookups = {name: {} for name in CATEGORICAL_FIELDS}
+        parts = []
+        for batch in batches:
+            part = batch.data.copy()
+            for name in CATEGORICAL_FIELDS:
+                remap = np.empty(len(batch.categories[name]) + 1, dtype=np.int32)
+                remap[-1] = -1
+                for code, value in enumerate(batch.categories[name]):
+                    if value not in lookups[name]:
+                        lookups[name][value] = len(categories[name])
+                        categories[name].append(value)
+                    remap[code] = lookups[name][value]
+                part[name] = remap[part[name]]
+            parts.append(part)
+        return cls(np.concatenate(parts), categories)
+
+    def __len__(self):
+        return len(self.data)
+
+    def __getitem__(self, name):
+        return self.data[name]
+
+    def decoded(self, name):
+        """
+        Values of a categorical field as an object array of strings (None where missing).
+        """
+        lookup = np.array(list(self.categories[name]) + [None], dtype=object)
+        return lookup[self.data[name]]
+
+    def unique(self, name):
+        """
+        Distinct values of a categorical field present in the batch.
+        """
+        codes = np.unique(self.data[name])
+        return [self.categories[name][code] for code in codes if code >= 0]
+
+    def take(self, index):
+        """
+        Select records by position or boolean mask, sharing the category dictionaries.
+        """
+        return RecordBatch(self.data[index], self.categories)
+
+    def group_indices(self, *names):
+        """
+        Positions of the records of each distinct key, keys in order of first appearance.
+
+        Args:
+        - names (str): Categorical fields forming the key.
+
+        Returns:
+        - Dict[Tuple[str, ...], np.ndarray]: Record positions of each key, in input order.
+        """
+        if not len(self):
+            return {}
+        keys = pd.DataFrame({name: self.data[name] for name in names})
+        groups = keys.groupby(list(names), sort=False).indices
+        result = {}
+        for codes, index in groups.items():
+            codes = codes if isinstance(codes, tuple) else (codes,)
+            result[tuple(self.categories[name][code] if code >= 0 else None
+                         for name, code in zip(names, codes))] = np.sort(index)
+        return result
+
+    def to_dicts(self, exclude=()):
+        """
+        Convert the batch back to feed-formatted record dictionaries.
+
+        Args:
+        - exclude (Iterable[str]): Fields to leave out.
+
+        Returns:
+        - List[Dict]: One dictionary per record; missing fields are omitted.
+        """
+        columns = []
+        for name, _, missing in FIELDS:
+            if name in exclude:
+                continue
+            if name in CATEGORICAL_FIELDS:
+                values = self.decoded(name).tolist()
+            else:
+                values = self.data[name].tolist()
+                if isinstance(missing, float):
+                    values = [None if value != value else value for value in values]
+                else:
+                    values = [None if value == missing else value for value in values]
+                if name in COORDINATE_FIELDS:
+                    values = [None if value is None else format_coordinate(value) for value in values]
+                elif name in FEED_STRING_FIELDS:
+                    values = [None if value is None else format_number(value) for value in values]
+                elif name == 'feriado':
+                    values = [None if value is None else ("Sim" if value else "Não") for value in values]
+            columns.append((name, values))
+
+        records = []
+        for row in zip(*(values for _, values in columns)):
+            records.append({name: value for (name, _), value in zip(columns, row) if value is not None})
+        return records
@@ -0,0 +1,323 @@
+import os
+import hashlib
+import numpy as np
+import pandas as pd
+from cleaning import project_to_meters, clean_groups, EARTH_RADIUS_M
+
+# Points farther than this from their line's route are outliers
+ROUTE_TOLERANCE_METERS = 111.0
+
+# Grid the route vertices are snapped to, merging the traces of different buses
+ROUTE_SNAP_METERS = 25.0
+
+# Consecutive pings farther apart than this are not joined into a route segment
+ROUTE_MAX_GAP_METERS = 500.0
+
+# Number of traversals a segment needs to be part of the route
+ROUTE_MIN_SUPPORT = 2
+
+# Maximum number of (point, segment) pairs compared at once
+MAX_QUERY_PAIRS = 1 << 20
+
+
+def route_file_path(routes_path, linha):
+    return os.path.join(routes_path, f"route_{linha}.npz")
+
+
+def point_segment_projection(points, starts, ends):
+    """
+    Project planar points onto segments, pairwise over aligned arrays.
+
+    Args:
+    - points (np.ndarray): (n, 2) points.
+    - starts (np.ndarray): (n, 2) segment start points.
+    - ends (np.ndarray): (n, 2) segment end points.
+
+    Returns:
+    - Tuple[np.ndarray, np.ndarray]: Distance of each point to its segment, and the position of the
+      nearest point along the segment (0 at the start, 1 at the end).
+    """
+    direction = ends - starts
+    length2 = np.einsum('ij,ij->i', direction, direction)
+    t = np.zeros(len(points))
+    np.divide(np.einsum('ij,ij->i', points - starts, direction), length2, out=t, where=length2 > 0)
+    t = np.clip(t, 0.0, 1.0)
+    nearest = starts + t[:, None] * direction
+    return np.hypot(*(points - nearest).T), t
+
+
+def point_segment_distances(points, starts, ends):
+    """
+    Distance between planar points and segments, pairwise over aligned arrays.
+    """
+    return point_segment_projection(points, starts, ends)[0]
+
+
+class Route:
+    """
+    Canonical geometry of a bus line, as a set of segments indexed by a uniform grid.
+
+    Each segment is registered in every grid cell (of side tolerance) its
+    bounding box, grown by the tolerance, overlaps; a point within tolerance of
+    a segment therefore finds it in its own cell.
+    """
+
+    __slots__ = ('segments', 'reference_latitude', 'tolerance', '_starts', '_ends', '_cell_keys', '_cell_offsets',
+                 '_cell_segments')
+
+    def __init__(self, segments, reference_latitude, tolerance=ROUTE_TOLERANCE_METERS):
+        """
+        Args:
+        - segments (np.ndarray): (m, 4) segments as start latitude, start longitude, end latitude, end longitude.
+        - reference_latitude (float): Latitude, in radians, of the planar projection.
+        - tolerance (float): Distance, in metres, up to which a point is on the route.
+        """
+        self.segments = np.asarray(segments, dtype=np.float64).reshape(-1, 4)
+        self.reference_latitude = float(reference_latitude)
+        self.tolerance = float(tolerance)
+        self._starts = self.to_meters(self.segments[:, :2])
+        self._ends = self.to_meters(self.segments[:, 2:])
+
+        low = np.floor((np.minimum(self._starts, self._ends) - tolerance) / tolerance).astype(np.int64)
+        high = np.floor((np.maximum(self._starts, self._ends) + tolerance) / tolerance).astype(np.int64)
+        nx, ny = (high - low + 1).T
+        cells_per_segment = nx * ny
+        segment = np.repeat(np.arange(len(self.segments)), cells_per_segment)
+        local = np.arange(cells_per_segment.sum()) - np.repeat(np.cumsum(cells_per_segment) - cells_per_segment,
+                                                               cells_per_segment)
+        keys = self._cell_key(low[segment, 0] + local // ny[segment], low[segment, 1] + local % ny[segment])
+
+        order = np.argsort(keys, kind='stable')
+        self._cell_keys, starts = np.unique(keys[order], return_index=True)
+        self._cell_offsets = np.append(starts, len(order))
+        self._cell_segments = segment[order]
+
+    @staticmethod
+    def _cell_key(cx, cy):
+        return cx * (1 << 32) + cy
+
+    def to_meters(self, coordinates):
+        return project_to_meters(coordinates, reference_latitude=self.reference_latitude)
+
+    def nearest(self, coordinates):
+        """
+        Nearest route segment of each point.
+
+        Args:
+        - coordinates (np.ndarray): (n, 2) array of latitude and longitude.
+
+        Returns:
+        - Tuple[np.ndarray, np.ndarray, np.ndarray]: Distance in metres to the nearest segment (inf when no
+          segment is within tolerance), its index (-1 when none) and the position along it (0 to 1).
+        """
+        distances = np.full(len(coordinates), np.inf)
+        segments = np.full(len(coordinates), -1, dtype=np.int64)
+        along = np.zeros(len(coordinates))
+        if not len(self._cell_keys):
+            return distances, segments, along
+        points = self.to_meters(coordinates)
+        valid = np.flatnonzero(np.all(np.isfinite(points), axis=1))
+        cells = np.floor(points[valid] / self.tolerance).astype(np.int64)
+        keys = self._cell_key(cells[:, 0], cells[:, 1])
+        slot = np.minimum(np.searchsorted(self._cell_keys, keys), len(self._cell_keys) - 1)
+        found = self._cell_keys[slot] == keys
+        valid, slot = valid[found], slot[found]
+        first = self._cell_offsets[slot]
+        count = self._cell_offsets[slot + 1] - first
+        if not len(valid):
+            return distances, segments, along
+
+        # Compare points with the segments of their cell, a block of points at a time
+        block_size = max(1, MAX_QUERY_PAIRS // int(count.max()))
+        for block_start in range(0, len(valid), block_size):
+            block = slice(block_start, block_start + block_size)
+            point = np.repeat(valid[block], count[block])
+            offset = np.arange(len(point)) - np.repeat(np.cumsum(count[block]) - count[block], count[block])
+            segment = self._cell_segments[np.repeat(first[block], count[block]) + offset]
+            pair_distances, pair_along = point_segment_projection(points[point], self._starts[segment],
+                                                                  self._ends[segment])
+
+            # Closest pair of each point (pairs are grouped by point)
+            order = np.lexsort((pair_distances, point))
+            best = order[np.flatnonzero(np.diff(point[order], prepend=-1))]
+            distances[point[best]] = pair_distances[best]
+            segments[point[best]] = segment[best]
+            along[point[best]] = pair_along[best]
+        return distances, segments, along
+
+    def distance(self, coordinates):
+        """
+        Distance, in metres, from each point to the route.
+
+        Args:
+        - coordinates (np.ndarray): (n, 2) array of latitude and longitude.
+
+        Returns:
+        - np.ndarray: Distance to the nearest segment, or inf when no segment is within tolerance.
+        """
+        return self.nearest(coordinates)[0]
+
+    def on_route(self, coordinates):
+        """
+        Boolean mask of the points within tolerance of the route.
+        """
+        return self.distance(coordinates) <= self.tolerance
+
+    def digest(self):
+        """
+        Hash of the route's geometry and tolerance, identifying the route a point was checked against.
+        """
+        digest = hashlib.sha256(self.segments.tobytes())
+        digest.update(np.array([self.reference_latitude, self.tolerance]).tobytes())
+        return digest.hexdigest()
+
+
+def build_route(latitude, longitude, datahora, ordem, snap_meters=ROUTE_SNAP_METERS,
+                max_gap_meters=ROUTE_MAX_GAP_METERS, min_support=ROUTE_MIN_SUPPORT):
+    """
+    Build the canonical geometry of a line from its buses' traces.
+
+    Consecutive pings of the same bus become segments; their ends are snapped
+    to a grid so that traces of different buses and trips coincide, and
+    segments traversed at least min_support times are kept.
+
+    Args:
+    - latitude (np.ndarray): Latitudes in degrees, outliers already removed.
+    - longitude (np.ndarray): Longitudes in degrees.
+    - datahora (np.ndarray): Timestamps in milliseconds.
+    - ordem (np.ndarray): Vehicle identifiers (or their codes).
+    - snap_meters (float): Side of the snapping grid in metres.
+    - max_gap_meters (float): Longest segment in metres.
+    - min_support (int): Traversals needed to keep a segment; if none reaches it, every segment is kept.
+
+    Returns:
+    - Route: The line's route, or None if there are no segments.
+    """
+    coordinates = np.column_stack((latitude, longitude))
+    valid = np.all(np.isfinite(coordinates), axis=1)
+    if not np.any(valid):
+        return None
+    reference_latitude = float(np.mean(np.radians(coordinates[valid, 0])))
+
+    ordem_codes = pd.factorize(np.asarray(ordem)[valid])[0]
+    order = np.lexsort((np.asarray(datahora)[valid], ordem_codes))
+    points = project_to_meters(coordinates[valid][order], reference_latitude=reference_latitude)
+    cells = np.round(points / snap_meters).astype(np.int64)
+    codes = ordem_codes[order]
+
+    start, end = cells[:-1], cells[1:]
+    length = np.hypot(*((end - start) * snap_meters).T)
+    keep = (codes[1:] == codes[:-1]) & (length > 0) & (length <= max_gap_meters)
+    if not np.any(keep):
+        return None
+
+    # Undirected segments, so that both directions of a trip support the same segment
+    pairs = np.concatenate((start[keep], end[keep]), axis=1)
+    swap = (pairs[:, 0] > pairs[:, 2]) | ((pairs[:, 0] == pairs[:, 2]) & (pairs[:, 1] > pairs[:, 3]))
+    pairs[swap] = pairs[swap][:, [2, 3, 0, 1]]
+    pairs, support = np.unique(pairs, axis=0, return_counts=True)
+    if np.any(support >= min_support):
+        pairs = pairs[support >= min_support]
+
+    # Back to degrees, inverting project_to_meters
+    meters = pairs.astype(np.float64) * snap_meters
+    lat = np.degrees(meters[:, [1, 3]] / EARTH_RADIUS_M)
+    lon = np.degrees(meters[:, [0, 2]] / (EARTH_RADIUS_M * np.cos(reference_latitude)))
+    segments = np.column_stack((lat[:, 0], lon[:, 0], lat[:, 1], lon[:, 1]))
+    return Route(segments, reference_latitude)
+
+
+def build_routes(batch, linhas=None, workers=1):
+    """
+    Build the route of each line from a batch of historical records.
+
+    The main route of every (ordem, linha) group is found by clustering
+    (cleaning.find_main_route) and the remaining pings of each line are
+    joined into its route.
+
+    Args:
+    - batch (RecordBatch): GPS records.
+    - linhas (Iterable[str]): Lines to build, or None for every line in the batch.
+    - workers (int): Number of worker processes for the clustering.
+
+    Returns:
+    - Dict[str, Route]: Route of each line that has one.
+    """
+    linhas = set(batch.unique('linha') if linhas is None else linhas)
+    grouped = {key: index for key, index in batch.group_indices('ordem', 'linha').items() if key[1] in linhas}
+    kept = {}
+    for (_, linha), index in clean_groups(batch, grouped, workers=workers):
+        kept.setdefault(linha, []).append(index)
+
+    routes = {}
+    for linha, indices in kept.items():
+        index = np.sort(np.concatenate(indices))
+        route = build_route(batch['latitude'][index], batch['longitude'][index], batch['datahora'][index],
+                            batch['ordem'][index])
+        if route is not None:
+            routes[linha] = route
+    return routes
+
+
+def save_routes(routes_path, routes):
+    """
+    Persist routes as 'route_<linha>.npz' files in a folder.
+
+    Args:
+    - routes_path (str): Folder of the route catalogue.
+    - routes (Dict[str, Route]): Routes to write.
+    """
+    os.makedirs(routes_path, exist_ok=True)
+    for linha, route in routes.items():
+        temp_path = route_file_path(routes_path, linha) + ".tmp.npz"
+        np.savez(temp_path, segments=route.segments, reference_latitude=route.reference_latitude)
+        os.replace(temp_path, route_file_path(routes_path, linha))
+        print(f"Route for line {linha} saved with {len(route.segments)} segments.")
+
+
+def load_routes(routes_path, linhas=None):
+    """
+    Load routes from the catalogue folder.
+
+    Args:
+    - routes_path (str): Folder of the route catalogue.
+    - linhas (Iterable[str]): Lines to load, or None for every line in the catalogue.
+
+    Returns:
+    - Dict[str, Route]: Route of each requested line found in the catalogue.
+    """
+    if not os.path.isdir(routes_path):
+        return {}
+    if linhas is None:
+        linhas = [file_name[len("route_"):-len(".npz")] for file_name in os.listdir(routes_path)
+                  if file_name.startswith("route_") and file_name.endswith(".npz") and ".tmp" not in file_name]
+
+    routes = {}
+    for linha in linhas:
+        file_path = route_file_path(routes_path, linha)
+        if os.path.exists(file_path):
+            with np.load(file_path) as route_file:
+                routes[linha] = Route(route_file['segments'], route_file['reference_latitude'])
+    return routes
+
+
+def update_route_catalogue(routes_path, batch, workers=1):
+    """
+    Build and persist the routes of the lines in a batch that do not have one yet.
+
+    Args:
+    - routes_path (str): Folder of the route catalogue.
+    - batch (RecordBatch): Historical GPS records.
+    - workers (int): Number of worker processes for the clustering.
+
+    Returns:
+    - Dict[str, Route]: Routes of every line in the batch that has one.
+    """
+    linhas = batch.unique('linha')
+    routes = load_routes(routes_path, linhas)
+    missing = [linha for linha in linhas if linha not in routes]
+    if missing:
+        new_routes = build_routes(batch, missing, workers=workers)
+        save_routes(routes_path, new_routes)
+        routes.update(new_routes)
+    return routes
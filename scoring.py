@@ -0,0 +1,289 @@
+import os
+import json
+import argparse
+import numpy as np
+import pandas as pd
+from cleaning import haversine_meters
+from records import parse_coordinates
+from store import chunk_names, read_dataframe
+from testModels import read_test_queries
+
+GROUND_TRUTH_VERSION = 1
+GROUND_TRUTH_FILE = 'ground_truth.npz'
+
+# Kinds of query: position at a datahora, or datahora at a position
+KIND_COORDS = 0
+KIND_TIMESTAMP = 1
+
+# Coordinates are matched at micro-degree precision (about 0.1 m), the precision of the feed
+COORDINATE_SCALE = 1e6
+
+PING_COLUMNS = ['ordem', 'datahora', 'latitude', 'longitude']
+
+
+def read_truth_pings(store_path, folder_path, linhas):
+    """
+    Pings of the given lines in the test data, from the columnar store when it exists,
+    or else from the '_sorted.json' files.
+
+    Returns:
+    - pd.DataFrame: 'ordem' (str), 'datahora' (int64 ms), 'latitude' and 'longitude', sorted by datahora.
+    """
+    linhas = set(linhas)
+    if chunk_names(store_path):
+        data = read_dataframe(store_path, columns=PING_COLUMNS, linhas=linhas)
+        data = pd.DataFrame({'ordem': data['ordem'].astype(str).to_numpy(),
+                             'datahora': data['datahora'].to_numpy(dtype=np.int64),
+                             'latitude': data['latitude'].to_numpy(dtype=np.float64),
+                             'longitude': data['longitude'].to_numpy(dtype=np.float64)})
+    else:
+        records = []
+        for root, _, files in os.walk(folder_path):
+            for file_name in sorted(files):
+                if not file_name.endswith('_sorted.json'):
+                    continue
+                with open(os.path.join(root, file_name), 'r', encoding='utf-8') as json_file:
+                    records.extend(record for record in json.load(json_file) if str(record.get('linha')) in linhas)
+        data = pd.DataFrame({
+            'ordem': [str(record.get('ordem')) for record in records],
+            'datahora': pd.to_numeric(pd.Series([record.get('datahora') for record in records], dtype=object),
+                                      errors='coerce').to_numpy(dtype=np.float64),
+            'latitude': parse_coordinates(record.get('latitude') for record in records),
+            'longitude': parse_coordinates(record.get('longitude') for record in records),
+        })
+        data = data[np.isfinite(data['datahora'])].astype({'datahora': np.int64})
+    data = data[(data['datahora'] >= 0) & np.isfinite(data['latitude']) & np.isfinite(data['longitude'])]
+    return data.sort_values('datahora', kind='stable').reset_index(drop=True)
+
+
+def coordinate_keys(latitude, longitude):
+    return np.round(latitude * COORDINATE_SCALE).astype(np.int64), np.round(longitude * COORDINATE_SCALE).astype(np.int64)
+
+
+def parse_numbers(values, coordinates=False):
+    """
+    Parse a list of values into floats, NaN where missing or invalid. Plain numbers take a fast
+    path; anything else (e.g. coordinates with ',' as decimal separator) is parsed value by value.
+    """
+    try:
+        return np.array(values, dtype=np.float64)
+    except (TypeError, ValueError):
+        if coordinates:
+            return parse_coordinates(values)
+        return pd.to_numeric(pd.Series(values, dtype=object), errors='coerce').to_numpy(dtype=np.float64)
+
+
+def error_summary(errors):
+    """
+    Aggregates of absolute errors: count, mean, median, 90th percentile, RMSE and maximum.
+    """
+    if not len(errors):
+        return {'count': 0}
+    return {
+        'count': int(len(errors)),
+        'mean': float(np.mean(errors)),
+        'median': float(np.median(errors)),
+        'p90': float(np.percentile(errors, 90)),
+        'rmse': float(np.sqrt(np.mean(errors ** 2))),
+        'max': float(np.max(errors)),
+    }
+
+
+class GroundTruth:
+    """
+    True answer of each test query, in arrays sorted by query id.
+
+    Position queries (a datahora) hold the true latitude and longitude, and datahora
+    queries (a position) the true datahora. Scoring a submission looks its ids up with
+    one searchsorted and computes every error at once.
+    """
+
+    def __init__(self, ids, kinds, latitude, longitude, datahora, sources=()):
+        order = np.argsort(ids, kind='stable')
+        self.ids = np.asarray(ids, dtype=np.int64)[order]
+        self.kinds = np.asarray(kinds, dtype=np.int8)[order]
+        self.latitude = np.asarray(latitude, dtype=np.float64)[order]
+        self.longitude = np.asarray(longitude, dtype=np.float64)[order]
+        self.datahora = np.asarray(datahora, dtype=np.int64)[order]
+        self.sources = list(sources)
+
+    def __len__(self):
+        return len(self.ids)
+
+    @classmethod
+    def build(cls, queries, pings, sources=()):
+        """
+        Match each query to the test ping it was taken from: by (ordem, datahora) for position
+        queries, and by (ordem, position) for datahora queries, taking the earliest ping when
+        the bus stood still. Queries without an integer id or a matching ping are left out.
+
+        Args:
+        - queries (List[Tuple]): Queries as returned by testModels.read_test_queries.
+        - pings (pd.DataFrame): Test pings, as returned by read_truth_pings.
+        """
+        ids = pd.to_numeric(pd.Series([query[0] for query in queries], dtype=object), errors='coerce')
+        frame = pd.DataFrame({
+            'id': ids.to_numpy(dtype=np.float64),
+            'kind': [KIND_COORDS if query[2] == 'coords' else KIND_TIMESTAMP for query in queries],
+            'ordem': [str(query[1].get('ordem')) for query in queries],
+        })
+        frame = frame[np.isfinite(frame['id']) & (frame['id'] == np.round(frame['id']))]
+        frame = frame[~frame['id'].duplicated()]
+        positions = frame.index.to_numpy()
+
+        coords = frame['kind'].to_numpy() == KIND_COORDS
+        datahora = pd.to_numeric(pd.Series([queries[i][1].get('datahora') for i in positions[coords]], dtype=object),
+                                 errors='coerce').to_numpy(dtype=np.float64)
+        by_time = frame[coords].assign(datahora=datahora).dropna(subset=['datahora'])
+        by_time = by_time.astype({'datahora': np.int64}).merge(
+            pings.drop_duplicates(['ordem', 'datahora']), on=['ordem', 'datahora'], how='inner')
+
+        latitude_key, longitude_key = coordinate_keys(
+            parse_coordinates(queries[i][1].get('latitude') for i in positions[~coords]),
+            parse_coordinates(queries[i][1].get('longitude') for i in positions[~coords]))
+        by_position = frame[~coords].assign(latitude_key=latitude_key, longitude_key=longitude_key)
+        keyed = pings.assign(**dict(zip(('latitude_key', 'longitude_key'),
+                                        coordinate_keys(pings['latitude'].to_numpy(), pings['longitude'].to_numpy()))))
+        by_position = by_position.merge(keyed.drop_duplicates(['ordem', 'latitude_key', 'longitude_key']),
+                                        on=['ordem', 'latitude_key', 'longitude_key'], how='inner')
+
+        matched = pd.concat([by_time, by_position], ignore_index=True)
+        return cls(matched['id'].to_numpy(dtype=np.int64), matched['kind'].to_numpy(),
+                   np.where(matched['kind'] == KIND_COORDS, matched['latitude'], np.nan),
+                   np.where(matched['kind'] == KIND_COORDS, matched['longitude'], np.nan),
+                   np.where(matched['kind'] == KIND_TIMESTAMP, matched['datahora'], -1), sources)
+
+    def save(self, path):
+        np.savez(path, version=GROUND_TRUTH_VERSION, ids=self.ids, kinds=self.kinds, latitude=self.latitude,
+                 longitude=self.longitude, datahora=self.datahora, sources=json.dumps(self.sources))
+
+    @classmethod
+    def load(cls, path):
+        """
+        Load a saved ground truth; returns None if the file is missing or from another version.
+        """
+        if not os.path.exists(path):
+            return None
+        with np.load(path) as data:
+            if int(data['version']) != GROUND_TRUTH_VERSION:
+                return None
+            return cls(data['ids'], data['kinds'], data['latitude'], data['longitude'], data['datahora'],
+                       json.loads(str(data['sources'])))
+
+    def score(self, previsoes):
+        """
+        Score the predictions of a submission.
+
+        Position predictions are scored by their great-circle distance to the true position,
+        in metres, and datahora predictions by their absolute error, in seconds. Only the first
+        prediction of an id is scored; predictions with an unknown id, or without the fields
+        their query asks for, are counted but not scored.
+
+        Args:
+        - previsoes (List[Dict]): Predictions, as in resposta.json.
+
+        Returns:
+        - Dict: Counts and error aggregates ('coordinates_m', 'datahora_s').
+        """
+        records = [previsao if isinstance(previsao, dict) else {} for previsao in previsoes]
+        ids = parse_numbers([record.get('id') for record in records])
+        latitude = parse_numbers([record.get('latitude') for record in records], coordinates=True)
+        longitude = parse_numbers([record.get('longitude') for record in records], coordinates=True)
+        datahora = parse_numbers([record.get('datahora') for record in records])
+
+        valid = np.isfinite(ids) & (ids == np.round(ids))
+        keys = np.where(valid, ids, -1).astype(np.int64)
+        positions = np.zeros(len(keys), dtype=np.intp)
+        found = np.zeros(len(keys), dtype=bool)
+        kinds = np.full(len(keys), -1, dtype=np.int8)
+        if len(self.ids):
+            positions = np.minimum(np.searchsorted(self.ids, keys), len(self.ids) - 1)
+            found = valid & (self.ids[positions] == keys)
+            kinds = self.kinds[positions]
+
+        first = np.zeros(len(keys), dtype=bool)
+        first[np.flatnonzero(found)[np.unique(keys[found], return_index=True)[1]]] = True
+
+        coords = first & (kinds == KIND_COORDS) & np.isfinite(latitude) & np.isfinite(longitude)
+        timestamps = first & (kinds == KIND_TIMESTAMP) & np.isfinite(datahora)
+
+        distances = haversine_meters(latitude[coords], longitude[coords],
+                                     self.latitude[positions[coords]], self.longitude[positions[coords]])
+        seconds = np.abs(datahora[timestamps] - self.datahora[positions[timestamps]]) / 1000.0
+        return {
+            'predictions': len(records),
+            'scored': int(coords.sum() + timestamps.sum()),
+            'unknown_ids': int(len(records) - found.sum()),
+            'duplicates': int(found.sum() - first.sum()),
+            'invalid': int(first.sum() - coords.sum() - timestamps.sum()),
+            'queries': len(self),
+            'coordinates_m': error_summary(distances),
+            'datahora_s': error_summary(seconds),
+        }
+
+
+def source_signature(paths):
+    return [[path, os.stat(path).st_size, os.stat(path).st_mtime_ns] for path in sorted(paths)]
+
+
+def truth_sources(query_path, store_path, folder_path):
+    """
+    Files the ground truth is built from: the query files and the test data (store manifest or '_sorted.json' files).
+    """
+    paths = []
+    for directory, suffix in ((query_path, '.json'), (folder_path, '_sorted.json')):
+        for root, _, files in os.walk(directory):
+            paths.extend(os.path.join(root, file_name) for file_name in files
+                         if file_name.endswith(suffix) and (suffix != '.json' or file_name.startswith('teste-')))
+    manifest_path = os.path.join(store_path, 'manifest.json')
+    if os.path.exists(manifest_path):
+        paths.append(manifest_path)
+    return source_signature(paths)
+
+
+def load_ground_truth(query_path, store_path, folder_path, cache_path=None):
+    """
+    Load the ground truth saved in cache_path, or build (and save) it again when the query
+    files or the test data changed since.
+
+    Args:
+    - query_path (str): Folder with the 'teste-*.json' query files.
+    - store_path (str): Columnar store of the test data.
+    - folder_path (str): Test data folder, used when there is no store.
+    - cache_path (str): Where the ground truth is saved; defaults to query_path/GROUND_TRUTH_FILE.
+
+    Returns:
+    - GroundTruth: The ground truth (empty if there are no queries).
+    """
+    cache_path = cache_path or os.path.join(query_path, GROUND_TRUTH_FILE)
+    sources = truth_sources(query_path, store_path, folder_path)
+    truth = GroundTruth.load(cache_path)
+    if truth is not None and truth.sources == sources:
+        return truth
+
+    queries = read_test_queries(query_path)
+    pings = read_truth_pings(store_path, folder_path, {str(query[1].get('linha')) for query in queries})
+    truth = GroundTruth.build(queries, pings, sources)
+    truth.save(cache_path)
+    return truth
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Score a resposta.json submission against the test data.")
+    parser.add_argument('submission', nargs='?', default='resposta.json', help="Submission file (default: resposta.json).")
+    parser.add_argument('--queries', default='dataTestEnd', help="Folder with the teste-*.json query files.")
+    parser.add_argument('--store', default=os.path.join('store', 'dataTest'), help="Columnar store of the test data.")
+    parser.add_argument('--data', default='dataTest', help="Test data folder, used when there is no store.")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    truth = load_ground_truth(args.queries, args.store, args.data)
+    with open(args.submission, 'r', encoding='utf-8') as file:
+        submission = json.load(file)
+    print(json.dumps(truth.score(submission.get('previsoes', [])), indent=4))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,295 @@
+import os
+import json
+import shutil
+import hashlib
+import numpy as np
+import pandas as pd
+from records import RecordBatch
+from localcalendar import LOCAL_TIMEZONE
+
+# Typed columns of the store and the value used when a record lacks the field
+COLUMNS = {
+    'latitude': (np.float64, np.nan),
+    'longitude': (np.float64, np.nan),
+    'datahora': (np.int64, -1),
+    'velocidade': (np.float64, np.nan),
+    'velocidadeReal': (np.float64, np.nan),
+    'diaSemana': (np.int8, -1),
+    'feriado': (np.int8, -1),
+}
+
+# Columns stored as dictionary codes plus a list of categories
+CATEGORICAL_COLUMNS = ('ordem',)
+
+META_FILE = 'meta.json'
+
+
+def local_days(datahora):
+    """
+    Local calendar day ('YYYY-MM-DD') of each millisecond timestamp.
+    """
+    local = pd.to_datetime(datahora, unit='ms', utc=True).tz_convert(LOCAL_TIMEZONE).normalize()
+    codes, uniques = pd.factorize(local)
+    return np.asarray(uniques.strftime('%Y-%m-%d'), dtype=object)[codes]
+
+
+def partition_path(store_path, day, linha):
+    """
+    Directory holding the chunks of one (day, linha) partition.
+    """
+    return os.path.join(store_path, f"day={day}", f"linha={linha}")
+
+
+def write_partitions(store_path, batch, chunk_name):
+    """
+    Write GPS records to the store, partitioned by local day and 'linha'.
+
+    Each partition receives a chunk directory named after the source of the
+    records; writing the same source again replaces all of its previous chunks.
+
+    Args:
+    - store_path (str): Root folder of the store.
+    - batch (RecordBatch): GPS records with 'datahora' and 'linha'.
+    - chunk_name (str): Name identifying the source of the records.
+
+    Returns:
+    - List[str]: Chunk directories written.
+    """
+    for _, _, _, chunk_dir in list(iter_chunks(store_path, chunks=[chunk_name])):
+        shutil.rmtree(chunk_dir)
+
+    batch = batch.take((batch['datahora'] >= 0) & (batch['linha'] >= 0))
+    if not len(batch):
+        return []
+
+    keys = pd.DataFrame({'day': local_days(batch['datahora']), 'linha': batch.decoded('linha')})
+    decoded = {name: batch.decoded(name) for name in CATEGORICAL_COLUMNS}
+
+    written = []
+    for (day, linha), index in keys.groupby(['day', 'linha'], sort=True).indices.items():
+        chunk_dir = os.path.join(partition_path(store_path, day, linha), chunk_name)
+        os.makedirs(chunk_dir)
+
+        meta = {'rows': int(len(index)), 'categories': {}}
+        digest = hashlib.sha256()
+        for name, (dtype, _) in COLUMNS.items():
+            values = batch[name][index].astype(dtype)
+            np.save(os.path.join(chunk_dir, f"{name}.npy"), values)
+            digest.update(values.tobytes())
+        for name in CATEGORICAL_COLUMNS:
+            codes, categories = pd.factorize(pd.Series(decoded[name][index], dtype=object), sort=True)
+            np.save(os.path.join(chunk_dir, f"{name}.npy"), codes.astype(np.int32))
+            meta['categories'][name] = list(categories)
+            digest.update(codes.astype(np.int32).tobytes())
+            digest.update(json.dumps(meta['categories'][name], ensure_ascii=False).encode('utf-8'))
+        meta['sha256'] = digest.hexdigest()
+
+        with open(os.path.join(chunk_dir, META_FILE), 'w', encoding='utf-8') as meta_file:
+            json.dump(meta, meta_file, ensure_ascii=False)
+        written.append(chunk_dir)
+    return written
+
+
+def iter_chunks(store_path, days=None, linhas=None, chunks=None):
+    """
+    Iterate over the chunk directories of the store, pruning by partition.
+
+    Args:
+    - store_path (str): Root folder of the store.
+    - days (Iterable[str]): Days to keep ('YYYY-MM-DD'), or None for all.
+    - linhas (Iterable[str]): Lines to keep, or None for all.
+    - chunks (Iterable[str]): Chunk names to keep, or None for all.
+
+    Returns:
+    - Iterator[Tuple[str, str, str, str]]: Day, linha, chunk name and chunk directory.
+    """
+    if not os.path.isdir(store_path):
+        return
+    days = None if days is None else set(days)
+    linhas = None if linhas is None else set(map(str, linhas))
+    chunks = None if chunks is None else set(chunks)
+
+    for day_dir in sorted(os.listdir(store_path)):
+        day = day_dir.partition('=')[2]
+        if not day_dir.startswith('day=') or (days is not None and day not in days):
+            continue
+        day_path = os.path.join(store_path, day_dir)
+        for line_dir in sorted(os.listdir(day_path)):
+            linha = line_dir.partition('=')[2]
+            if not line_dir.startswith('linha=') or (linhas is not None and linha not in linhas):
+                continue
+            line_path = os.path.join(day_path, line_dir)
+            for chunk_name in sorted(os.listdir(line_path)):
+                if chunks is not None and chunk_name not in chunks:
+                    continue
+                yield day, linha, chunk_name, os.path.join(line_path, chunk_name)
+
+
+def remove_chunk(chunk_dir):
+    """
+    Remove a chunk directory, and its 'linha=' and 'day=' partitions once they are empty.
+    """
+    shutil.rmtree(chunk_dir, ignore_errors=True)
+    partition = os.path.dirname(chunk_dir)
+    for prefix in ('linha=', 'day='):
+        if not os.path.basename(partition).startswith(prefix):
+            break
+        try:
+            os.rmdir(partition)
+        except OSError:
+            break  # Not empty
+        partition = os.path.dirname(partition)
+
+
+def read_chunk(chunk_dir, columns=None, mmap=True):
+    """
+    Read the requested columns of a chunk, memory-mapping them by default.
+
+    Args:
+    - chunk_dir (str): Chunk directory.
+    - columns (Iterable[str]): Columns to read, or None for all.
+    - mmap (bool): Memory-map the column files instead of loading them.
+
+    Returns:
+    - Tuple[Dict[str, np.ndarray], Dict]: Column arrays (codes for categorical columns) and chunk metadata.
+    """
+    with open(os.path.join(chunk_dir, META_FILE), 'r', encoding='utf-8') as meta_file:
+        meta = json.load(meta_file)
+    if columns is None:
+        columns = list(COLUMNS) + list(CATEGORICAL_COLUMNS)
+    mmap_mode = 'r' if mmap else None
+    arrays = {name: np.load(os.path.join(chunk_dir, f"{name}.npy"), mmap_mode=mmap_mode) for name in columns}
+    return arrays, meta
+
+
+def read_dataframe(store_path, columns=None, days=None, linhas=None, chunks=None, chunk_dirs=None):
+    """
+    Read the selected columns and partitions of the store into a DataFrame.
+
+    'linha' and 'ordem' are returned as pandas categoricals.
+
+    Args:
+    - store_path (str): Root folder of the store.
+    - columns (Iterable[str]): Columns to read, or None for all. 'linha' is always included.
+    - days (Iterable[str]): Days to keep, or None for all.
+    - linhas (Iterable[str]): Lines to keep, or None for all.
+    - chunks (Iterable[str]): Chunk names to keep, or None for all.
+    - chunk_dirs (Iterable[Tuple[str, str, str, str]]): Chunk directories already listed, as yielded by
+      iter_chunks (or grouped by group_chunks), read instead of walking the store; the filters are ignored.
+
+    Returns:
+    - pd.DataFrame: The selected data.
+    """
+    columns = list(COLUMNS) + list(CATEGORICAL_COLUMNS) if columns is None else [c for c in columns if c != 'linha']
+    if chunk_dirs is None:
+        chunk_dirs = iter_chunks(store_path, days, linhas, chunks)
+    frames = []
+    for day, linha, _, chunk_dir in chunk_dirs:
+        arrays, meta = read_chunk(chunk_dir, columns)
+        frame = {}
+        for name in columns:
+            if name in CATEGORICAL_COLUMNS:
+                frame[name] = pd.Categorical.from_codes(arrays[name], meta['categories'][name])
+            else:
+                frame[name] = arrays[name]
+        frame = pd.DataFrame(frame)
+        frame['linha'] = linha
+        frames.append(frame)
+
+    if not frames:
+        return pd.DataFrame(columns=columns + ['linha'])
+    data = pd.concat(frames, ignore_index=True)
+    for name in CATEGORICAL_COLUMNS:
+        if name in data.columns:
+            data[name] = data[name].astype('category')
+    data['linha'] = data['linha'].astype('category')
+    return data
+
+
+def chunk_names(store_path):
+    """
+    Names of all chunks in the store, one per source file.
+    """
+    return sorted({chunk_name for _, _, chunk_name, _ in iter_chunks(store_path)})
+
+
+def group_chunks(store_path, days=None, linhas=None):
+    """
+    Chunk directories of the store grouped by chunk name, listed in a single walk.
+
+    Reading each source with read_dataframe(chunks=[name]) walks every
+    partition once per source; the groups can be passed to read_dataframe as
+    chunk_dirs instead.
+
+    Args:
+    - store_path (str): Root folder of the store.
+    - days (Iterable[str]): Days to keep, or None for all.
+    - linhas (Iterable[str]): Lines to keep, or None for all.
+
+    Returns:
+    - Dict[str, List[Tuple[str, str, str, str]]]: The (day, linha, chunk name, chunk directory) of each
+      chunk name, by chunk name in sorted order.
+    """
+    grouped = {}
+    for entry in iter_chunks(store_path, days, linhas):
+        grouped.setdefault(entry[2], []).append(entry)
+    return dict(sorted(grouped.items()))
+
+
+def chunk_digests(store_path):
+    """
+    Content digest of each chunk name of the store, over all of its partitions.
+
+    Only the metadata files are read: write_partitions records the digest of
+    each chunk directory's columns. Chunks written before that are hashed from
+    their column files.
+
+    Args:
+    - store_path (str): Root folder of the store.
+
+    Returns:
+    - Dict[str, str]: Hexadecimal digest of each chunk name.
+    """
+    partitions = {}
+    for day, linha, chunk_name, chunk_dir in iter_chunks(store_path):
+        with open(os.path.join(chunk_dir, META_FILE), 'r', encoding='utf-8') as meta_file:
+            digest = json.load(meta_file).get('sha256')
+        if digest is None:
+            files = hashlib.sha256()
+            for file_name in sorted(os.listdir(chunk_dir)):
+                with open(os.path.join(chunk_dir, file_name), 'rb') as chunk_file:
+                    files.update(chunk_file.read())
+            digest = files.hexdigest()
+        partitions.setdefault(chunk_name, []).append(f"{day}/{linha}/{digest}")
+    return {name: hashlib.sha256("\n".join(items).encode('utf-8')).hexdigest() for name, items in partitions.items()}
+
+
+def chunk_name_for(folder_path, file_path):
+    """
+    Chunk name for a source file: its path relative to the data folder, without extension.
+    """
+    relative_path = os.path.relpath(os.path.splitext(file_path)[0], folder_path)
+    return relative_path.replace(os.sep, '__')
+
+
+def build_store(folder_path, store_path):
+    """
+    Build the store from the '_sorted.json' files of a data folder.
+
+    Args:
+    - folder_path (str): Folder containing '_sorted.json' files.
+    - store_path (str): Root folder of the store.
+    """
+    for root, _, files in os.walk(folder_path):
+        for file_name in sorted(files):
+            if not file_name.endswith("_sorted.json"):
+                continue
+            file_path = os.path.join(root, file_name)
+            try:
+                with open(file_path, 'r', encoding='utf-8') as json_file:
+                    data = json.load(json_file)
+            except json.JSONDecodeError as e:
+                print(f"Error decoding JSON in file {file_path}: {e}")
+                continue
+            chunk_name = chunk_name_for(folder_path, file_path[:-len("_sorted.json")] + ".json")
+            write_partitions(store_path, RecordBatch.from_dicts(data), chunk_name)
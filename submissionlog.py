@@ -0,0 +1,332 @@
+import os
+import json
+import hashlib
+import queue
+import argparse
+import threading
+from concurrent.futures import Future
+
+# Segment files: submissions-000001.log, submissions-000002.log, ...
+SEGMENT_PREFIX = 'submissions-'
+SEGMENT_SUFFIX = '.log'
+
+# A new segment is started once the current one would pass this size
+SEGMENT_MAX_BYTES = 64 * 1024 * 1024
+
+# Submissions written (and fsynced) together at most
+MAX_BATCH_RECORDS = 1000
+
+
+def segment_paths(log_path):
+    """
+    Segment files of a log folder, oldest first.
+    """
+    if not os.path.isdir(log_path):
+        return []
+    names = sorted(name for name in os.listdir(log_path)
+                   if name.startswith(SEGMENT_PREFIX) and name.endswith(SEGMENT_SUFFIX))
+    return [os.path.join(log_path, name) for name in names]
+
+
+def segment_number(path):
+    return int(os.path.basename(path)[len(SEGMENT_PREFIX):-len(SEGMENT_SUFFIX)])
+
+
+def submission_filename(data):
+    """
+    File name of a submission when exported: '{aluno}_{datahora}.json', or
+    '{aluno}_{datahora}_parte{i}de{n}.json' for a submission sent in parts.
+    """
+    if 'parte' in data:
+        return f'{data["aluno"]}_{data["datahora"]}_parte{data["parte"]}de{data.get("partes", "?")}.json'
+    return f'{data["aluno"]}_{data["datahora"]}.json'
+
+
+def submission_key(data):
+    """
+    Idempotency key of a submission: ('aluno', 'datahora', 'parte') and a hash of the whole
+    payload. A part sent again unchanged, e.g. retried after a lost response, has the same
+    key as the first copy; a corrected one does not, and is written again.
+    """
+    payload = json.dumps(data, ensure_ascii=False, sort_keys=True, separators=(',', ':')).encode('utf-8')
+    return (str(data.get('aluno')), str(data.get('datahora')), str(data.get('parte', '')),
+            hashlib.sha256(payload).hexdigest())
+
+
+def write_submission_file(output_path, data):
+    """
+    Write a submission as its own indented JSON file, as /rest/rpc/avalia used to.
+
+    Returns:
+    - str: Path of the file.
+    """
+    filepath = os.path.join(output_path, submission_filename(data))
+    with open(filepath, 'w') as file:
+        json.dump(data, file, indent=4)
+    return filepath
+
+
+def iter_submissions(log_path):
+    """
+    Iterate over the submissions of a log, in the order they were written.
+
+    A last line left incomplete or torn by a crash or a failed write is skipped:
+    it was never acknowledged.
+    """
+    for path in segment_paths(log_path):
+        with open(path, 'rb') as segment:
+            previous = None
+            for line in segment:
+                if previous is not None:
+                    yield json.loads(previous)
+                previous = line
+        if previous is None or not previous.endswith(b'\n'):
+            continue
+        try:
+            data = json.loads(previous)
+        except ValueError:
+            continue
+        yield data
+
+
+def export_submissions(log_path, output_path):
+    """
+    Write every submission of a log as its own JSON file in output_path.
+
+    Returns:
+    - int: Number of files written.
+    """
+    os.makedirs(output_path, exist_ok=True)
+    count = 0
+    for data in iter_submissions(log_path):
+        write_submission_file(output_path, data)
+        count += 1
+    return count
+
+
+def _line_start(segment, end, block_size=65536):
+    """
+    Offset just after the last newline before end, or 0.
+    """
+    position = end
+    while position > 0:
+        start = max(0, position - block_size)
+        segment.seek(start)
+        newline = segment.read(position - start).rfind(b'\n')
+        if newline >= 0:
+            return start + newline + 1
+        position = start
+    return 0
+
+
+def _truncate_partial_line(path):
+    """
+    Drop an incomplete last line (a write interrupted by a crash), or a complete one that
+    is not valid JSON (torn by a failed write), so new lines start clean.
+    """
+    with open(path, 'r+b') as segment:
+        end = segment.seek(0, os.SEEK_END)
+        position = _line_start(segment, end)
+        if position == end and end > 0:
+            start = _line_start(segment, end - 1)
+            segment.seek(start)
+            try:
+                json.loads(segment.read(end - start))
+            except ValueError:
+                position = start
+        if position < end:
+            segment.truncate(position)
+
+
+def _fsync_directory(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class SubmissionLog:
+    """
+    Append-only log of submissions, written behind the requests by a background thread.
+
+    Each submission is one compact JSON line in the current segment file. The writer
+    takes every submission queued while it was busy, appends them and calls fsync once
+    for the whole batch (group commit), so concurrent requests share the cost of a disk
+    flush. append() returns once the submission is on disk.
+
+    Identical submissions are deduplicated on submission_key: a key already in the log
+    (or queued) is acknowledged without writing it again. A later, different submission
+    with the same 'aluno', 'datahora' and 'parte' is written, and wins when exported. The keys are read back from
+    the segments when the log is opened.
+
+    If export_path is given, each submission is also written as its own indented JSON
+    file there, after it has been acknowledged.
+    """
+
+    def __init__(self, log_path, export_path=None, segment_max_bytes=SEGMENT_MAX_BYTES,
+                 max_batch_records=MAX_BATCH_RECORDS):
+        self.log_path = log_path
+        self.export_path = export_path
+        self.segment_max_bytes = segment_max_bytes
+        self.max_batch_records = max_batch_records
+        os.makedirs(log_path, exist_ok=True)
+        if export_path is not None:
+            os.makedirs(export_path, exist_ok=True)
+
+        # Keys of the submissions already written, and continue the last segment, if any
+        self.keys = {submission_key(data) for data in iter_submissions(log_path)}
+        self.keys_lock = threading.Lock()
+        paths = segment_paths(log_path)
+        self.segment = segment_number(paths[-1]) if paths else 1
+        self.file = None
+        self._open_segment()
+
+        self.pending = queue.Queue()
+        self.worker = threading.Thread(target=self.run, daemon=True)
+        self.worker.start()
+
+    def submit(self, data):
+        """
+        Queue a submission for writing.
+
+        Returns:
+        - Future: Resolves to (segment file name, offset) once the submission is on disk,
+          or to None at once if a submission with the same key was already received.
+        """
+        future = Future()
+        key = submission_key(data)
+        with self.keys_lock:
+            if key in self.keys:
+                future.set_result(None)
+                return future
+            self.keys.add(key)
+        line = json.dumps(data, ensure_ascii=False, separators=(',', ':')).encode('utf-8') + b'\n'
+        self.pending.put((line, data, future))
+        return future
+
+    def append(self, data):
+        """
+        Write a submission and wait until it is on disk; raises OSError if it could not be written.
+        Returns None for a submission already received.
+        """
+        return self.submit(data).result()
+
+    def close(self):
+        """
+        Write the submissions still queued and stop the writer.
+        """
+        self.pending.put(None)
+        self.worker.join()
+        self.file.close()
+
+    def next_batch(self):
+        batch = [self.pending.get()]
+        while batch[-1] is not None and len(batch) < self.max_batch_records:
+            try:
+                batch.append(self.pending.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def run(self):
+        while True:
+            batch = self.next_batch()
+            stop = batch[-1] is None
+            if stop:
+                batch.pop()
+            if batch:
+                self._write_batch(batch)
+            if stop:
+                return
+
+    def _write_batch(self, batch):
+        # Where the batch starts in each segment it writes to, to take it back if a write fails
+        touched = [(self.file.name, self.file.tell())]
+        try:
+            locations = []
+            lines = []
+            position = self.file.tell()
+            for line, _, _ in batch:
+                if position and position + len(line) > self.segment_max_bytes:
+                    if lines:
+                        self._write_all(b''.join(lines))
+                        lines = []
+                    self._rotate()
+                    position = 0
+                    touched.append((self.file.name, 0))
+                locations.append((os.path.basename(self.file.name), position))
+                lines.append(line)
+                position += len(line)
+            self._write_all(b''.join(lines))
+            os.fsync(self.file.fileno())
+        except OSError as e:
+            # Not acknowledged: the same submission can be sent again, so none of the batch
+            # (not even a torn line) may stay in the log for the next batch to follow
+            self._discard(touched)
+            with self.keys_lock:
+                self.keys.difference_update(submission_key(data) for _, data, _ in batch)
+            for _, _, future in batch:
+                future.set_exception(e)
+            return
+
+        for (_, _, future), location in zip(batch, locations):
+            future.set_result(location)
+
+        if self.export_path is not None:
+            for _, data, _ in batch:
+                try:
+                    write_submission_file(self.export_path, data)
+                except OSError as e:
+                    print(f"Error exporting {submission_filename(data)}: {e}")
+
+    def _write_all(self, data):
+        view = memoryview(data)
+        while view:
+            view = view[self.file.write(view):]
+
+    def _discard(self, touched):
+        try:
+            for path, offset in touched:
+                if path == self.file.name:
+                    os.ftruncate(self.file.fileno(), offset)
+                    self.file.seek(offset)
+                else:
+                    with open(path, 'r+b') as segment:
+                        segment.truncate(offset)
+        except OSError as e:
+            # The lines left behind are dropped when the log is opened again
+            print(f"Error discarding a failed batch from {self.log_path}: {e}")
+
+    def _open_segment(self):
+        path = os.path.join(self.log_path, f"{SEGMENT_PREFIX}{self.segment:06d}{SEGMENT_SUFFIX}")
+        created = not os.path.exists(path)
+        if not created:
+            _truncate_partial_line(path)
+        # Unbuffered: a failed write leaves nothing behind to be flushed later
+        self.file = open(path, 'ab', buffering=0)
+        if created:
+            _fsync_directory(self.log_path)
+
+    def _rotate(self):
+        os.fsync(self.file.fileno())
+        self.file.close()
+        self.segment += 1
+        self._open_segment()
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Export the submissions of a log as one JSON file each.")
+    parser.add_argument('log_path', help="Folder with the submissions-*.log segments.")
+    parser.add_argument('output_path', help="Folder where the JSON files are written.")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    count = export_submissions(args.log_path, args.output_path)
+    print(f"{count} submission(s) exported to {args.output_path}")
+
+
+if __name__ == "__main__":
+    main()
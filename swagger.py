@@ -1,60 +1,283 @@
 from flask import Flask, request, jsonify
 import os
 import json
-import requests
+import time
+import zlib
+import queue
+import threading
+from concurrent.futures import Future
+import numpy as np
+from modelbundle import load_bundle
+from trajectoryindex import load_trajectory_index
+from traveltime import load_profiles
+from records import parse_coordinates
+from testModels import query_kind, answer_queries
+from uploader import upload_file, UploadError
+from submissionlog import SubmissionLog
+from scoring import load_ground_truth
 
 app = Flask(__name__)
 
 # Caminhos dos diretórios
 data_test_end_path = 'dataTestEnd'
 models_path = 'models'
+data_test_path = 'dataTest'
+store_test_path = os.path.join('store', 'dataTest')
+
+# Endereço padrão para envio dos testes finais (o próprio servidor, rodando localmente)
+url_avalia = 'http://127.0.0.1:5000/rest/rpc/avalia'
+
+# Tamanho máximo de um envio depois de descompactado
+MAX_DECOMPRESSED_BYTES = 512 * 1024 * 1024
+
+# Pasta (dentro de dataTestEnd) do log de envios recebidos em /rest/rpc/avalia, e se cada envio
+# também deve ser exportado como um arquivo JSON próprio em dataTestEnd
+submissions_folder = 'submissions'
+EXPORTAR_ARQUIVOS = False
+
+# Maior datahora aceita nas consultas (fim do ano 9999, o limite das conversões de data, dentro do int64 em ms)
+MAX_DATAHORA_MS = 253402300799999
+
+# Micro-lotes de previsão: quantas consultas no máximo por lote e quanto tempo (s) esperar por mais requisições
+# (0: o lote reúne apenas as requisições que chegaram enquanto o lote anterior era calculado)
+MAX_BATCH_QUERIES = 10000
+MAX_BATCH_WAIT_S = 0.0
+
+# Serviço de previsão com os modelos residentes em memória
+# As requisições concorrentes são reunidas em micro-lotes por uma thread, e cada lote é avaliado
+# com uma única chamada vetorizada; consultas do mesmo ônibus no mesmo lote servem de âncora umas às outras
+class PredictionService:
+    def __init__(self, models_path, max_batch_queries=MAX_BATCH_QUERIES, max_batch_wait=MAX_BATCH_WAIT_S):
+        self.models = load_bundle(models_path)
+        self.trajectories = load_trajectory_index(models_path)
+        self.profiles = load_profiles(models_path)
+        self.max_batch_queries = max_batch_queries
+        self.max_batch_wait = max_batch_wait
+        self.pending = queue.Queue()
+        self.worker = threading.Thread(target=self.run, daemon=True)
+        self.worker.start()
+    
+    # Enfileira as consultas de uma requisição e espera as respostas, na mesma ordem
+    def predict(self, queries):
+        future = Future()
+        self.pending.put((queries, future))
+        return future.result()
+    
+    # Reúne as requisições pendentes em um lote, até o limite de consultas
+    def next_batch(self):
+        batch = [self.pending.get()]
+        count = len(batch[0][0])
+        deadline = time.monotonic() + self.max_batch_wait
+        while count < self.max_batch_queries:
+            try:
+                timeout = deadline - time.monotonic()
+                item = self.pending.get(timeout=timeout) if timeout > 0 else self.pending.get_nowait()
+            except queue.Empty:
+                break
+            batch.append(item)
+            count += len(item[0])
+        return batch
+    
+    # Responde as consultas de um lote com uma única avaliação vetorizada; cada requisição é um grupo,
+    # de modo que suas respostas são as mesmas que teria se fosse avaliada sozinha
+    def answer_batch(self, batch):
+        queries = [query for batch_queries, _ in batch for query in batch_queries]
+        groups = np.repeat(np.arange(len(batch)), [len(batch_queries) for batch_queries, _ in batch])
+        answers = answer_queries(self.models, queries, self.trajectories, self.profiles, groups)
+        start = 0
+        for batch_queries, future in batch:
+            future.set_result(answers[start:start + len(batch_queries)])
+            start += len(batch_queries)
+    
+    def run(self):
+        while True:
+            batch = self.next_batch()
+            try:
+                self.answer_batch(batch)
+            except Exception:
+                # Se o lote falhar, cada requisição é avaliada sozinha, e só as que falharem recebem o erro
+                for item in batch:
+                    try:
+                        self.answer_batch([item])
+                    except Exception as e:
+                        item[1].set_exception(e)
+
+# Serviço criado na primeira previsão, para que o servidor suba mesmo sem modelos treinados
+prediction_service = None
+prediction_service_lock = threading.Lock()
+
+def get_prediction_service():
+    global prediction_service
+    with prediction_service_lock:
+        if prediction_service is None:
+            prediction_service = PredictionService(models_path)
+    return prediction_service
+
+# Função para verificar se um valor é um identificador simples (texto ou inteiro)
+def identificador_valido(valor):
+    return isinstance(valor, str) or (isinstance(valor, int) and not isinstance(valor, bool))
+
+# Função para converter um número (ou texto numérico) em float finito; retorna None se não for
+def numero_finito(valor):
+    if isinstance(valor, bool) or not isinstance(valor, (int, float, str)):
+        return None
+    try:
+        valor = float(valor)
+    except (ValueError, OverflowError):
+        return None
+    return valor if np.isfinite(valor) else None
+
+# Função para validar uma consulta; retorna a mensagem de erro ou None
+def validar_consulta(consulta):
+    if not isinstance(consulta, dict):
+        return 'a consulta deve ser um objeto JSON'
+    if 'linha' not in consulta:
+        return "campo 'linha' ausente"
+    if not identificador_valido(consulta['linha']):
+        return "'linha' deve ser um texto ou um número inteiro"
+    if consulta.get('ordem') is not None and not identificador_valido(consulta['ordem']):
+        return "'ordem' deve ser um texto ou um número inteiro"
+    if 'velocidade' in consulta and numero_finito(consulta['velocidade']) is None:
+        return "'velocidade' deve ser um número"
+    kind = query_kind(consulta)
+    if kind is None:
+        return "informe 'datahora' ou 'latitude' e 'longitude'"
+    if kind == 'coords':
+        try:
+            datahora = None if isinstance(consulta['datahora'], bool) else int(consulta['datahora'])
+        except (TypeError, ValueError, OverflowError):
+            datahora = None
+        if datahora is None or not 0 <= datahora <= MAX_DATAHORA_MS:
+            return "'datahora' deve ser um timestamp em milissegundos"
+    elif not np.isfinite(parse_coordinates([consulta['latitude'], consulta['longitude']])).all():
+        return "'latitude' e 'longitude' devem ser números"
+    return None
+
+# Função para formatar a resposta de uma consulta como em resposta.json
+def formatar_previsao(query, answer):
+    if answer is None:
+        modelo = 'coordenadas' if query[2] == 'coords' else 'velocidade'
+        return {'id': query[0], 'error': f"Modelo de {modelo} para linha {query[1]['linha']} não encontrado"}
+    if len(answer) == 3:
+        return {'id': answer[0], 'latitude': answer[1], 'longitude': answer[2]}
+    return {'id': answer[0], 'datahora': answer[1]}
+
+# Endpoint de previsão em tempo real
+# Recebe uma consulta {ordem, linha, datahora} ou {ordem, linha, latitude, longitude}, ou uma lista delas,
+# e responde no mesmo formato (objeto ou lista) com as previsões de resposta.json
+@app.route('/predict', methods=['POST'])
+def predict():
+    data = request.get_json(silent=True)
+    consultas = [data] if isinstance(data, dict) else data
+    if not isinstance(consultas, list) or not consultas:
+        return jsonify({'error': 'Envie uma consulta ou uma lista de consultas em JSON'}), 400
+    
+    queries = []
+    for i, consulta in enumerate(consultas):
+        erro = validar_consulta(consulta)
+        if erro is not None:
+            return jsonify({'error': f'Consulta {i}: {erro}'}), 400
+        # Identificador da consulta: 'id', ou 'ordem' como nos arquivos de teste
+        queries.append((consulta.get('id', consulta.get('ordem')), consulta, query_kind(consulta)))
+    
+    try:
+        service = get_prediction_service()
+    except (OSError, ValueError) as e:
+        return jsonify({'error': f'Modelos indisponíveis: {e}'}), 503
+    previsoes = [formatar_previsao(query, answer) for query, answer in zip(queries, service.predict(queries))]
+    return jsonify(previsoes[0] if isinstance(data, dict) else previsoes), 200
+
+# Log de envios criado no primeiro envio, com uma thread que grava os envios em segundo plano
+submission_log = None
+submission_log_lock = threading.Lock()
+
+def get_submission_log():
+    global submission_log
+    with submission_log_lock:
+        if submission_log is None:
+            submission_log = SubmissionLog(os.path.join(data_test_end_path, submissions_folder),
+                                           export_path=data_test_end_path if EXPORTAR_ARQUIVOS else None)
+    return submission_log
+
+# Gabarito das consultas de dataTestEnd, montado a partir de dataTest e carregado uma única vez, no primeiro envio
+ground_truth = None
+ground_truth_lock = threading.Lock()
+
+def get_ground_truth():
+    global ground_truth
+    with ground_truth_lock:
+        if ground_truth is None:
+            ground_truth = load_ground_truth(data_test_end_path, store_test_path, data_test_path)
+    return ground_truth
+
+# Função para avaliar as previsões de um envio; retorna None se não houver gabarito
+def avaliar_previsoes(previsoes):
+    try:
+        truth = get_ground_truth()
+    except (OSError, ValueError) as e:
+        print(f'Gabarito indisponível: {e}')
+        return None
+    return truth.score(previsoes) if len(truth) else None
+
+# Função para ler o corpo JSON de uma requisição, descompactando-o se vier com Content-Encoding: gzip
+# Retorna None se o corpo não for JSON válido ou passar do tamanho máximo
+def ler_json(req):
+    raw = req.get_data()
+    if req.content_encoding == 'gzip':
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        try:
+            raw = decompressor.decompress(raw, MAX_DECOMPRESSED_BYTES)
+        except zlib.error:
+            return None
+        if decompressor.unconsumed_tail:
+            return None
+    try:
+        return json.loads(raw)
+    except ValueError:
+        return None
 
 # Endpoint para receber os dados finais
+# Os envios são gravados no log de envios; a resposta sai assim que o envio está no disco,
+# com a gravação (e o fsync) feita em lote junto com os envios que chegaram ao mesmo tempo
 @app.route('/rest/rpc/avalia', methods=['POST'])
 def avalia():
     if request.method == 'POST':
-        data = request.json
+        data = ler_json(request)
         
         # Verifica se os dados necessários estão presentes
-        if 'aluno' not in data or 'datahora' not in data or 'previsoes' not in data or 'senha' not in data:
+        if not isinstance(data, dict) or 'aluno' not in data or 'datahora' not in data or 'previsoes' not in data \
+                or 'senha' not in data:
             return jsonify({'error': 'Dados incompletos no arquivo JSON'}), 400
         
-        # Nome do aluno e senha
-        aluno = data['aluno']
-        senha = data['senha']
-        
-        # Gera o nome do arquivo baseado no aluno e na datahora
-        filename = f'{aluno}_{data["datahora"]}.json'
-        filepath = os.path.join(data_test_end_path, filename)
+        # Grava o envio no log de envios; um envio idêntico a um já recebido (por exemplo, reenviado após uma
+        # resposta perdida) não é gravado de novo, mas um envio corrigido com o mesmo aluno, datahora e parte é
+        try:
+            localizacao = get_submission_log().append(data)
+        except OSError as e:
+            return jsonify({'error': f'Não foi possível salvar os dados: {e}'}), 503
         
-        # Salva o arquivo resposta.json no diretório dataTestEnd
-        with open(filepath, 'w') as file:
-            json.dump(data, file, indent=4)
-        
-        # Resposta de sucesso
-        return jsonify({'message': 'Dados recebidos e salvos com sucesso!'}), 200
+        # Resposta de sucesso, com a avaliação das previsões quando há gabarito
+        resposta = {'message': 'Dados recebidos e salvos com sucesso!' if localizacao is not None
+                    else 'Dados já recebidos anteriormente.'}
+        if isinstance(data['previsoes'], list):
+            score = avaliar_previsoes(data['previsoes'])
+            if score is not None:
+                resposta['score'] = score
+        return jsonify(resposta), 200
 
 # Função para enviar o arquivo resposta.json para o endpoint especificado
-def enviar_testes_finais(filepath):
-    url = ''
-    
-    # Carrega os dados do arquivo resposta.json
-    with open(filepath, 'r') as file:
-        data = json.load(file)
+# As previsões são enviadas em partes compactadas com gzip, várias ao mesmo tempo por conexões reaproveitadas,
+# e cada parte é reenviada com espera crescente em caso de falha de conexão ou erro temporário do servidor
+def enviar_testes_finais(filepath, url=url_avalia, **opcoes):
+    resultados = upload_file(url, filepath, **opcoes)
+    falhas = [resultado for resultado in resultados if isinstance(resultado, UploadError)]
     
-    # Envia os dados via POST usando requests
-    headers = {
-        'accept': 'application/json',
-        'Content-Type': 'application/json'
-    }
-    
-    response = requests.post(url, json=data, headers=headers)
-    
-    if response.status_code == 200:
+    if not falhas:
         print('Testes finais enviados com sucesso!')
     else:
-        print(f'Erro ao enviar os testes finais: {response.status_code}')
+        print(f'Erro ao enviar os testes finais: {len(falhas)} de {len(resultados)} parte(s) falharam')
+        for falha in falhas:
+            print(f'  {falha}')
 
 if __name__ == '__main__':
     app.run(debug=True)
-
@@ -0,0 +1,264 @@
+import os
+import json
+import zipfile
+import argparse
+from datetime import datetime, timedelta
+from zoneinfo import ZoneInfo
+import numpy as np
+from cleaning import EARTH_RADIUS_M
+from localcalendar import LOCAL_TIMEZONE
+
+# Timezone of the generated timestamps (the feed's local time)
+LOCAL_ZONE = ZoneInfo(LOCAL_TIMEZONE)
+
+# Area covered by the generated routes (roughly the city of Rio de Janeiro)
+RIO_LATITUDE = (-23.00, -22.80)
+RIO_LONGITUDE = (-43.60, -43.20)
+
+# Bus lines used by default: the first ones are relevant to the models, the last ones are filtered out
+DEFAULT_LINES = ['107', '177', '203', '222', '230', '9001', '9002']
+
+# Service hours (local time) and stop duration at each end of a route
+SERVICE_HOURS = (5, 23)
+TERMINAL_STOP_S = 300
+
+# GPS noise and the share of pings placed far away from the route
+GPS_NOISE_M = 8.0
+OUTLIER_RATE = 0.01
+OUTLIER_DISTANCE_M = 5000.0
+
+
+def make_route(rng, waypoints=25, step_m=600.0):
+    """
+    Random street-like route inside Rio: a walk of waypoints with a slowly turning heading.
+
+    Returns:
+    - np.ndarray: (waypoints, 2) latitude and longitude.
+    """
+    latitude = rng.uniform(RIO_LATITUDE[0] + 0.03, RIO_LATITUDE[1] - 0.03)
+    longitude = rng.uniform(RIO_LONGITUDE[0] + 0.03, RIO_LONGITUDE[1] - 0.03)
+    heading = rng.uniform(0, 2 * np.pi)
+    points = [(latitude, longitude)]
+    for _ in range(waypoints - 1):
+        heading += rng.normal(0, 0.4)
+        latitude += np.degrees(step_m * np.cos(heading) / EARTH_RADIUS_M)
+        longitude += np.degrees(step_m * np.sin(heading) / (EARTH_RADIUS_M * np.cos(np.radians(latitude))))
+        points.append((latitude, longitude))
+    return np.array(points)
+
+
+def route_lengths(route):
+    """
+    Cumulative distance in metres along a route, starting at 0.
+    """
+    lat = np.radians(route[:, 0])
+    dlat = np.diff(lat)
+    dlon = np.radians(np.diff(route[:, 1])) * np.cos(lat[:-1])
+    return np.concatenate(([0.0], np.cumsum(EARTH_RADIUS_M * np.hypot(dlat, dlon))))
+
+
+def vehicle_pings(rng, route, lengths, day_start_ms, interval_s):
+    """
+    Pings of one bus over a day: back-and-forth trips along the route during service hours.
+
+    Returns:
+    - Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]: datahora (ms), latitude, longitude and speed (km/h).
+    """
+    start_s = SERVICE_HOURS[0] * 3600 + rng.uniform(0, 3600)
+    end_s = SERVICE_HOURS[1] * 3600 - rng.uniform(0, 3600)
+    times = np.arange(start_s, end_s, interval_s)
+    times += rng.uniform(-0.2, 0.2, size=len(times)) * interval_s
+
+    # Trip speed (km/h) changes with the time of day: slower in the rush hours
+    hours = times / 3600.0
+    rush = np.exp(-((hours - 8) ** 2) / 2) + np.exp(-((hours - 18) ** 2) / 2)
+    speed = np.clip(rng.normal(28, 4) * (1 - 0.45 * rush) + rng.normal(0, 3, size=len(times)), 3, 70)
+
+    # Drive along the route and back, stopping at each end
+    along = np.empty(len(times))
+    position, direction, waiting = rng.uniform(0, lengths[-1]), 1, 0.0
+    for i in range(len(times)):
+        elapsed = times[i] - times[i - 1] if i else 0.0
+        if waiting > 0:
+            waiting -= elapsed
+            speed[i] = 0.0
+        else:
+            position += direction * elapsed * speed[i] / 3.6
+            if not 0.0 < position < lengths[-1]:
+                position = min(max(position, 0.0), lengths[-1])
+                direction, waiting = -direction, TERMINAL_STOP_S
+        along[i] = position
+
+    latitude = np.interp(along, lengths, route[:, 0])
+    longitude = np.interp(along, lengths, route[:, 1])
+    noise = rng.normal(0, GPS_NOISE_M, size=(len(times), 2))
+    outliers = rng.random(len(times)) < OUTLIER_RATE
+    noise[outliers] += rng.choice([-1, 1], size=(outliers.sum(), 2)) * OUTLIER_DISTANCE_M
+    latitude = latitude + np.degrees(noise[:, 0] / EARTH_RADIUS_M)
+    longitude = longitude + np.degrees(noise[:, 1] / (EARTH_RADIUS_M * np.cos(np.radians(latitude))))
+    return (day_start_ms + np.round(times * 1000).astype(np.int64), latitude, longitude, np.round(speed))
+
+
+def comma_decimal(value):
+    """
+    Format a coordinate like the feed does, with ',' as decimal separator.
+    """
+    return f"{value:.5f}".replace('.', ',')
+
+
+def day_records(rng, lines, vehicles, day, interval_s):
+    """
+    All pings of a day, as feed records sorted by the time they were sent.
+
+    Args:
+    - rng (np.random.Generator): Random generator.
+    - lines (Dict[str, Tuple[np.ndarray, np.ndarray]]): Route and cumulative lengths of each line.
+    - vehicles (Dict[str, List[str]]): Buses of each line.
+    - day (datetime.date): Local day.
+    - interval_s (float): Mean time between two pings of a bus.
+
+    Returns:
+    - List[dict]: Feed records.
+    """
+    day_start = datetime(day.year, day.month, day.day, tzinfo=LOCAL_ZONE)
+    day_start_ms = int(day_start.timestamp() * 1000)
+    columns = []
+    for linha, (route, lengths) in lines.items():
+        for ordem in vehicles[linha]:
+            datahora, latitude, longitude, speed = vehicle_pings(rng, route, lengths, day_start_ms, interval_s)
+            columns.append((linha, ordem, datahora, latitude, longitude, speed))
+
+    records = []
+    for linha, ordem, datahora, latitude, longitude, speed in columns:
+        delays = rng.integers(1000, 30000, size=len(datahora))
+        for i in range(len(datahora)):
+            sent = int(datahora[i] + delays[i])
+            records.append({
+                'ordem': ordem,
+                'latitude': comma_decimal(latitude[i]),
+                'longitude': comma_decimal(longitude[i]),
+                'datahora': str(int(datahora[i])),
+                'velocidade': str(int(speed[i])),
+                'linha': linha,
+                'datahoraenvio': str(sent),
+                'datahoraservidor': str(sent + 500),
+            })
+    records.sort(key=lambda record: int(record['datahoraenvio']))
+    return records
+
+
+def write_day_zip(folder_path, day, records):
+    """
+    Write a day of records as a zip with one JSON array per hour, like the feed archives.
+
+    Returns:
+    - str: Path of the zip file.
+    """
+    os.makedirs(folder_path, exist_ok=True)
+    by_hour = {}
+    for record in records:
+        hour = datetime.fromtimestamp(int(record['datahoraenvio']) / 1000, LOCAL_ZONE).hour
+        by_hour.setdefault(hour, []).append(record)
+    zip_path = os.path.join(folder_path, f"{day.isoformat()}.zip")
+    with zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_DEFLATED) as zip_file:
+        for hour, hour_records in sorted(by_hour.items()):
+            zip_file.writestr(f"{day.isoformat()}_{hour:02d}.json", json.dumps(hour_records, ensure_ascii=False))
+    return zip_path
+
+
+def write_test_queries(folder_path, rng, records, count, file_name='teste-1.json'):
+    """
+    Write prediction queries taken from real pings: half ask for the position at a datahora,
+    half for the datahora at a position.
+
+    Returns:
+    - int: Number of queries written.
+    """
+    os.makedirs(folder_path, exist_ok=True)
+    picked = rng.choice(len(records), size=min(count, len(records)), replace=False)
+    queries = []
+    for query_id, index in enumerate(sorted(picked)):
+        record = records[index]
+        query = {'id': query_id, 'linha': record['linha'], 'ordem': record['ordem']}
+        if query_id % 2 == 0:
+            query['datahora'] = record['datahora']
+        else:
+            query['latitude'] = record['latitude']
+            query['longitude'] = record['longitude']
+        queries.append(query)
+    with open(os.path.join(folder_path, file_name), 'w', encoding='utf-8') as json_file:
+        json.dump(queries, json_file, ensure_ascii=False)
+    return len(queries)
+
+
+def generate_dataset(root_folder, days=2, test_days=1, lines=None, vehicles_per_line=10, interval_s=60.0,
+                     queries=1000, start_day='2024-05-10', seed=0):
+    """
+    Generate a synthetic dataset in the layout the scripts expect: day archives in 'dataGPS'
+    (history) and 'dataTest', and prediction queries in 'dataTestEnd'.
+
+    Args:
+    - root_folder (str): Folder where 'dataGPS', 'dataTest' and 'dataTestEnd' are created.
+    - days (int): Days of history.
+    - test_days (int): Days of test data, following the history.
+    - lines (List[str]): Bus lines; by default a few relevant lines and two that are filtered out.
+    - vehicles_per_line (int): Buses per line.
+    - interval_s (float): Mean time between two pings of a bus.
+    - queries (int): Prediction queries, drawn from the test days.
+    - start_day (str): First local day, 'YYYY-MM-DD'.
+    - seed (int): Random seed; the same arguments always produce the same files.
+
+    Returns:
+    - Dict[str, int]: Records written to 'dataGPS' and 'dataTest', and queries written to 'dataTestEnd'.
+    """
+    rng = np.random.default_rng(seed)
+    lines = lines or DEFAULT_LINES
+    routes = {}
+    for linha in lines:
+        route = make_route(rng)
+        routes[linha] = (route, route_lengths(route))
+    vehicles = {linha: [f"{chr(ord('A') + i % 26)}{rng.integers(10000, 99999)}" for i in range(vehicles_per_line)]
+                for linha in lines}
+
+    counts = {'dataGPS': 0, 'dataTest': 0, 'dataTestEnd': 0}
+    first_day = datetime.strptime(start_day, '%Y-%m-%d').date()
+    test_records = []
+    for offset in range(days + test_days):
+        day = first_day + timedelta(days=offset)
+        folder = 'dataGPS' if offset < days else 'dataTest'
+        records = day_records(rng, routes, vehicles, day, interval_s)
+        write_day_zip(os.path.join(root_folder, folder), day, records)
+        counts[folder] += len(records)
+        if folder == 'dataTest':
+            test_records.extend(records)
+
+    if queries and test_records:
+        counts['dataTestEnd'] = write_test_queries(os.path.join(root_folder, 'dataTestEnd'), rng, test_records,
+                                                   queries)
+    return counts
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Generate a synthetic Rio bus GPS dataset with the feed's schema.")
+    parser.add_argument('root_folder', help="Folder where 'dataGPS', 'dataTest' and 'dataTestEnd' are created.")
+    parser.add_argument('--days', type=int, default=2, help="Days of history (default: 2).")
+    parser.add_argument('--test-days', type=int, default=1, help="Days of test data (default: 1).")
+    parser.add_argument('--lines', nargs='+', help="Bus lines (default: %s)." % ' '.join(DEFAULT_LINES))
+    parser.add_argument('--vehicles', type=int, default=10, help="Buses per line (default: 10).")
+    parser.add_argument('--interval', type=float, default=60.0, help="Seconds between pings of a bus (default: 60).")
+    parser.add_argument('--queries', type=int, default=1000, help="Prediction queries (default: 1000).")
+    parser.add_argument('--seed', type=int, default=0, help="Random seed (default: 0).")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    counts = generate_dataset(args.root_folder, days=args.days, test_days=args.test_days, lines=args.lines,
+                              vehicles_per_line=args.vehicles, interval_s=args.interval, queries=args.queries,
+                              seed=args.seed)
+    for folder, count in counts.items():
+        print(f"{folder}: {count} records")
+
+
+if __name__ == "__main__":
+    main()
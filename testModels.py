@@ -1,74 +1,187 @@
 import os
 import json
+import math
 import pandas as pd
 import numpy as np
-import joblib
 from datetime import datetime, timedelta
+from modelbundle import load_bundle
+from trajectoryindex import load_trajectory_index
+from traveltime import load_profiles
+from records import parse_coordinates
+from localcalendar import local_hours
 
 # Caminhos dos diretórios
 data_test_path = './dataTestEnd'
 models_path = './models'
 
+# Timestamp inicial usado como último timestamp conhecido
+INITIAL_TIMESTAMP = 1715930000000
+
+# Velocidade usada quando a consulta não informa uma
+DEFAULT_VELOCIDADE = 30
+
+HOURS_PER_DAY = 24
+
+# Fusos horários e mudanças de horário de verão são múltiplos de 15 minutos
+QUARTER_HOUR_MS = 15 * 60 * 1000
+
+# Passadas vetorizadas de predict_timestamp antes de percorrer a cadeia de consultas uma a uma
+MAX_HOUR_PASSES = 4
+
+# Consultas de datahora avaliadas juntas para as 24 horas do dia (24 previsões por consulta)
+TIMESTAMP_BLOCK = 4096
+
 # Função para carregar modelos treinados
+# Os modelos vêm do pacote único models/models.npz (gerado pelo trainModels.py ou por python modelbundle.py),
+# sem desserializar os pipelines do scikit-learn
 def load_models():
-    models = {}
-    for filename in os.listdir(models_path):
-        if filename.endswith('.joblib'):
-            model = joblib.load(os.path.join(models_path, filename))
-            if filename.startswith('model_speed'):
-                linha = filename.split('_')[2].split('.')[0]
-                models[(linha, 'speed')] = model
-            elif filename.startswith('model_coords'):
-                linha = filename.split('_')[2].split('.')[0]
-                models[(linha, 'coords')] = model
-    return models
-
-# Função para prever latitude e longitude dado um timestamp e uma velocidade
-def predict_coordinates(model, timestamp, velocidade, last_known_coords):
-    try:
-        # Converter timestamp para hora do dia
-        datahora = datetime.fromtimestamp(int(timestamp) / 1000)
-        hora_do_dia = datahora.hour
-        
-        # Preparar os dados para previsão
-        X_pred = pd.DataFrame({'hora_do_dia': [hora_do_dia], 'velocidade': [velocidade]})
-        
-        predicted = model.predict(X_pred)
-        if len(predicted[0]) == 2:
-            return predicted[0].tolist()  # Retorna a previsão como uma lista
-    except Exception as e:
-        print(f"Erro ao prever coordenadas: {e}")
-    
-    # Fallback: Retornar a última coordenada conhecida com um pequeno ajuste
-    return [last_known_coords[0] + 0.0001, last_known_coords[1] + 0.0001]
-
-# Função para prever timestamp dado latitude, longitude e uma velocidade
-def predict_timestamp(model, latitude, longitude, velocidade, last_known_timestamp):
-    try:
-        # Converter last_known_timestamp para hora do dia
-        datahora = datetime.fromtimestamp(int(last_known_timestamp) / 1000)
-        hora_do_dia = datahora.hour
-        
-        # Preparar os dados para previsão
-        X_pred = pd.DataFrame({'latitude': [latitude], 'longitude': [longitude], 'velocidade': [velocidade], 'hora_do_dia': [hora_do_dia]})
-        
-        predicted = model.predict(X_pred)
-        if len(predicted) > 0:
-            return predicted[0]  # Retorna o primeiro elemento da previsão
-    except Exception as e:
-        print(f"Erro ao prever timestamp: {e}")
+    return load_bundle(models_path)
+
+# Função para propagar um valor de fallback: onde a previsão falhou, usa o último resultado
+# anterior (ou o valor inicial) mais um incremento por falha consecutiva
+# Com starts (início do grupo de cada posição), a propagação recomeça do valor inicial em cada grupo
+def fill_failures(predicted, ok, initial, step, starts=None):
+    n = len(predicted)
+    position = np.arange(n)
+    starts = np.zeros(n, dtype=np.int64) if starts is None else starts
+    last_ok = np.maximum.accumulate(np.where(ok, position, -1))
+    last_ok = np.where(last_ok >= starts, last_ok, starts - 1)
+    base = np.where((last_ok >= starts)[:, None], predicted[np.maximum(last_ok, 0)], initial)
+    steps = position - last_ok
+    return np.where(ok[:, None], predicted, base + steps[:, None] * step)
+
+# Função para calcular o início do grupo de cada posição, com os grupos em posições contíguas
+def group_starts(groups):
+    groups = np.asarray(groups)
+    n = len(groups)
+    new_group = np.ones(n, dtype=bool)
+    new_group[1:] = groups[1:] != groups[:-1]
+    return np.maximum.accumulate(np.where(new_group, np.arange(n), 0))
+
+# Função para prever latitude e longitude de várias consultas de uma vez, dado o timestamp e a velocidade
+# Linhas com histórico no índice de trajetórias usam a posição histórica mais próxima em (tipo de dia, hora do dia),
+# do mesmo ônibus quando ele tem histórico, interpolada na sua trajetória; as demais usam o modelo de
+# coordenadas da linha, avaliado para todas as consultas em uma única operação matricial
+# Onde a previsão falha, retorna a última coordenada prevista do mesmo ônibus (ordem) com um pequeno ajuste
+# Com groups (grupo de cada consulta, por exemplo a requisição), o estado de cada ônibus é mantido por grupo
+def predict_coordinates(models, linhas, timestamps, velocidades, ordens=None, trajectories=None,
+                        last_known_coords=None, groups=None):
+    ordens = list(ordens) if ordens is not None else [None] * len(linhas)
+    last_known_coords = last_known_coords if last_known_coords is not None else {}
+    rows = models.lookup('model_coords', linhas)
+    X_pred = np.column_stack((local_hours(timestamps), velocidades))
+    predicted = models.predict('model_coords', rows, X_pred)
+    found = rows >= 0
     
-    # Fallback: Retornar o último timestamp conhecido com um pequeno incremento
-    return last_known_timestamp + 60000  # Incrementa 1 minuto (60000 ms)
+    if trajectories is not None:
+        indexed = np.array([linha in trajectories for linha in linhas], dtype=bool)
+        if np.any(indexed):
+            predicted[indexed] = trajectories.locate(np.asarray(linhas, dtype=object)[indexed],
+                                                     np.asarray(timestamps)[indexed],
+                                                     np.asarray(ordens, dtype=object)[indexed])
+            found = found | indexed
+    
+    # Apenas as consultas com modelo ou histórico produzem resultado; o estado é mantido por ônibus
+    coords = np.full((len(rows), 2), np.nan)
+    keys = ordens if groups is None else list(zip(groups, ordens))
+    ordem_codes, ordem_values = pd.factorize(pd.Series(keys, dtype=object), use_na_sentinel=False)
+    for code, ordem in enumerate(ordem_values):
+        queries = np.flatnonzero((ordem_codes == code) & found)
+        if not len(queries):
+            continue
+        initial = np.asarray(last_known_coords.get(ordem, (0.0, 0.0)), dtype=np.float64)
+        coords[queries] = fill_failures(predicted[queries], np.all(np.isfinite(predicted[queries]), axis=1),
+                                        initial, np.array([0.0001, 0.0001]))
+        last_known_coords[ordem] = coords[queries[-1]].tolist()
+    return coords, found
 
-# Função para processar arquivos de teste e gerar previsões
-def process_test_files(models):
+# Função para percorrer uma única vez a cadeia de consultas de datahora (found são as posições com modelo)
+# O modelo é avaliado de uma vez para as 24 horas possíveis de cada consulta (em blocos de TIMESTAMP_BLOCK consultas),
+# e cada consulta escolhe a previsão da hora dada pelo resultado da anterior
+def chain_timestamps(models, rows, latitudes, longitudes, found, first, last_known_timestamp):
+    initial = float(last_known_timestamp)
+    initial_hour = int(local_hours([last_known_timestamp])[0])
+    first = first.tolist()
+    # Hora de cada intervalo de 15 minutos dos resultados de fallback, convertida uma única vez
+    quarter_hours = {}
     results = []
-    last_known_coords = [0.0, 0.0]
-    last_known_timestamp = 1715930000000  # Um timestamp inicial padrão
+    hour, last_ok, failures = initial_hour, initial, 0
+    for block_start in range(0, len(found), TIMESTAMP_BLOCK):
+        block = found[block_start:block_start + TIMESTAMP_BLOCK]
+        X_pred = np.column_stack((np.tile(np.arange(HOURS_PER_DAY), len(block)),
+                                  np.repeat(latitudes[block], HOURS_PER_DAY), np.repeat(longitudes[block], HOURS_PER_DAY)))
+        predicted = models.predict('model_speed', np.repeat(rows[block], HOURS_PER_DAY), X_pred)[:, 0]
+        ok = np.isfinite(predicted)
+        predicted_hours = np.full(len(predicted), -1, dtype=np.int64)
+        predicted_hours[ok] = local_hours(predicted[ok])
+        predicted = predicted.reshape(-1, HOURS_PER_DAY).tolist()
+        predicted_hours = predicted_hours.reshape(-1, HOURS_PER_DAY).tolist()
+        
+        for j in range(len(block)):
+            if first[block_start + j]:
+                hour, last_ok, failures = initial_hour, initial, 0
+            value = predicted[j][hour]
+            if math.isfinite(value):
+                last_ok, failures = value, 0
+                hour = predicted_hours[j][hour]
+            else:
+                # Fallback: o último timestamp previsto (ou o conhecido) com um incremento de 1 minuto (60000 ms)
+                # por falha consecutiva
+                failures += 1
+                value = last_ok + 60000.0 * failures
+                quarter = int(value // QUARTER_HOUR_MS)
+                if quarter not in quarter_hours:
+                    quarter_hours[quarter] = int(local_hours([quarter * QUARTER_HOUR_MS])[0])
+                hour = quarter_hours[quarter]
+            results.append(value)
+    return np.array(results)
+
+# Função para prever o timestamp de várias consultas de uma vez, dado latitude, longitude e velocidade
+# A hora do dia de cada consulta vem do último timestamp conhecido, o resultado da consulta anterior, então as
+# consultas formam uma cadeia. Normalmente as horas ficam estáveis em poucas passadas vetorizadas; se não ficarem
+# em MAX_HOUR_PASSES, a cadeia é percorrida uma única vez por chain_timestamps
+# Com groups (grupo de cada consulta, em posições contíguas), cada grupo tem sua própria cadeia
+def predict_timestamp(models, linhas, latitudes, longitudes, velocidades, last_known_timestamp=INITIAL_TIMESTAMP,
+                      groups=None):
+    rows = models.lookup('model_speed', linhas)
+    found = np.flatnonzero(rows >= 0)
+    timestamps = np.full(len(rows), np.nan)
+    if not len(found):
+        return timestamps, rows >= 0
     
-    # Iterar sobre arquivos de teste
-    for root, _, files in os.walk(data_test_path):
+    starts = group_starts(np.zeros(len(found)) if groups is None else np.asarray(groups)[found])
+    first = starts == np.arange(len(found))
+    hours = np.full(len(found), local_hours([last_known_timestamp])[0])
+    for _ in range(MAX_HOUR_PASSES):
+        X_pred = np.column_stack((hours, latitudes[found], longitudes[found]))
+        predicted = models.predict('model_speed', rows[found], X_pred)
+        # Fallback: o último timestamp conhecido com um incremento de 1 minuto (60000 ms)
+        results = fill_failures(predicted, np.isfinite(predicted[:, 0]), np.array([float(last_known_timestamp)]),
+                                np.array([60000.0]), starts)[:, 0]
+        previous = np.where(first, last_known_timestamp, np.concatenate(([last_known_timestamp], results[:-1])))
+        new_hours = local_hours(previous)
+        if np.array_equal(new_hours, hours):
+            break
+        hours = new_hours
+    else:
+        results = chain_timestamps(models, rows, latitudes, longitudes, found, first, last_known_timestamp)
+    
+    timestamps[found] = results
+    return timestamps, rows >= 0
+
+# Função para identificar o tipo de uma consulta: 'coords' (temos datahora, prever latitude e longitude),
+# 'timestamp' (temos latitude e longitude, prever datahora) ou None se faltarem dados
+def query_kind(data):
+    if 'datahora' in data:
+        return 'coords'
+    if 'latitude' in data and 'longitude' in data:
+        return 'timestamp'
+    return None
+
+# Função para ler as consultas dos arquivos de teste, na ordem em que aparecem
+def read_test_queries(folder_path=None):
+    queries = []
+    for root, _, files in os.walk(folder_path or data_test_path):
         for file in files:
             if file.startswith('teste-') and file.endswith('.json'):
                 filepath = os.path.join(root, file)
@@ -86,41 +199,85 @@ def process_test_files(models):
                         print(f"Chave 'id' ou 'ordem' não encontrada no arquivo {file}.")
                         continue
                     
-                    linha = data['linha']
-                    
-                    # Usar velocidade padrão se não estiver presente
-                    velocidade = data.get('velocidade', 30)  # Usando 30 como velocidade padrão
-                    
-                    if 'datahora' in data:
-                        # Temos timestamp, prever latitude e longitude
-                        timestamp = data['datahora']
-                        if (linha, 'coords') in models:
-                            model_coords = models[(linha, 'coords')]
-                            predicted_coords = predict_coordinates(model_coords, timestamp, velocidade, last_known_coords)
-                            if len(predicted_coords) == 2:
-                                results.append([id, predicted_coords[0], predicted_coords[1]])
-                                last_known_coords = predicted_coords
-                            else:
-                                print(f"Previsão inválida para ID {id} no arquivo {file}.")
-                        else:
-                            print(f"Modelo de coordenadas para linha {linha} não encontrado.")
-                    
-                    elif 'latitude' in data and 'longitude' in data:
-                        # Temos latitude e longitude, prever timestamp
-                        latitude = float(data['latitude'].replace(',', '.'))
-                        longitude = float(data['longitude'].replace(',', '.'))
-                        if (linha, 'speed') in models:
-                            model_speed = models[(linha, 'speed')]
-                            timestamp = predict_timestamp(model_speed, latitude, longitude, velocidade, last_known_timestamp)
-                            results.append([id, timestamp])
-                            last_known_timestamp = timestamp
-                        else:
-                            print(f"Modelo de velocidade para linha {linha} não encontrado.")
-                    
+                    kind = query_kind(data)
+                    if kind is not None:
+                        queries.append((id, data, kind, file))
                     else:
                         print(f"Dados incompletos para previsão no arquivo {file}: {data}")
+    return queries
+
+# Função para responder uma lista de consultas (id, dados, tipo, ...), usada pelos testes e pelo endpoint /predict
+# As consultas são agrupadas por tipo e avaliadas em lote; as respostas seguem a ordem de entrada,
+# [id, latitude, longitude] ou [id, datahora], e None quando não há modelo para a linha
+# Com perfis de tempo de percurso, a datahora de uma posição é estimada pelo tempo de percurso desde a última
+# posição conhecida do ônibus (as consultas de coordenadas, com sua datahora e posição prevista, servem de âncora);
+# as demais consultas de datahora usam o modelo de velocidade da linha
+# Com groups (grupo de cada consulta, em posições contíguas), as consultas de cada grupo são respondidas como
+# se fossem avaliadas sozinhas: o estado de cada ônibus e as cadeias de datahora não passam de um grupo a outro
+def answer_queries(models, queries, trajectories=None, profiles=None, groups=None):
+    answers = [None] * len(queries)
+    groups = np.zeros(len(queries), dtype=np.int64) if groups is None else np.asarray(groups)
+    coordinates = np.full((len(queries), 2), np.nan)
+    known_datahora = np.full(len(queries), np.nan)
+    
+    for kind in ('coords', 'timestamp'):
+        positions = [i for i, query in enumerate(queries) if query[2] == kind]
+        if not positions:
+            continue
+        batch = [queries[i][1] for i in positions]
+        linhas = [data['linha'] for data in batch]
+        # Usar velocidade padrão se não estiver presente
+        velocidades = pd.to_numeric(pd.Series([data.get('velocidade', DEFAULT_VELOCIDADE) for data in batch],
+                                              dtype=object), errors='coerce').to_numpy(dtype=np.float64)
+        
+        if kind == 'coords':
+            timestamps = np.array([int(data['datahora']) for data in batch], dtype=np.int64)
+            ordens = [data.get('ordem') for data in batch]
+            predicted, found = predict_coordinates(models, linhas, timestamps, velocidades, ordens, trajectories,
+                                                   groups=groups[positions])
+            coordinates[positions] = predicted
+            known_datahora[positions] = timestamps
+            for i, coords, ok in zip(positions, predicted.tolist(), found):
+                if ok:
+                    answers[i] = [queries[i][0], coords[0], coords[1]]
+        else:
+            latitudes = parse_coordinates(data['latitude'] for data in batch)
+            longitudes = parse_coordinates(data['longitude'] for data in batch)
+            coordinates[positions] = np.column_stack((latitudes, longitudes))
+            
+            # Perfis de tempo de percurso, percorrendo todas as consultas na ordem de entrada
+            profiled = np.zeros(len(positions), dtype=bool)
+            if profiles is not None:
+                estimated = profiles.predict_timestamps([query[1]['linha'] for query in queries],
+                                                        [query[1].get('ordem') for query in queries],
+                                                        coordinates, known_datahora, groups)[positions]
+                profiled = np.isfinite(estimated)
+                for i, timestamp in zip(np.asarray(positions)[profiled], estimated[profiled].tolist()):
+                    answers[i] = [queries[i][0], int(round(timestamp))]
+            
+            # Demais consultas: modelo de velocidade da linha
+            rest = np.flatnonzero(~profiled)
+            if not len(rest):
+                continue
+            predicted, found = predict_timestamp(models, [linhas[j] for j in rest], latitudes[rest], longitudes[rest],
+                                                 velocidades[rest], groups=groups[positions][rest])
+            for j, timestamp, ok in zip(rest, predicted.tolist(), found):
+                if ok:
+                    answers[positions[j]] = [queries[positions[j]][0], timestamp]
     
-    return results
+    return answers
+
+# Função para processar arquivos de teste e gerar previsões
+def process_test_files(models, trajectories=None, profiles=None):
+    queries = read_test_queries()
+    answers = answer_queries(models, queries, trajectories, profiles)
+    
+    for kind, model_name in (('coords', 'coordenadas'), ('timestamp', 'velocidade')):
+        for query, answer in zip(queries, answers):
+            if answer is None and query[2] == kind:
+                print(f"Modelo de {model_name} para linha {query[1]['linha']} não encontrado.")
+    
+    return [answer for answer in answers if answer is not None]
 
 # Função para salvar resultados no formato resposta.json
 def save_results(results):
@@ -145,13 +302,23 @@ def save_results(results):
     with open('resposta.json', 'w') as f:
         json.dump(response_data, f, indent=4)
 
-# Carregar modelos treinados
-models = load_models()
-
-# Processar arquivos de teste e gerar previsões
-results = process_test_files(models)
-
-# Salvar resultados no arquivo resposta.json
-save_results(results)
+def main():
+    # Carregar modelos treinados
+    models = load_models()
+    
+    # Carregar o índice de trajetórias históricas, se o treinamento o gerou
+    trajectories = load_trajectory_index(models_path)
+    
+    # Carregar os perfis de tempo de percurso, se o treinamento os gerou
+    profiles = load_profiles(models_path)
+    
+    # Processar arquivos de teste e gerar previsões
+    results = process_test_files(models, trajectories, profiles)
+    
+    # Salvar resultados no arquivo resposta.json
+    save_results(results)
+    
+    print("Previsões concluídas e resultados salvos em resposta.json.")
 
-print("Previsões concluídas e resultados salvos em resposta.json.")
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+import unittest
+import numpy as np
+from sklearn.cluster import DBSCAN
+from cleaning import (grid_dbscan, find_main_route, project_to_meters, haversine_meters, EARTH_RADIUS_M,
+                      DEFAULT_EPS_METERS, DEFAULT_MIN_SAMPLES)
+
+
+def make_group(seed=0, route_points=1500, jitter=0.0002):
+    """
+    Coordinates of one vehicle: pings along a route, a smaller cluster at the depot and scattered outliers.
+    """
+    rng = np.random.default_rng(seed)
+    corners = np.array([[-22.90, -43.25], [-22.91, -43.22], [-22.93, -43.21], [-22.95, -43.18]])
+    steps = rng.uniform(0, len(corners) - 1, route_points)
+    segment = np.minimum(steps.astype(int), len(corners) - 2)
+    fraction = (steps - segment)[:, None]
+    route = corners[segment] * (1 - fraction) + corners[segment + 1] * fraction
+    route += rng.normal(0, jitter, route.shape)
+    depot = np.array([-22.87, -43.30]) + rng.normal(0, 0.0003, (80, 2))
+    outliers = np.column_stack((rng.uniform(-23.0, -22.8, 60), rng.uniform(-43.4, -43.1, 60)))
+    coordinates = np.vstack((route, depot, outliers))
+    return coordinates[rng.permutation(len(coordinates))]
+
+
+def sklearn_dbscan(coordinates, eps_meters=DEFAULT_EPS_METERS, min_samples=DEFAULT_MIN_SAMPLES):
+    model = DBSCAN(eps=eps_meters / EARTH_RADIUS_M, min_samples=min_samples, metric='haversine',
+                   algorithm='ball_tree')
+    return model.fit(np.radians(coordinates))
+
+
+class GridDbscanTest(unittest.TestCase):
+    """
+    grid_dbscan over the projected coordinates finds the clusters of scikit-learn's haversine DBSCAN.
+    """
+
+    def test_labels_match_haversine_dbscan(self):
+        # A sparse route, so some border points are within eps of two clusters
+        coordinates = make_group(route_points=600, jitter=0.0003)
+        model = sklearn_dbscan(coordinates)
+        expected = model.labels_
+        core = np.zeros(len(coordinates), dtype=bool)
+        core[model.core_sample_indices_] = True
+        self.assertGreater(len(set(expected.tolist()) - {-1}), 1)
+
+        labels = grid_dbscan(project_to_meters(coordinates), DEFAULT_EPS_METERS, DEFAULT_MIN_SAMPLES)
+        np.testing.assert_array_equal(labels == -1, expected == -1)
+        # Cluster ids may differ, but each cluster of core points must map to exactly one cluster of the other
+        pairs = set(zip(labels[core].tolist(), expected[core].tolist()))
+        self.assertEqual(len(pairs), len(set(labels[core].tolist())))
+        self.assertEqual(len(pairs), len(set(expected[core].tolist())))
+
+        # A border point may join any cluster with a core point within eps; scikit-learn takes the first one
+        # reached and grid_dbscan the nearest one
+        cluster = {theirs: ours for ours, theirs in pairs}
+        border = np.flatnonzero(~core & (expected != -1))
+        self.assertGreater(len(border), 0)
+        for i in border:
+            distances = haversine_meters(coordinates[i, 0], coordinates[i, 1], coordinates[core, 0],
+                                         coordinates[core, 1])
+            candidates = {cluster[theirs] for theirs in expected[core][distances <= DEFAULT_EPS_METERS].tolist()}
+            self.assertIn(labels[i], candidates)
+
+    def test_small_blocks_give_same_labels(self):
+        points = project_to_meters(make_group(seed=1))
+        labels = grid_dbscan(points, DEFAULT_EPS_METERS, DEFAULT_MIN_SAMPLES)
+        blocked = grid_dbscan(points, DEFAULT_EPS_METERS, DEFAULT_MIN_SAMPLES, max_block_pairs=7)
+        np.testing.assert_array_equal(blocked, labels)
+
+    def test_main_route_is_largest_cluster(self):
+        coordinates = make_group(seed=2)
+        coordinates[::97] = np.nan
+        valid = np.all(np.isfinite(coordinates), axis=1)
+        expected = sklearn_dbscan(coordinates[valid]).labels_
+        main_cluster = np.argmax(np.bincount(expected[expected >= 0]))
+
+        main_route = find_main_route(coordinates)
+        self.assertFalse(np.any(main_route[~valid]))
+        np.testing.assert_array_equal(main_route[valid], expected == main_cluster)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,72 @@
+import os
+import json
+import random
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+import pipeline
+from main import group_sequence_json_file
+
+
+def make_feed(count, seed=0):
+    rng = random.Random(seed)
+    records = []
+    for position in range(count):
+        record = {'ordem': f'A{rng.randrange(20):05d}', 'linha': rng.choice(['107', '177', '203', 'São João']),
+                  'latitude': f'-22,{rng.randrange(10 ** 6):06d}', 'longitude': f'-43,{rng.randrange(10 ** 6):06d}',
+                  # Few distinct timestamps, so equal keys must keep their input order
+                  'datahora': str(1715930000000 + rng.randrange(50) * 1000), 'velocidade': str(rng.randrange(60))}
+        if position % 37 == 0:
+            del record['linha']
+        if position % 53 == 0:
+            record['datahora'] = ''
+        records.append(record)
+    return records
+
+
+class ExternalGroupSortTest(unittest.TestCase):
+    """
+    The external merge sort writes the same '_sorted.json' as the in-memory sort.
+    """
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def sorted_output(self, name, records, memory_limit=None):
+        folder = os.path.join(self.folder, name)
+        os.makedirs(folder)
+        file_path = os.path.join(folder, 'feed.json')
+        with open(file_path, 'w', encoding='utf-8') as json_file:
+            json.dump(records, json_file, ensure_ascii=False)
+        group_sequence_json_file(file_path, memory_limit)
+        with open(os.path.join(folder, 'feed_sorted.json'), 'rb') as sorted_file:
+            return sorted_file.read()
+
+    def test_spilled_runs_match_in_memory_sort(self):
+        records = make_feed(600)
+        expected = self.sorted_output('memory', records)
+
+        spilled = []
+        write_sorted_run = pipeline.write_sorted_run
+
+        def counting_write_sorted_run(run_path, items):
+            spilled.append(run_path)
+            write_sorted_run(run_path, items)
+
+        # One record per run and at most 8 runs per merge: several merge levels
+        with mock.patch.object(pipeline, 'write_sorted_run', counting_write_sorted_run), \
+                mock.patch.object(pipeline, 'MAX_MERGE_RUNS', 8):
+            external = self.sorted_output('external', records, memory_limit=1)
+
+        self.assertGreater(len(spilled), len(records))
+        self.assertEqual(external, expected)
+        # The runs are removed with the temporary folder
+        self.assertEqual(sorted(os.listdir(os.path.join(self.folder, 'external'))), ['feed.json', 'feed_sorted.json'])
+
+
+if __name__ == '__main__':
+    unittest.main()
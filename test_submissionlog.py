@@ -0,0 +1,101 @@
+import os
+import json
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+from concurrent.futures import Future
+from submissionlog import SubmissionLog, iter_submissions, segment_paths
+
+
+def make_submission(parte):
+    return {'aluno': 'Aluno', 'datahora': '2024-05-15 10:00:00', 'senha': 'senha', 'parte': parte,
+            'previsoes': [{'id': parte, 'latitude': -22.9, 'longitude': -43.2}]}
+
+
+class SubmissionLogTest(unittest.TestCase):
+    """
+    Failed writes and torn lines in the append-only submission log.
+    """
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def failing_write(self, written):
+        # Write the first bytes of the batch, then fail like a full disk
+        def write_all(log, data):
+            log.file.write(data[:written])
+            raise OSError('disk full')
+        return mock.patch.object(SubmissionLog, '_write_all', write_all)
+
+    def test_failed_batch_leaves_no_torn_line(self):
+        log = SubmissionLog(self.folder)
+        try:
+            log.append(make_submission(1))
+            with self.failing_write(10):
+                with self.assertRaises(OSError):
+                    log.append(make_submission(2))
+            log.append(make_submission(3))
+        finally:
+            log.close()
+
+        self.assertEqual([data['parte'] for data in iter_submissions(self.folder)], [1, 3])
+        # The failed part was not acknowledged, so it is written when sent again
+        log = SubmissionLog(self.folder)
+        try:
+            self.assertIsNotNone(log.append(make_submission(2)))
+        finally:
+            log.close()
+        self.assertEqual([data['parte'] for data in iter_submissions(self.folder)], [1, 3, 2])
+
+    def test_failed_batch_is_taken_back_across_segments(self):
+        log = SubmissionLog(self.folder, segment_max_bytes=1)
+        try:
+            log.append(make_submission(1))
+            size = os.path.getsize(segment_paths(self.folder)[0])
+            write_all = SubmissionLog._write_all
+
+            # Each part goes to a new segment; the second one fails halfway
+            def failing_write_all(log, data):
+                if b'"parte":3' in data:
+                    log.file.write(data[:10])
+                    raise OSError('disk full')
+                write_all(log, data)
+
+            batch = [(json.dumps(make_submission(parte), separators=(',', ':')).encode('utf-8') + b'\n',
+                      make_submission(parte), Future()) for parte in (2, 3)]
+            with mock.patch.object(SubmissionLog, '_write_all', failing_write_all):
+                log._write_batch(batch)
+            self.assertTrue(all(isinstance(future.exception(), OSError) for _, _, future in batch))
+            log.append(make_submission(4))
+        finally:
+            log.close()
+
+        self.assertEqual(len(segment_paths(self.folder)), 3)
+        self.assertEqual(os.path.getsize(segment_paths(self.folder)[0]), size)
+        self.assertEqual(os.path.getsize(segment_paths(self.folder)[1]), 0)
+        self.assertEqual([data['parte'] for data in iter_submissions(self.folder)], [1, 4])
+
+    def test_torn_last_line_is_dropped_on_open(self):
+        log = SubmissionLog(self.folder)
+        try:
+            log.append(make_submission(1))
+        finally:
+            log.close()
+        with open(segment_paths(self.folder)[-1], 'ab') as segment:
+            segment.write(b'{"aluno":"Alu\n')
+
+        self.assertEqual([data['parte'] for data in iter_submissions(self.folder)], [1])
+        log = SubmissionLog(self.folder)
+        try:
+            log.append(make_submission(2))
+        finally:
+            log.close()
+        self.assertEqual([data['parte'] for data in iter_submissions(self.folder)], [1, 2])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,137 @@
+import gzip
+import json
+import asyncio
+import shutil
+import tempfile
+import threading
+import unittest
+from unittest import mock
+import requests
+from werkzeug.serving import make_server
+import swagger
+import uploader
+from submissionlog import SubmissionLog, iter_submissions, export_submissions, submission_filename
+
+
+def make_submission(count):
+    return {'aluno': 'Aluno', 'datahora': '2024-05-15 10:00:00', 'senha': 'senha',
+            'previsoes': [{'id': i, 'latitude': -22.9 - i / 1000, 'longitude': -43.2} for i in range(count)]}
+
+
+class AvaliaServerTest(unittest.TestCase):
+    """
+    Upload submissions to the /rest/rpc/avalia app served on a local thread.
+    """
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.patches = [
+            mock.patch.object(swagger, 'data_test_end_path', self.folder),
+            mock.patch.object(swagger, 'submission_log', None),
+            mock.patch.object(swagger, 'avaliar_previsoes', lambda previsoes: None),
+            mock.patch.object(uploader, 'BACKOFF_BASE_S', 0.01),
+        ]
+        for patch in self.patches:
+            patch.start()
+
+        # Record the Content-Encoding of every request the app receives
+        self.encodings = []
+
+        def app(environ, start_response):
+            self.encodings.append(environ.get('HTTP_CONTENT_ENCODING'))
+            return swagger.app(environ, start_response)
+
+        self.server = make_server('127.0.0.1', 0, app, threaded=True)
+        self.url = f'http://127.0.0.1:{self.server.server_port}/rest/rpc/avalia'
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.thread.join()
+        if swagger.submission_log is not None:
+            swagger.submission_log.close()
+        for patch in reversed(self.patches):
+            patch.stop()
+        shutil.rmtree(self.folder)
+
+    def logged(self):
+        swagger.submission_log.close()
+        swagger.submission_log = None
+        return list(iter_submissions(f'{self.folder}/{swagger.submissions_folder}'))
+
+    def upload(self, data, **options):
+        return asyncio.run(uploader.upload_submission(self.url, data, **options))
+
+    def test_parts_arrive_gzipped_and_numbered(self):
+        data = make_submission(25)
+        results = self.upload(data, chunk_size=10, concurrency=3)
+
+        self.assertTrue(all(result.status_code == 200 for result in results))
+        self.assertEqual(self.encodings, ['gzip'] * 3)
+        parts = sorted(self.logged(), key=lambda part: part['parte'])
+        self.assertEqual([(part['parte'], part['partes']) for part in parts], [(1, 3), (2, 3), (3, 3)])
+        self.assertEqual([prediction for part in parts for prediction in part['previsoes']], data['previsoes'])
+        self.assertTrue(all(part['aluno'] == data['aluno'] and part['datahora'] == data['datahora'] for part in parts))
+
+    def test_retries_after_503(self):
+        get_submission_log = swagger.get_submission_log
+        failures = [2]
+
+        def flaky_log():
+            if failures[0]:
+                failures[0] -= 1
+                raise OSError('disk full')
+            return get_submission_log()
+
+        with mock.patch.object(swagger, 'get_submission_log', flaky_log):
+            results = self.upload(make_submission(20), chunk_size=10, concurrency=1, retries=3)
+
+        self.assertTrue(all(result.status_code == 200 for result in results))
+        self.assertEqual(len(self.encodings), 4)
+        self.assertEqual(sorted(part['parte'] for part in self.logged()), [1, 2])
+
+    def test_gives_up_after_retries(self):
+        with mock.patch.object(swagger, 'get_submission_log', mock.Mock(side_effect=OSError('disk full'))):
+            results = self.upload(make_submission(5), chunk_size=10, retries=2)
+
+        self.assertIsInstance(results[0], uploader.UploadError)
+        self.assertEqual(len(self.encodings), 3)
+
+    def test_part_sent_again_is_stored_once(self):
+        part = uploader.split_submission(make_submission(15), chunk_size=10)[0]
+        headers = {'Content-Type': 'application/json', 'Content-Encoding': 'gzip'}
+        first = requests.post(self.url, data=gzip.compress(json.dumps(part).encode('utf-8')), headers=headers)
+        second = requests.post(self.url, data=gzip.compress(json.dumps(part).encode('utf-8')), headers=headers)
+
+        self.assertEqual((first.status_code, second.status_code), (200, 200))
+        self.assertEqual(second.json()['message'], 'Dados já recebidos anteriormente.')
+        self.assertEqual(len(self.logged()), 1)
+
+        # The keys are read back from the log when it is opened again
+        log = SubmissionLog(f'{self.folder}/{swagger.submissions_folder}')
+        try:
+            self.assertIsNone(log.append(part))
+            self.assertIsNotNone(log.append(dict(part, parte=2)))
+        finally:
+            log.close()
+        self.assertEqual(len(list(iter_submissions(f'{self.folder}/{swagger.submissions_folder}'))), 2)
+
+    def test_corrected_part_is_stored_again(self):
+        part = uploader.split_submission(make_submission(15), chunk_size=10)[0]
+        corrected = dict(part, previsoes=[dict(prediction, latitude=-23.0) for prediction in part['previsoes']])
+        headers = {'Content-Type': 'application/json', 'Content-Encoding': 'gzip'}
+        for data in (part, corrected):
+            response = requests.post(self.url, data=gzip.compress(json.dumps(data).encode('utf-8')), headers=headers)
+            self.assertEqual(response.json()['message'], 'Dados recebidos e salvos com sucesso!')
+
+        self.assertEqual(self.logged(), [part, corrected])
+        # The later submission wins when the log is exported, as when each one overwrote its file
+        export_path = f'{self.folder}/export'
+        export_submissions(f'{self.folder}/{swagger.submissions_folder}', export_path)
+        with open(f'{export_path}/{submission_filename(part)}') as exported:
+            self.assertEqual(json.load(exported), corrected)
+
+
+if __name__ == '__main__':
+    unittest.main()
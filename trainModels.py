@@ -1,40 +1,120 @@
 import os
 import json
+import time
+import argparse
+import tempfile
+import numpy as np
 import pandas as pd
 from sklearn.linear_model import LinearRegression
 from sklearn.pipeline import make_pipeline
 from sklearn.preprocessing import StandardScaler
 from sklearn.compose import ColumnTransformer
 import joblib
+from store import group_chunks, chunk_digests, read_dataframe
+from manifest import file_sha256
+from parallel import run_file_stage, report_errors
+from localcalendar import local_hours
+from modelbundle import compile_bundle
+from routes import load_routes
+from trajectoryindex import TrajectoryIndexBuilder, INDEX_FILE
+from traveltime import build_profiles, save_profiles, PROFILES_FILE
 
 # Caminhos dos diretórios
 current_dir = os.path.dirname(__file__)
 data_gps_path = os.path.join(current_dir, 'dataGPS')
+store_gps_path = os.path.join(current_dir, 'store', 'dataGPS')
+routes_path = os.path.join(current_dir, 'store', 'routes')
 models_path = os.path.join(current_dir, 'models')
 
 # Linhas de ônibus relevantes
 relevant_lines = [
     '107', '177', '203', '222', '230', '232', '415', '2803', '324', '852', '557', '759', '343', '779', '905', '108',
-    '483', '864', '639', '3', '309', '774', '629', '371', '397', '100', '838', '315', '624', '388', '918', '665',
-    '328', '497', '878', '355', '138', '606', '457', '550', '803', '917', '638', '2336', '399', '298', '867', '553',
-    '565', '422', '756', '186012003', '292', '554', '634', '232', '415', '2803', '324', '852', '557', '759', '343',
-    '779', '905', '108'
+    '483', '864', '639', '3', '309', '774', '629', '371', '397', '100', '838', '315', '624', '388', '918', '665', '328',
+    '497', '878', '355', '138', '606', '457', '550', '803', '917', '638', '2336', '399', '298', '867', '553', '565',
+    '422', '756', '186012003', '292', '554', '634'
 ]
 
+# Métricas calculadas por linha e hora do dia
+METRIC_COLUMNS = ['velocidade', 'latitude', 'longitude']
+
+# Colunas da matriz de métricas compartilhada com os processos de treinamento
+MATRIX_COLUMNS = ['hora_do_dia'] + METRIC_COLUMNS
+
+# Estatísticas de treinamento (somas e contagens por linha e hora do dia) e arquivos já incorporados,
+# usadas pelo modo --update para incorporar apenas os dados novos
+# Versão 2: hora do dia no fuso local (America/Sao_Paulo); a versão 1 usava a hora UTC
+# Versão 3: cada arquivo incorporado é guardado com o hash do seu conteúdo
+TRAIN_STATS_VERSION = 3
+TRAIN_STATS_FILE = 'train_stats.npz'
+
+# Função para preparar os dados de um arquivo: linhas relevantes, tipos numéricos e hora do dia
+def prepare_data(df):
+    df_relevant = df[df['linha'].astype(str).isin(relevant_lines)].copy()
+    df_relevant['linha'] = df_relevant['linha'].astype(str)
+    df_relevant['velocidade'] = df_relevant['velocidade'].astype(float)
+    # Os dados do armazenamento colunar já vêm tipados; só os JSON usam ',' como separador decimal
+    if not pd.api.types.is_numeric_dtype(df_relevant['latitude']):
+        df_relevant['latitude'] = df_relevant['latitude'].str.replace(',', '.').astype(float)  # Substituir ',' por '.'
+    if not pd.api.types.is_numeric_dtype(df_relevant['longitude']):
+        df_relevant['longitude'] = df_relevant['longitude'].str.replace(',', '.').astype(float)  # Substituir ',' por '.'
+    
+    # Certificar que 'datahora' seja numérico antes da conversão
+    df_relevant['datahora'] = pd.to_numeric(df_relevant['datahora'], errors='coerce')
+    # Hora do dia no fuso local (America/Sao_Paulo), como nas previsões
+    df_relevant['hora_do_dia'] = local_hours(df_relevant['datahora'].to_numpy())
+    return df_relevant
+
+# Função para acumular as somas e contagens das métricas por linha e hora do dia
+# O acumulado tem no máximo 24 linhas por linha de ônibus, independentemente do volume de dados
+def accumulate_metrics(totals, data):
+    partial = data.groupby(['linha', 'hora_do_dia'])[METRIC_COLUMNS].agg(['sum', 'count'])
+    if totals is None:
+        return partial
+    return totals.add(partial, fill_value=0)
+
 # Função para calcular a velocidade média, latitude e longitude por linha e hora do dia
-def calculate_metrics(data):
-    data['velocidade'] = data['velocidade'].astype(float)
-    data['latitude'] = data['latitude'].str.replace(',', '.').astype(float)  # Substituir ',' por '.'
-    data['longitude'] = data['longitude'].str.replace(',', '.').astype(float)  # Substituir ',' por '.'
-    
-    avg_metrics = data.groupby(['linha', 'hora_do_dia']).agg({
-        'velocidade': 'mean',
-        'latitude': 'mean',
-        'longitude': 'mean'
+# a partir das somas e contagens acumuladas de todos os arquivos
+def calculate_metrics(totals):
+    avg_metrics = pd.DataFrame({
+        column: totals[(column, 'sum')] / totals[(column, 'count')].where(totals[(column, 'count')] > 0)
+        for column in METRIC_COLUMNS
     }).reset_index()
+    avg_metrics['hora_do_dia'] = avg_metrics['hora_do_dia'].astype(int)
     
     return avg_metrics
 
+# Função para gravar as somas e contagens acumuladas e os arquivos de origem já incorporados,
+# com o hash do conteúdo de cada um ({arquivo: hash})
+def save_train_stats(stats_path, totals, sources):
+    index = totals.index
+    temp_path = f"{stats_path}.tmp.npz"
+    np.savez(temp_path,
+             version=np.array(TRAIN_STATS_VERSION),
+             linha=index.get_level_values('linha').to_numpy(dtype=str),
+             hora_do_dia=index.get_level_values('hora_do_dia').to_numpy(dtype=np.int64),
+             sums=totals[[(column, 'sum') for column in METRIC_COLUMNS]].to_numpy(dtype=np.float64),
+             counts=totals[[(column, 'count') for column in METRIC_COLUMNS]].to_numpy(dtype=np.float64),
+             sources=np.array(sorted(sources), dtype=str),
+             digests=np.array([sources[source] for source in sorted(sources)], dtype=str))
+    os.replace(temp_path, stats_path)
+
+# Função para carregar as estatísticas de treinamento; retorna (None, {}) se não existirem
+def load_train_stats(stats_path):
+    if not os.path.exists(stats_path):
+        return None, {}
+    with np.load(stats_path) as stats:
+        version = int(stats['version'])
+        if version != TRAIN_STATS_VERSION:
+            raise ValueError(f"Versão {version} das estatísticas de treinamento não suportada, esperada {TRAIN_STATS_VERSION}")
+        index = pd.MultiIndex.from_arrays([stats['linha'].astype(object), stats['hora_do_dia']],
+                                          names=['linha', 'hora_do_dia'])
+        data = {}
+        for i, column in enumerate(METRIC_COLUMNS):
+            data[(column, 'sum')] = stats['sums'][:, i]
+            data[(column, 'count')] = stats['counts'][:, i]
+        totals = pd.DataFrame(data, index=index)
+        return totals, dict(zip(stats['sources'].tolist(), stats['digests'].tolist()))
+
 # Função para encontrar recursivamente todos os arquivos _sorted.json em um diretório
 def find_sorted_json_files(directory):
     sorted_json_files = []
@@ -44,80 +124,212 @@ def find_sorted_json_files(directory):
                 sorted_json_files.append(os.path.join(root, file))
     return sorted_json_files
 
-# Verificar se o diretório de modelos existe, caso contrário, criá-lo
-if not os.path.exists(models_path):
-    os.makedirs(models_path)
+# Função para calcular o hash do conteúdo de cada arquivo de origem: no armazenamento colunar, a partir dos
+# metadados de cada chunk (sem ler os dados); nos arquivos _sorted.json, a partir do próprio arquivo
+def source_digests(directory, store_directory):
+    digests = chunk_digests(store_directory)
+    if digests:
+        return digests
+    return {filepath: file_sha256(filepath) for filepath in find_sorted_json_files(directory)}
 
-# Treinamento do modelo
-sorted_json_files = find_sorted_json_files(data_gps_path)
+# Função para iterar sobre os dados de cada arquivo de origem como DataFrames,
+# preferindo o armazenamento colunar gerado pelo main.py (apenas as colunas e linhas necessárias)
+# Os arquivos em skip (já incorporados) são ignorados
+# O armazenamento é percorrido uma única vez, e os diretórios de cada chunk são lidos diretamente
+def iter_data_frames(directory, store_directory, skip=()):
+    chunks = group_chunks(store_directory)
+    if chunks:
+        linhas = set(relevant_lines)
+        for chunk, chunk_dirs in chunks.items():
+            if chunk in skip:
+                continue
+            chunk_dirs = [entry for entry in chunk_dirs if entry[1] in linhas]
+            df = read_dataframe(store_directory, columns=['ordem', 'datahora', 'velocidade', 'latitude', 'longitude'], chunk_dirs=chunk_dirs)
+            df['linha'] = df['linha'].astype(str)
+            yield chunk, df
+        return
+    
+    for filepath in find_sorted_json_files(directory):
+        if filepath in skip:
+            continue
+        with open(filepath, 'r') as file:
+            data = json.load(file)
+        yield filepath, pd.DataFrame(data)
 
-for filepath in sorted_json_files:
-    # Processar o arquivo JSON
-    with open(filepath, 'r') as file:
-        data = json.load(file)
+# Função para treinar e salvar os modelos de velocidade e de coordenadas de uma linha
+# Retorna o tempo de ajuste dos modelos em segundos (sem contar a gravação)
+def train_line_models(linha, data_linha):
+    fit_seconds = 0.0
     
-    # Converter para DataFrame pandas
-    df = pd.DataFrame(data)
+    # Separar features e target (velocidade média)
+    X_speed = data_linha[['hora_do_dia', 'latitude', 'longitude']]
+    y_speed = data_linha['velocidade']
     
-    # Verificar se a coluna 'linha' existe
-    if 'linha' not in df.columns:
-        print(f"Coluna 'linha' não encontrada no arquivo {filepath}")
-        continue
+    # Criar modelo de regressão para velocidade média
+    model_speed = make_pipeline(ColumnTransformer(transformers=[
+        ('scaler', StandardScaler(), ['hora_do_dia', 'latitude', 'longitude'])
+    ]), LinearRegression())
     
-    # Filtrar apenas as linhas relevantes
-    df_relevant = df[df['linha'].astype(str).isin(relevant_lines)]
+    # Treinar o modelo de velocidade média
+    start = time.perf_counter()
+    model_speed.fit(X_speed, y_speed)
+    fit_seconds += time.perf_counter() - start
     
-    # Verificar se df_relevant não está vazio
-    if df_relevant.empty:
-        print(f"Nenhuma linha relevante encontrada no arquivo {filepath}")
-        continue
+    # Salvar o modelo treinado de velocidade média
+    model_speed_filename = f'model_speed_{linha}.joblib'
+    model_speed_path = os.path.join(models_path, model_speed_filename)
+    joblib.dump(model_speed, model_speed_path)
+    print(f'Modelo de velocidade para linha {linha} salvo em {model_speed_path}')
     
-    # Certificar que 'datahora' seja numérico antes da conversão
-    df_relevant['datahora'] = pd.to_numeric(df_relevant['datahora'], errors='coerce')
-    df_relevant['datahora'] = pd.to_datetime(df_relevant['datahora'], unit='ms')
-    df_relevant['hora_do_dia'] = df_relevant['datahora'].dt.hour
+    # Separar features e target (latitude e longitude)
+    X_coords = data_linha[['hora_do_dia', 'velocidade']]
+    y_coords = data_linha[['latitude', 'longitude']]
+    
+    # Criar modelo de regressão para latitude e longitude
+    model_coords = make_pipeline(ColumnTransformer(transformers=[
+        ('scaler', StandardScaler(), ['hora_do_dia', 'velocidade'])
+    ]), LinearRegression())
     
-    # Calcular média das métricas por linha e hora do dia
-    avg_metrics = calculate_metrics(df_relevant)
+    # Treinar o modelo de latitude e longitude
+    start = time.perf_counter()
+    model_coords.fit(X_coords, y_coords)
+    fit_seconds += time.perf_counter() - start
     
-    # Iterar sobre cada linha relevante e treinar um modelo
-    for linha in relevant_lines:
-        # Filtrar dados apenas para a linha atual
-        data_linha = avg_metrics[avg_metrics['linha'] == linha]
+    # Salvar o modelo treinado de latitude e longitude
+    model_coords_filename = f'model_coords_{linha}.joblib'
+    model_coords_path = os.path.join(models_path, model_coords_filename)
+    joblib.dump(model_coords, model_coords_path)
+    print(f'Modelo de coordenadas para linha {linha} salvo em {model_coords_path}')
+    return fit_seconds
+
+# Função para gravar as métricas médias em uma matriz .npy ordenada por linha,
+# lida pelos processos de treinamento por mapeamento em memória em vez de receber DataFrames serializados
+# Retorna o caminho da matriz e o intervalo de linhas (início, fim) de cada linha de ônibus
+def share_metrics(avg_metrics, directory):
+    avg_metrics = avg_metrics.sort_values(['linha', 'hora_do_dia'], kind='stable')
+    matrix_path = os.path.join(directory, 'metrics.npy')
+    np.save(matrix_path, avg_metrics[MATRIX_COLUMNS].to_numpy(dtype=np.float64))
+    
+    linhas, starts = np.unique(avg_metrics['linha'].to_numpy(dtype=str), return_index=True)
+    stops = np.append(starts[1:], len(avg_metrics))
+    return matrix_path, {linha: (int(start), int(stop)) for linha, start, stop in zip(linhas, starts, stops)}
+
+# Função executada em cada processo: lê a fatia da linha na matriz compartilhada e treina seus modelos
+def fit_line(linha, matrix_path, bounds):
+    start, stop = bounds[linha]
+    matrix = np.load(matrix_path, mmap_mode='r')
+    data_linha = pd.DataFrame(np.array(matrix[start:stop]), columns=MATRIX_COLUMNS)
+    return train_line_models(linha, data_linha)
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Treina os modelos de cada linha a partir do histórico em 'dataGPS'.")
+    parser.add_argument('--workers', type=int, default=1,
+                        help="Número de processos treinando linhas em paralelo (padrão: 1, serial).")
+    parser.add_argument('--update', action='store_true',
+                        help="Incorpora apenas os arquivos ainda não usados no treinamento e retreina só as linhas "
+                             "com dados novos, a partir das estatísticas salvas em 'models'.")
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    
+    # Verificar se o diretório de modelos existe, caso contrário, criá-lo
+    if not os.path.exists(models_path):
+        os.makedirs(models_path)
+    
+    stats_path = os.path.join(models_path, TRAIN_STATS_FILE)
+    trajectories_path = os.path.join(models_path, INDEX_FILE)
+    # Os pontos do índice de trajetórias são acumulados em disco, por linha, e não na memória
+    with tempfile.TemporaryDirectory() as spill_dir:
+        trajectories = TrajectoryIndexBuilder(spill_dir, load_routes(routes_path, relevant_lines))
+        train(args, stats_path, trajectories_path, trajectories)
+
+# Função que executa o treinamento, acumulando os pontos do índice de trajetórias no construtor recebido
+def train(args, stats_path, trajectories_path, trajectories):
+    # No modo --update, partir das somas e contagens salvas e do índice de trajetórias existente
+    # Se um arquivo já incorporado mudou (por exemplo, reprocessado pelo main.py) ou foi removido, suas
+    # contribuições antigas não podem ser separadas das demais: o treinamento usa todo o histórico
+    digests = source_digests(data_gps_path, store_gps_path)
+    totals, sources = None, {}
+    update = args.update
+    if update:
+        totals, sources = load_train_stats(stats_path)
+        changed = [source for source, digest in sources.items() if digests.get(source) != digest]
+        if totals is None:
+            print(f"Estatísticas de treinamento não encontradas em {stats_path}; treinando com todo o histórico")
+            update = False
+        elif changed:
+            print(f"{len(changed)} arquivo(s) já incorporado(s) alterado(s) ou removido(s) desde o último treinamento; "
+                  f"treinando com todo o histórico")
+            totals, sources, update = None, {}, False
+        elif os.path.exists(trajectories_path):
+            trajectories.load(trajectories_path)
+    
+    # Percorrer o histórico (ou só os arquivos novos) uma única vez, acumulando as métricas por linha e hora do dia
+    # e os pontos (dentro da rota de cada linha) do índice de trajetórias
+    updated_lines = set()
+    new_sources = []
+    for filepath, df in iter_data_frames(data_gps_path, store_gps_path, skip=sources):
+        new_sources.append(filepath)
+        # Verificar se a coluna 'linha' existe
+        if 'linha' not in df.columns:
+            print(f"Coluna 'linha' não encontrada no arquivo {filepath}")
+            continue
         
-        if len(data_linha) > 0:
-            # Separar features e target (velocidade média)
-            X_speed = data_linha[['hora_do_dia', 'latitude', 'longitude']]
-            y_speed = data_linha['velocidade']
-            
-            # Criar modelo de regressão para velocidade média
-            model_speed = make_pipeline(ColumnTransformer(transformers=[
-                ('scaler', StandardScaler(), ['hora_do_dia', 'latitude', 'longitude'])
-            ]), LinearRegression())
-            
-            # Treinar o modelo de velocidade média
-            model_speed.fit(X_speed, y_speed)
-            
-            # Salvar o modelo treinado de velocidade média
-            model_speed_filename = f'model_speed_{linha}.joblib'
-            model_speed_path = os.path.join(models_path, model_speed_filename)
-            joblib.dump(model_speed, model_speed_path)
-            print(f'Modelo de velocidade para linha {linha} salvo em {model_speed_path}')
-            
-            # Separar features e target (latitude e longitude)
-            X_coords = data_linha[['hora_do_dia', 'velocidade']]
-            y_coords = data_linha[['latitude', 'longitude']]
-            
-            # Criar modelo de regressão para latitude e longitude
-            model_coords = make_pipeline(ColumnTransformer(transformers=[
-                ('scaler', StandardScaler(), ['hora_do_dia', 'velocidade'])
-            ]), LinearRegression())
-            
-            # Treinar o modelo de latitude e longitude
-            model_coords.fit(X_coords, y_coords)
-            
-            # Salvar o modelo treinado de latitude e longitude
-            model_coords_filename = f'model_coords_{linha}.joblib'
-            model_coords_path = os.path.join(models_path, model_coords_filename)
-            joblib.dump(model_coords, model_coords_path)
-            print(f'Modelo de coordenadas para linha {linha} salvo em {model_coords_path}')
+        # Filtrar apenas as linhas relevantes
+        df_relevant = prepare_data(df)
+        
+        # Verificar se df_relevant não está vazio
+        if df_relevant.empty:
+            print(f"Nenhuma linha relevante encontrada no arquivo {filepath}")
+            continue
+        
+        totals = accumulate_metrics(totals, df_relevant)
+        trajectories.add(df_relevant)
+        updated_lines.update(df_relevant['linha'].unique())
+    
+    if totals is None:
+        print("Nenhum dado relevante encontrado para o treinamento")
+        return
+    if update and not new_sources:
+        print("Nenhum arquivo novo para incorporar ao treinamento")
+        return
+    
+    # Salvar as somas e contagens acumuladas para as próximas atualizações
+    save_train_stats(stats_path, totals, dict(sources, **{source: digests.get(source, '') for source in new_sources}))
+    print(f'{len(new_sources)} arquivo(s) incorporado(s); estatísticas de treinamento salvas em {stats_path}')
+    
+    # Calcular média das métricas por linha e hora do dia sobre todo o histórico
+    avg_metrics = calculate_metrics(totals).dropna()
+    
+    # Treinar e salvar os modelos de cada linha relevante uma única vez, em paralelo entre as linhas
+    # (no modo --update, apenas as linhas com dados novos; cada ajuste usa no máximo 24 médias horárias)
+    with tempfile.TemporaryDirectory() as shared_dir:
+        matrix_path, bounds = share_metrics(avg_metrics, shared_dir)
+        linhas = [linha for linha in relevant_lines if linha in bounds and (not update or linha in updated_lines)]
+        
+        start = time.perf_counter()
+        results, errors = run_file_stage(fit_line, linhas, matrix_path, bounds, workers=args.workers)
+        elapsed = time.perf_counter() - start
+    
+    # Relatório do tempo de ajuste de cada linha
+    for linha, fit_seconds in sorted(results, key=lambda result: result[1], reverse=True):
+        print(f'Linha {linha}: modelos ajustados em {fit_seconds * 1000:.1f} ms')
+    print(f'{len(results)} linha(s) treinada(s) em {elapsed:.2f} s com {args.workers} processo(s)')
+    report_errors('treinamento', errors)
+    
+    # Compilar todos os modelos em um único pacote para as previsões
+    print(f'Pacote de modelos salvo em {compile_bundle(models_path)}')
+    
+    # Salvar o índice de trajetórias usado nas previsões de coordenadas
+    linhas_indexadas = trajectories.save(trajectories_path)
+    print(f'Índice de trajetórias com {len(linhas_indexadas)} linha(s) salvo em {trajectories_path}')
+    
+    # Calcular e salvar os perfis de tempo de percurso usados nas previsões de datahora
+    profiles_path = os.path.join(models_path, PROFILES_FILE)
+    profiles = build_profiles(trajectories.lines())
+    save_profiles(profiles_path, profiles)
+    print(f'Perfis de tempo de percurso de {len(profiles)} linha(s) salvos em {profiles_path}')
+
+if __name__ == "__main__":
+    main()
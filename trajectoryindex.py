@@ -0,0 +1,292 @@
+import os
+import zipfile
+import numpy as np
+import pandas as pd
+from scipy.spatial import cKDTree
+from localcalendar import calendar_features, local_time_of_day
+
+INDEX_VERSION = 1
+INDEX_FILE = 'trajectories.npz'
+
+MS_PER_DAY = 86400 * 1000
+
+# Columns the index builder spills to disk, with their types
+SPILL_COLUMNS = {'latitude': np.float64, 'longitude': np.float64, 'datahora': np.int64, 'ordem': np.int32}
+
+# Two pings of the same bus farther apart in time are not interpolated between
+MAX_INTERPOLATION_GAP_MS = 10 * 60 * 1000
+
+# Distance between day types in key space, more than any time-of-day distance,
+# so that other day types are only used when a line has no history for the query's one
+DAY_TYPE_SPACING = MS_PER_DAY
+
+# Radius placing the time of day on a circle whose circumference is one day
+TIME_RADIUS = MS_PER_DAY / (2.0 * np.pi)
+
+
+def day_types(datahora):
+    """
+    Day type of each timestamp: 0 for weekdays, 1 for Saturdays, 2 for Sundays and holidays.
+    """
+    dia_semana, feriado = calendar_features(datahora)
+    return np.where(feriado | (dia_semana == 6), 2, np.where(dia_semana == 5, 1, 0))
+
+
+def index_keys(datahora):
+    """
+    Spatio-temporal keys of timestamps: local time of day on a circle (so 23:59 is next to 00:00)
+    and day type, in milliseconds.
+
+    Returns:
+    - np.ndarray: (n, 3) keys.
+    """
+    datahora = np.asarray(datahora, dtype=np.int64)
+    angle = local_time_of_day(datahora) * (2.0 * np.pi / MS_PER_DAY)
+    return np.column_stack((TIME_RADIUS * np.cos(angle), TIME_RADIUS * np.sin(angle),
+                            day_types(datahora) * DAY_TYPE_SPACING))
+
+
+class TrajectoryIndexBuilder:
+    """
+    Accumulate cleaned historical pings and write them as a trajectory index.
+
+    Pings are appended, per line, to typed binary files in a spill folder
+    (float64 coordinates, int64 timestamps, int32 bus codes), so memory holds
+    one file's pings while adding and one line's pings while writing.
+    """
+
+    def __init__(self, spill_path, routes=None):
+        """
+        Args:
+        - spill_path (str): Empty folder for the accumulated pings, removed by the caller.
+        - routes (Dict[str, routes.Route]): Route of each line; pings off their line's route are left out.
+        """
+        self.spill_path = spill_path
+        self.routes = routes or {}
+        self.ordens = {}
+        self.positions = {}
+
+    def _append(self, linha, latitude, longitude, datahora, ordens):
+        lookup = self.ordens.setdefault(linha, {})
+        codes, uniques = pd.factorize(np.asarray(ordens, dtype=object))
+        codes = np.array([lookup.setdefault(ordem, len(lookup)) for ordem in uniques], dtype=np.int32)[codes]
+        line_path = os.path.join(self.spill_path, str(self.positions.setdefault(linha, len(self.positions))))
+        os.makedirs(line_path, exist_ok=True)
+        arrays = {'latitude': latitude, 'longitude': longitude, 'datahora': datahora, 'ordem': codes}
+        for name, dtype in SPILL_COLUMNS.items():
+            with open(os.path.join(line_path, f"{name}.bin"), 'ab') as spill_file:
+                np.asarray(arrays[name], dtype=dtype).tofile(spill_file)
+
+    def add(self, df):
+        """
+        Add the pings of a DataFrame with 'linha', 'ordem', 'latitude', 'longitude' and 'datahora'.
+        """
+        df = pd.DataFrame({
+            'linha': df['linha'].astype(str),
+            'ordem': df['ordem'].astype(str),
+            'latitude': pd.to_numeric(df['latitude'].astype(str).str.replace(',', '.'), errors='coerce'),
+            'longitude': pd.to_numeric(df['longitude'].astype(str).str.replace(',', '.'), errors='coerce'),
+            'datahora': pd.to_numeric(df['datahora'], errors='coerce'),
+        }).dropna()
+        coordinates = df[['latitude', 'longitude']].to_numpy()
+        datahora = df['datahora'].to_numpy().astype(np.int64)
+        ordens = df['ordem'].to_numpy()
+        for linha, index in df.groupby('linha').indices.items():
+            if linha in self.routes:
+                index = index[self.routes[linha].on_route(coordinates[index])]
+            if len(index):
+                self._append(linha, coordinates[index, 0], coordinates[index, 1], datahora[index], ordens[index])
+
+    def load(self, index_path):
+        """
+        Add the pings of a saved index, e.g. to extend it with new data.
+        """
+        with np.load(index_path) as archive:
+            version = int(archive['version'])
+            if version != INDEX_VERSION:
+                raise ValueError(f"Unsupported trajectory index version {version}, expected {INDEX_VERSION}")
+            for linha in archive['linhas'].tolist():
+                self._append(linha, archive[f'{linha}/latitude'], archive[f'{linha}/longitude'],
+                             archive[f'{linha}/datahora'],
+                             archive[f'{linha}/ordens'].astype(object)[archive[f'{linha}/ordem']])
+
+    def lines(self):
+        """
+        The accumulated pings of each line, in line order, without duplicates and sorted by ('ordem', 'datahora').
+
+        Returns:
+        - Iterator[Tuple[str, np.ndarray, np.ndarray, np.ndarray, np.ndarray, np.ndarray]]: Line, latitude,
+          longitude, datahora, codes of 'ordem' and the sorted 'ordem' values they index.
+        """
+        for linha in sorted(self.positions):
+            line_path = os.path.join(self.spill_path, str(self.positions[linha]))
+            arrays = {name: np.fromfile(os.path.join(line_path, f"{name}.bin"), dtype=dtype)
+                      for name, dtype in SPILL_COLUMNS.items()}
+            ordens = np.array(sorted(self.ordens[linha]), dtype=str)
+            rank = np.empty(len(ordens), dtype=np.int32)
+            rank[[self.ordens[linha][ordem] for ordem in ordens.tolist()]] = np.arange(len(ordens))
+            ordem = rank[arrays['ordem']]
+
+            # The first ping added of each ('ordem', 'datahora') is kept
+            order = np.lexsort((np.arange(len(ordem)), arrays['datahora'], ordem))
+            ordem, datahora = ordem[order], arrays['datahora'][order]
+            first = np.ones(len(order), dtype=bool)
+            first[1:] = (ordem[1:] != ordem[:-1]) | (datahora[1:] != datahora[:-1])
+            order = order[first]
+            yield (linha, arrays['latitude'][order], arrays['longitude'][order], arrays['datahora'][order],
+                   ordem[first], ordens)
+
+    def save(self, index_path):
+        """
+        Write the index, one line at a time: per line, the pings sorted by ('ordem', 'datahora').
+
+        Returns:
+        - List[str]: Lines in the index.
+        """
+        os.makedirs(os.path.dirname(os.path.abspath(index_path)), exist_ok=True)
+        temp_path = f"{index_path}.tmp.npz"
+        linhas = []
+        with zipfile.ZipFile(temp_path, 'w', compression=zipfile.ZIP_STORED, allowZip64=True) as archive:
+            def write(name, array):
+                with archive.open(f"{name}.npy", 'w', force_zip64=True) as member:
+                    np.lib.format.write_array(member, np.asanyarray(array), allow_pickle=False)
+
+            write('version', np.array(INDEX_VERSION))
+            for linha, latitude, longitude, datahora, ordem, ordens in self.lines():
+                write(f'{linha}/latitude', latitude)
+                write(f'{linha}/longitude', longitude)
+                write(f'{linha}/datahora', datahora)
+                write(f'{linha}/ordem', ordem)
+                write(f'{linha}/ordens', ordens)
+                linhas.append(linha)
+            write('linhas', np.array(linhas, dtype=str))
+        os.replace(temp_path, index_path)
+        return linhas
+
+
+class LineTrajectories:
+    """
+    Historical pings of one line, with KD-trees over their spatio-temporal keys
+    (one for the whole line and, built on first use, one per bus).
+    """
+
+    def __init__(self, latitude, longitude, datahora, ordem, ordens):
+        self.latitude = latitude
+        self.longitude = longitude
+        self.datahora = datahora
+        self.ordem = ordem
+        self.ordem_index = {value: code for code, value in enumerate(ordens)}
+        self.keys = index_keys(datahora)
+        self.tree = cKDTree(self.keys)
+        self.ordem_trees = {}
+
+        # Whether each ping can be interpolated with the next one of the same bus
+        self.joins_next = np.zeros(len(datahora), dtype=bool)
+        self.joins_next[:-1] = (ordem[1:] == ordem[:-1]) & (np.diff(datahora) <= MAX_INTERPOLATION_GAP_MS)
+
+    def ordem_tree(self, code):
+        if code not in self.ordem_trees:
+            positions = np.flatnonzero(self.ordem == code)
+            self.ordem_trees[code] = (cKDTree(self.keys[positions]), positions)
+        return self.ordem_trees[code]
+
+    def nearest(self, keys, ordens):
+        """
+        Historical ping nearest to each query key, from the same bus when it has history.
+        """
+        nearest = np.empty(len(keys), dtype=np.int64)
+        codes = np.array([self.ordem_index.get(ordem, -1) for ordem in ordens], dtype=np.int64)
+        for code in np.unique(codes):
+            queries = np.flatnonzero(codes == code)
+            if code < 0:
+                nearest[queries] = self.tree.query(keys[queries])[1]
+            else:
+                tree, positions = self.ordem_tree(code)
+                nearest[queries] = positions[tree.query(keys[queries])[1]]
+        return nearest
+
+    def locate(self, datahora, ordens):
+        """
+        Expected position at each query time: the nearest historical ping in (day type, time of day),
+        interpolated along its bus's trajectory to the query's time of day.
+
+        Args:
+        - datahora (np.ndarray): Query timestamps in milliseconds.
+        - ordens (List[str]): Bus of each query (None if unknown).
+
+        Returns:
+        - np.ndarray: (n, 2) latitude and longitude.
+        """
+        nearest = self.nearest(index_keys(datahora), ordens)
+
+        # Signed time-of-day offset from the ping to the query, wrapped to half a day
+        offset = (local_time_of_day(datahora) - local_time_of_day(self.datahora[nearest]) + MS_PER_DAY // 2) \
+            % MS_PER_DAY - MS_PER_DAY // 2
+        forward = offset >= 0
+        first = np.where(forward, nearest, nearest - 1)
+        joined = (first >= 0) & self.joins_next[np.maximum(first, 0)]
+        first = np.where(joined, first, nearest)
+        second = np.where(joined, first + 1, nearest)
+
+        span = (self.datahora[second] - self.datahora[first]).astype(np.float64)
+        target = self.datahora[nearest] + offset
+        t = np.zeros(len(nearest))
+        np.divide(target - self.datahora[first], span, out=t, where=span > 0)
+        t = np.clip(t, 0.0, 1.0)
+        latitude = self.latitude[first] + t * (self.latitude[second] - self.latitude[first])
+        longitude = self.longitude[first] + t * (self.longitude[second] - self.longitude[first])
+        return np.column_stack((latitude, longitude))
+
+
+class TrajectoryIndex:
+    """
+    Persisted trajectory index; each line is loaded and indexed on first use.
+    """
+
+    def __init__(self, index_path):
+        self.archive = np.load(index_path)
+        version = int(self.archive['version'])
+        if version != INDEX_VERSION:
+            raise ValueError(f"Unsupported trajectory index version {version}, expected {INDEX_VERSION}")
+        self.lines = set(self.archive['linhas'].tolist())
+        self.loaded = {}
+
+    def __contains__(self, linha):
+        return linha in self.lines
+
+    def line(self, linha):
+        if linha not in self.loaded:
+            self.loaded[linha] = LineTrajectories(*(self.archive[f'{linha}/{name}'] for name in
+                                                    ('latitude', 'longitude', 'datahora', 'ordem', 'ordens')))
+        return self.loaded[linha]
+
+    def locate(self, linhas, datahora, ordens):
+        """
+        Expected positions for queries of any lines.
+
+        Args:
+        - linhas (List[str]): Line of each query.
+        - datahora (np.ndarray): Query timestamps in milliseconds.
+        - ordens (List[str]): Bus of each query (None if unknown).
+
+        Returns:
+        - np.ndarray: (n, 2) latitude and longitude, NaN for lines without history.
+        """
+        datahora = np.asarray(datahora, dtype=np.int64)
+        linhas = np.asarray(linhas, dtype=object)
+        ordens = np.asarray(ordens, dtype=object)
+        coords = np.full((len(datahora), 2), np.nan)
+        for linha in pd.unique(linhas):
+            if linha not in self.lines:
+                continue
+            queries = np.flatnonzero(linhas == linha)
+            coords[queries] = self.line(linha).locate(datahora[queries], ordens[queries].tolist())
+        return coords
+
+
+def load_trajectory_index(models_path):
+    """
+    Load the trajectory index saved in the models folder, or None if there is none.
+    """
+    index_path = os.path.join(models_path, INDEX_FILE)
+    return TrajectoryIndex(index_path) if os.path.exists(index_path) else None
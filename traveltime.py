@@ -0,0 +1,338 @@
+import os
+import numpy as np
+import pandas as pd
+from cleaning import project_to_meters
+from localcalendar import local_hours
+from routes import Route, ROUTE_SNAP_METERS
+
+PROFILES_VERSION = 1
+PROFILES_FILE = 'traveltime.npz'
+
+# Length of the route-progress bins of a profile
+PROFILE_BIN_METERS = 100.0
+
+HOURS_PER_DAY = 24
+
+# Time zone offsets and daylight saving changes are multiples of 15 minutes
+QUARTER_HOUR_MS = 15 * 60 * 1000
+
+# Two pings of the same bus farther apart in time do not belong to the same trip
+MAX_TRIP_GAP_MS = 10 * 60 * 1000
+
+# Pace (seconds per metre) used where a line has no history at all: 20 km/h
+DEFAULT_PACE = 3.6 / 20.0
+
+# Pings farther than this from the reference path are not used to build the profile
+MAX_PROJECTION_METERS = 200.0
+
+
+def split_trips(ordem_codes, datahora):
+    """
+    Trip number of each ping, for pings sorted by (ordem, datahora): a new trip starts with a new bus
+    or after a gap longer than MAX_TRIP_GAP_MS.
+    """
+    new_trip = np.ones(len(datahora), dtype=bool)
+    new_trip[1:] = (ordem_codes[1:] != ordem_codes[:-1]) | (np.diff(datahora) > MAX_TRIP_GAP_MS)
+    return np.cumsum(new_trip) - 1
+
+
+def reference_path(points, trips):
+    """
+    Pick the reference path of a line: the longest one-way leg of any trip.
+
+    In each trip the leg runs between its two farthest-apart pings, found with
+    two sweeps (the ping farthest from the first one, then the ping farthest
+    from that), so round trips do not fold the path onto itself.
+
+    Args:
+    - points (np.ndarray): (n, 2) planar points in metres, sorted by trip and time.
+    - trips (np.ndarray): Trip number of each point.
+
+    Returns:
+    - np.ndarray: Positions of the points of the path, in travel order.
+    """
+    best, best_length = np.empty(0, dtype=np.int64), 0.0
+    bounds = np.flatnonzero(np.diff(trips, prepend=-1, append=-1))
+    for start, stop in zip(bounds[:-1], bounds[1:]):
+        trip = points[start:stop]
+        if len(trip) < 2:
+            continue
+        b = int(np.argmax(np.hypot(*(trip - trip[0]).T)))
+        c = int(np.argmax(np.hypot(*(trip - trip[b]).T)))
+        length = float(np.hypot(*(trip[c] - trip[b])))
+        if length > best_length:
+            best_length = length
+            best = np.arange(start + min(b, c), start + max(b, c) + 1)
+    return best
+
+
+class TravelTimeProfile:
+    """
+    Travel-time profile of a line: expected elapsed time along its reference path, by local hour of day.
+    """
+
+    def __init__(self, path, reference_latitude, elapsed):
+        """
+        Args:
+        - path (np.ndarray): (m + 1, 2) vertices (latitude, longitude) of the reference path, in travel order.
+        - reference_latitude (float): Latitude, in radians, of the planar projection.
+        - elapsed (np.ndarray): (24, bins + 1) expected seconds from the path start to each bin edge, per hour.
+        """
+        self.path = np.asarray(path, dtype=np.float64)
+        self.reference_latitude = float(reference_latitude)
+        self.elapsed = np.asarray(elapsed, dtype=np.float64)
+        self.route = Route(np.concatenate((self.path[:-1], self.path[1:]), axis=1), reference_latitude)
+        vertices = project_to_meters(self.path, reference_latitude=reference_latitude)
+        self.segment_lengths = np.hypot(*np.diff(vertices, axis=0).T)
+        self.cumulative = np.concatenate(([0.0], np.cumsum(self.segment_lengths)))
+        self.edges = np.minimum(np.arange(self.elapsed.shape[1]) * PROFILE_BIN_METERS, self.cumulative[-1])
+
+    def progress(self, coordinates):
+        """
+        Project points onto the reference path.
+
+        Args:
+        - coordinates (np.ndarray): (n, 2) latitude and longitude.
+
+        Returns:
+        - Tuple[np.ndarray, np.ndarray]: Distance along the path in metres, and distance from the path
+          (inf when farther than the route tolerance, in which case the progress is the nearest vertex's).
+        """
+        distance, segment, along = self.route.nearest(coordinates)
+        progress = np.zeros(len(coordinates))
+        found = segment >= 0
+        progress[found] = self.cumulative[segment[found]] + along[found] * self.segment_lengths[segment[found]]
+
+        # Points away from the path take the nearest vertex, compared a block at a time
+        missing = np.flatnonzero(~found & np.all(np.isfinite(coordinates), axis=1))
+        if len(missing):
+            vertices = project_to_meters(self.path, reference_latitude=self.reference_latitude)
+            points = project_to_meters(coordinates[missing], reference_latitude=self.reference_latitude)
+            block_size = max(1, (1 << 20) // len(vertices))
+            for block_start in range(0, len(missing), block_size):
+                block = slice(block_start, block_start + block_size)
+                diff = points[block, None, :] - vertices[None, :, :]
+                nearest = np.argmin(np.einsum('ijk,ijk->ij', diff, diff), axis=1)
+                progress[missing[block]] = self.cumulative[nearest]
+        return progress, distance
+
+    def elapsed_at(self, progress, hours):
+        """
+        Expected seconds from the path start to each progress, at each local hour (O(log n) per lookup).
+        """
+        progress = np.asarray(progress, dtype=np.float64)
+        hours = np.asarray(hours, dtype=np.int64)
+        result = np.empty(len(progress))
+        for hour in np.unique(hours):
+            queries = hours == hour
+            result[queries] = np.interp(progress[queries], self.edges, self.elapsed[hour])
+        return result
+
+
+def build_profile(latitude, longitude, datahora, ordem):
+    """
+    Build a line's travel-time profile from its cleaned history.
+
+    Consecutive pings of the same trip give a pace (seconds per metre of
+    route progress), accumulated per (hour of day, progress bin). Empty cells
+    take the line's pace for that hour, then its overall pace. The profile
+    is the cumulative sum of pace times bin length.
+
+    Args:
+    - latitude (np.ndarray): Latitudes in degrees.
+    - longitude (np.ndarray): Longitudes in degrees.
+    - datahora (np.ndarray): Timestamps in milliseconds.
+    - ordem (np.ndarray): Vehicle identifiers (or their codes).
+
+    Returns:
+    - TravelTimeProfile: The profile, or None if the line has no usable trip.
+    """
+    coordinates = np.column_stack((latitude, longitude)).astype(np.float64)
+    valid = np.all(np.isfinite(coordinates), axis=1)
+    if np.count_nonzero(valid) < 2:
+        return None
+    ordem_codes = pd.factorize(np.asarray(ordem)[valid])[0]
+    datahora = np.asarray(datahora, dtype=np.int64)[valid]
+    order = np.lexsort((datahora, ordem_codes))
+    coordinates, datahora, ordem_codes = coordinates[valid][order], datahora[order], ordem_codes[order]
+    reference_latitude = float(np.mean(np.radians(coordinates[:, 0])))
+    trips = split_trips(ordem_codes, datahora)
+
+    # Reference path, dropping vertices closer than the snapping distance
+    path_index = reference_path(project_to_meters(coordinates, reference_latitude=reference_latitude), trips)
+    if len(path_index) < 2:
+        return None
+    path = coordinates[path_index]
+    path_points = project_to_meters(path, reference_latitude=reference_latitude)
+    keep = [0]
+    for i in range(1, len(path_points)):
+        if np.hypot(*(path_points[i] - path_points[keep[-1]])) >= ROUTE_SNAP_METERS:
+            keep.append(i)
+    path = path[keep]
+    if len(path) < 2:
+        return None
+
+    bins = max(1, int(np.ceil(np.hypot(*np.diff(project_to_meters(path, reference_latitude=reference_latitude),
+                                                axis=0).T).sum() / PROFILE_BIN_METERS)))
+    profile = TravelTimeProfile(path, reference_latitude, np.zeros((HOURS_PER_DAY, bins + 1)))
+    progress, distance = profile.progress(coordinates)
+
+    # Pace between consecutive pings of the same trip, both near the path
+    near = distance <= MAX_PROJECTION_METERS
+    pair = (trips[1:] == trips[:-1]) & near[1:] & near[:-1]
+    moved = np.abs(np.diff(progress))[pair]
+    seconds = (np.diff(datahora) / 1000.0)[pair]
+    useful = moved > 0
+    moved, seconds = moved[useful], seconds[useful]
+    middle = ((progress[1:] + progress[:-1]) / 2.0)[pair][useful]
+    hours = local_hours(datahora[:-1][pair][useful])
+    bin_index = np.minimum((middle // PROFILE_BIN_METERS).astype(np.int64), bins - 1)
+
+    total_seconds = np.zeros((HOURS_PER_DAY, bins))
+    total_meters = np.zeros((HOURS_PER_DAY, bins))
+    np.add.at(total_seconds, (hours, bin_index), seconds)
+    np.add.at(total_meters, (hours, bin_index), moved)
+
+    overall_pace = seconds.sum() / moved.sum() if moved.sum() > 0 else DEFAULT_PACE
+    hour_meters = total_meters.sum(axis=1)
+    hour_pace = np.full(HOURS_PER_DAY, overall_pace)
+    np.divide(total_seconds.sum(axis=1), hour_meters, out=hour_pace, where=hour_meters > 0)
+    pace = np.repeat(hour_pace[:, None], bins, axis=1)
+    np.divide(total_seconds, total_meters, out=pace, where=total_meters > 0)
+
+    bin_lengths = np.diff(profile.edges)
+    elapsed = np.concatenate((np.zeros((HOURS_PER_DAY, 1)), np.cumsum(pace * bin_lengths, axis=1)), axis=1)
+    return TravelTimeProfile(path, reference_latitude, elapsed)
+
+
+def build_profiles(lines):
+    """
+    Build the travel-time profile of every line.
+
+    Args:
+    - lines (Iterable[Tuple]): Cleaned history of each line, as yielded by
+      trajectoryindex.TrajectoryIndexBuilder.lines: line, latitude, longitude, datahora and 'ordem' codes.
+
+    Returns:
+    - Dict[str, TravelTimeProfile]: Profile of each line that has one.
+    """
+    profiles = {}
+    for linha, latitude, longitude, datahora, ordem, *_ in lines:
+        profile = build_profile(latitude, longitude, datahora, ordem)
+        if profile is not None:
+            profiles[linha] = profile
+    return profiles
+
+
+def save_profiles(profiles_path, profiles):
+    """
+    Write travel-time profiles to a single .npz file.
+    """
+    arrays = {'version': np.array(PROFILES_VERSION), 'linhas': np.array(sorted(profiles), dtype=str)}
+    for linha, profile in profiles.items():
+        arrays[f'{linha}/path'] = profile.path
+        arrays[f'{linha}/reference_latitude'] = np.array(profile.reference_latitude)
+        arrays[f'{linha}/elapsed'] = profile.elapsed
+    os.makedirs(os.path.dirname(os.path.abspath(profiles_path)), exist_ok=True)
+    temp_path = f"{profiles_path}.tmp.npz"
+    np.savez(temp_path, **arrays)
+    os.replace(temp_path, profiles_path)
+
+
+class TravelTimeProfiles:
+    """
+    Persisted travel-time profiles; each line is loaded on first use.
+    """
+
+    def __init__(self, profiles_path):
+        self.archive = np.load(profiles_path)
+        version = int(self.archive['version'])
+        if version != PROFILES_VERSION:
+            raise ValueError(f"Unsupported travel-time profiles version {version}, expected {PROFILES_VERSION}")
+        self.lines = set(self.archive['linhas'].tolist())
+        self.loaded = {}
+
+    def __contains__(self, linha):
+        return linha in self.lines
+
+    def line(self, linha):
+        if linha not in self.loaded:
+            self.loaded[linha] = TravelTimeProfile(self.archive[f'{linha}/path'],
+                                                   self.archive[f'{linha}/reference_latitude'],
+                                                   self.archive[f'{linha}/elapsed'])
+        return self.loaded[linha]
+
+    def predict_timestamps(self, linhas, ordens, coordinates, datahora, groups=None):
+        """
+        Estimate when each bus is at a position, from the travel time since its last known position.
+
+        Queries are walked in input order. Those with a datahora are anchors: the
+        bus (ordem) was at that position at that time. A query without one gets
+        the anchor time plus the profile's travel time between the anchor's
+        position and its own, at the anchor's local hour, and becomes the next
+        anchor. Anchors are kept per (linha, ordem), falling back to the line's
+        latest anchor for buses seen for the first time. With groups, anchors are
+        also kept per group, so queries of different groups never anchor each other.
+
+        Args:
+        - linhas (List[str]): Line of each query.
+        - ordens (List[str]): Bus of each query (None if unknown).
+        - coordinates (np.ndarray): (n, 2) latitude and longitude of each query.
+        - datahora (np.ndarray): Known timestamp in ms of each query, NaN for the ones to predict.
+        - groups (np.ndarray): Group of each query (e.g. the request it came from), or None for a single group.
+
+        Returns:
+        - np.ndarray: Predicted timestamps, NaN where the line has no profile or there is no anchor yet.
+        """
+        linhas = np.asarray(linhas, dtype=object)
+        datahora = np.asarray(datahora, dtype=np.float64)
+        progress = np.full(len(linhas), np.nan)
+        for linha in pd.unique(linhas):
+            if linha in self.lines:
+                queries = np.flatnonzero(linhas == linha)
+                progress[queries] = self.line(linha).progress(np.asarray(coordinates)[queries])[0]
+
+        # Elapsed time from the path start at every hour, so that the walk below only picks values
+        elapsed = np.full((len(linhas), HOURS_PER_DAY), np.nan)
+        for linha in pd.unique(linhas):
+            if linha in self.lines:
+                queries = np.flatnonzero(linhas == linha)
+                for hour in range(HOURS_PER_DAY):
+                    elapsed[queries, hour] = self.line(linha).elapsed_at(progress[queries],
+                                                                         np.full(len(queries), hour))
+
+        located = np.isfinite(progress)
+        known = np.isfinite(datahora) & located
+        hours = np.full(len(linhas), -1, dtype=np.int64)
+        hours[known] = local_hours(datahora[known].astype(np.int64))
+        quarter_hours = {}
+
+        predicted = np.full(len(linhas), np.nan)
+        anchors = {}
+        groups = [None] * len(linhas) if groups is None else np.asarray(groups).tolist()
+        for i, (linha, ordem, group) in enumerate(zip(linhas.tolist(), list(ordens), groups)):
+            if not located[i]:
+                continue
+            if known[i]:
+                anchors[(group, linha, ordem)] = anchors[(group, linha, None)] = (datahora[i], i, hours[i])
+                continue
+            anchor = anchors.get((group, linha, ordem)) or anchors.get((group, linha, None))
+            if anchor is None:
+                continue
+            anchor_time, anchor_index, anchor_hour = anchor
+            predicted[i] = anchor_time + 1000.0 * abs(elapsed[i, anchor_hour] - elapsed[anchor_index, anchor_hour])
+            # Hour of the new anchor, converted once per distinct quarter of an hour
+            quarter = int(predicted[i] // QUARTER_HOUR_MS)
+            if quarter not in quarter_hours:
+                quarter_hours[quarter] = int(local_hours(np.array([quarter * QUARTER_HOUR_MS]))[0])
+            hour = quarter_hours[quarter]
+            anchors[(group, linha, ordem)] = anchors[(group, linha, None)] = (predicted[i], i, hour)
+        return predicted
+
+
+def load_profiles(models_path):
+    """
+    Load the travel-time profiles saved in the models folder, or None if there are none.
+    """
+    profiles_path = os.path.join(models_path, PROFILES_FILE)
+    return TravelTimeProfiles(profiles_path) if os.path.exists(profiles_path) else None
@@ -0,0 +1,190 @@
+import json
+import gzip
+import time
+import random
+import asyncio
+import argparse
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
+import requests
+from requests.adapters import HTTPAdapter
+
+# Predictions sent per request
+DEFAULT_CHUNK_SIZE = 50000
+
+# Requests in flight at once, and connections kept open in the session's pool
+DEFAULT_CONCURRENCY = 4
+
+# Attempts after the first one, and the exponential backoff between them (seconds)
+DEFAULT_RETRIES = 5
+BACKOFF_BASE_S = 0.5
+BACKOFF_MAX_S = 30.0
+
+# Timeout of each request (seconds)
+DEFAULT_TIMEOUT_S = 60.0
+
+# Responses worth retrying: rate limiting and transient server errors
+RETRY_STATUSES = frozenset({408, 429, 500, 502, 503, 504})
+
+GZIP_LEVEL = 6
+
+
+class UploadError(Exception):
+    """
+    Raised when a chunk could not be delivered after all its attempts.
+    """
+
+
+def split_submission(data, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Split a submission into parts of at most chunk_size predictions.
+
+    Every part keeps the submission's other fields ('aluno', 'datahora', 'senha', ...)
+    and is numbered with 'parte' (from 1) and 'partes', so that the server can store
+    the parts side by side. ('aluno', 'datahora', 'parte') and the part's content form its
+    idempotency key: the server ignores a part it already received unchanged, so retrying
+    a part is always safe.
+
+    Args:
+    - data (Dict): Submission, as in resposta.json.
+    - chunk_size (int): Maximum predictions per part.
+
+    Returns:
+    - List[Dict]: The parts, in order.
+    """
+    previsoes = data['previsoes']
+    fields = {key: value for key, value in data.items() if key != 'previsoes'}
+    starts = range(0, max(len(previsoes), 1), chunk_size)
+    return [dict(fields, previsoes=previsoes[start:start + chunk_size], parte=number, partes=len(starts))
+            for number, start in enumerate(starts, 1)]
+
+
+def gzip_json(payload):
+    """
+    Serialize a payload as gzip-compressed JSON.
+    """
+    return gzip.compress(json.dumps(payload, ensure_ascii=False).encode('utf-8'), compresslevel=GZIP_LEVEL)
+
+
+def make_session(pool_size=DEFAULT_CONCURRENCY):
+    """
+    HTTP session reusing up to pool_size keep-alive connections per host. Retries are handled by the uploader.
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=0)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    session.headers.update({
+        'accept': 'application/json',
+        'Content-Type': 'application/json',
+        'Content-Encoding': 'gzip',
+    })
+    return session
+
+
+def backoff_delay(attempt, response=None):
+    """
+    Delay before retry number attempt (from 0): exponential with full jitter, or the server's Retry-After.
+    """
+    retry_after = response.headers.get('Retry-After') if response is not None else None
+    if retry_after is not None:
+        try:
+            return min(float(retry_after), BACKOFF_MAX_S)
+        except ValueError:
+            pass
+    return random.uniform(0, min(BACKOFF_MAX_S, BACKOFF_BASE_S * 2 ** attempt))
+
+
+async def post_part(session, executor, semaphore, url, part, retries=DEFAULT_RETRIES, timeout=DEFAULT_TIMEOUT_S):
+    """
+    Compress and send one part, retrying connection errors and retryable statuses.
+
+    The semaphore bounds the requests in flight, and with them the compressed bodies held in memory.
+
+    Returns:
+    - requests.Response: The successful response.
+    """
+    loop = asyncio.get_running_loop()
+    async with semaphore:
+        body = await loop.run_in_executor(executor, gzip_json, part)
+        for attempt in range(retries + 1):
+            response, error = None, None
+            try:
+                response = await loop.run_in_executor(executor, partial(session.post, url, data=body, timeout=timeout))
+            except (requests.ConnectionError, requests.Timeout) as e:
+                error = f"{type(e).__name__}: {e}"
+            else:
+                if response.status_code < 400:
+                    return response
+                error = f"HTTP {response.status_code}: {response.text[:200]}"
+                if response.status_code not in RETRY_STATUSES:
+                    break
+            if attempt < retries:
+                await asyncio.sleep(backoff_delay(attempt, response))
+        raise UploadError(f"Part {part['parte']}/{part['partes']} failed: {error}")
+
+
+async def upload_submission(url, data, chunk_size=DEFAULT_CHUNK_SIZE, concurrency=DEFAULT_CONCURRENCY,
+                            retries=DEFAULT_RETRIES, timeout=DEFAULT_TIMEOUT_S):
+    """
+    Upload a submission in gzip-compressed parts over a pooled session.
+
+    Args:
+    - url (str): Endpoint receiving the parts.
+    - data (Dict): Submission, as in resposta.json.
+    - chunk_size (int): Maximum predictions per part.
+    - concurrency (int): Parts in flight at once.
+    - retries (int): Attempts after the first one for each part.
+    - timeout (float): Timeout of each request, in seconds.
+
+    Returns:
+    - List[Union[requests.Response, UploadError]]: Outcome of each part, in order.
+    """
+    parts = split_submission(data, chunk_size)
+    semaphore = asyncio.Semaphore(concurrency)
+    with make_session(concurrency) as session, ThreadPoolExecutor(max_workers=concurrency) as executor:
+        return await asyncio.gather(*(post_part(session, executor, semaphore, url, part, retries, timeout)
+                                      for part in parts), return_exceptions=True)
+
+
+def upload_file(url, filepath, **options):
+    """
+    Upload a resposta.json file; see upload_submission for the options.
+
+    Returns:
+    - List[Union[requests.Response, UploadError]]: Outcome of each part, in order.
+    """
+    with open(filepath, 'r', encoding='utf-8') as file:
+        data = json.load(file)
+    return asyncio.run(upload_submission(url, data, **options))
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Upload a resposta.json submission in compressed parts.")
+    parser.add_argument('url', help="Endpoint receiving the submission, e.g. http://127.0.0.1:5000/rest/rpc/avalia.")
+    parser.add_argument('filepath', nargs='?', default='resposta.json', help="Submission file (default: resposta.json).")
+    parser.add_argument('--chunk-size', type=int, default=DEFAULT_CHUNK_SIZE,
+                        help="Predictions per request (default: %(default)s).")
+    parser.add_argument('--concurrency', type=int, default=DEFAULT_CONCURRENCY,
+                        help="Requests in flight at once (default: %(default)s).")
+    parser.add_argument('--retries', type=int, default=DEFAULT_RETRIES,
+                        help="Retries of each request (default: %(default)s).")
+    parser.add_argument('--timeout', type=float, default=DEFAULT_TIMEOUT_S,
+                        help="Timeout of each request in seconds (default: %(default)s).")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    start = time.perf_counter()
+    outcomes = upload_file(args.url, args.filepath, chunk_size=args.chunk_size, concurrency=args.concurrency,
+                           retries=args.retries, timeout=args.timeout)
+    failed = [outcome for outcome in outcomes if isinstance(outcome, Exception)]
+    print(f"{len(outcomes) - len(failed)}/{len(outcomes)} part(s) uploaded in {time.perf_counter() - start:.2f} s")
+    for error in failed:
+        print(f"  {error}")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())